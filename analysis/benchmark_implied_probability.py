@@ -0,0 +1,52 @@
+import time
+import numpy as np
+import pandas as pd
+from implied_probability import implied_probabilities, implied_probability, remove_vig
+
+N_LINES = 1_000_000
+# The scalar function is timed on a sample and scaled, a full million-line loop adds nothing but waiting
+SCALAR_SAMPLE = 200_000
+
+
+def sample_odds(n, seed=0):
+    """
+    :param n: Number of lines
+    :param seed: Random seed
+    :return: Dict of odds type to n lines in that format
+    """
+    rng = np.random.default_rng(seed)
+    american = np.where(rng.random(n) < 0.5, -rng.integers(101, 400, n), rng.integers(100, 400, n))
+    numerator, denominator = rng.integers(1, 20, n), rng.integers(1, 10, n)
+    fractional = pd.Series(numerator).astype(str) + '/' + pd.Series(denominator).astype(str)
+
+    return {'American': american, 'Decimal': 1 + rng.random(n) * 5, 'Fractional': fractional.to_numpy()}
+
+
+def per_million(func, n):
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) * 1_000_000 / n
+
+
+if __name__ == '__main__':
+    books = sample_odds(N_LINES)
+
+    print(f'{"format":<12} {"scalar s/1M":>12} {"vectorized s/1M":>16} {"speedup":>8}')
+    for odds_type, odds in books.items():
+        sample = odds[:SCALAR_SAMPLE]
+        scalar = per_million(lambda: [implied_probability(x, odds_type) for x in sample], SCALAR_SAMPLE)
+        vectorized = per_million(lambda: implied_probabilities(odds, odds_type), N_LINES)
+        assert np.allclose(implied_probabilities(sample[:1000], odds_type), [implied_probability(x, odds_type) for x in sample[:1000]])
+        print(f'{odds_type:<12} {scalar:>12.3f} {vectorized:>16.3f} {scalar / vectorized:>7.0f}x')
+
+    mixed = np.concatenate([books['American'][:N_LINES // 3].astype(object), books['Decimal'][:N_LINES // 3].astype(object),
+                            books['Fractional'][:N_LINES - 2 * (N_LINES // 3)]])
+    print(f'{"Mixed":<12} {"":>12} {per_million(lambda: implied_probabilities(mixed, "Mixed"), N_LINES):>16.3f}')
+
+    # Two-way markets with a 2-8% bookmaker margin
+    rng = np.random.default_rng(1)
+    fair = rng.uniform(0.1, 0.9, N_LINES // 2)
+    markets = np.c_[fair, 1 - fair] * rng.uniform(1.02, 1.08, (N_LINES // 2, 1))
+    for method in ['proportional', 'shin']:
+        seconds = per_million(lambda: remove_vig(markets, method), markets.shape[0])
+        print(f'remove_vig {method:<13} {seconds:.3f} s per 1M two-way markets')
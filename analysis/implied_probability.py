@@ -1,3 +1,9 @@
+import numpy as np
+import pandas as pd
+
+ODDS_TYPES = ("American", "Decimal", "Fractional")
+
+
 def implied_probability(odds, type: str="American") -> float:
     if type == "American":
 
@@ -13,4 +19,210 @@ def implied_probability(odds, type: str="American") -> float:
         num = int(str(odds).split("/", 1)[0])
         denom = int(str(odds).split("/", 1)[1])
 
-        return denom/(num+denom)
\ No newline at end of file
+        return denom/(num+denom)
+
+
+# Variable-width strings (numpy 2) parse much faster than fixed-width ones; older numpy falls back to those
+STRING_DTYPE = np.dtypes.StringDType() if hasattr(np.dtypes, 'StringDType') else str
+
+
+def _text(odds):
+    """
+    :param odds: Array-like of odds, numbers or strings
+    :return: 1D numpy string array of the stripped odds
+    """
+    return np.char.strip(np.asarray(np.asarray(odds, dtype=object).ravel(), dtype=STRING_DTYPE))
+
+
+def _to_float(text):
+    """
+    :param text: numpy string array
+    :return: Float numpy array, NaN where an entry is not a number
+    """
+    try:
+        return text.astype(float)
+    except ValueError:
+        return pd.to_numeric(pd.Series(text.astype(object)), errors='coerce').to_numpy(dtype=float)
+
+
+def _numbers(odds):
+    """
+    :param odds: Array-like of numbers or numeric strings, e.g. '+150'
+    :return: Float numpy array, NaN where a value is not a number
+    """
+    try:
+        return np.asarray(odds, dtype=float)
+    except (TypeError, ValueError):
+        return _to_float(np.char.lstrip(_text(odds), '+')).reshape(np.shape(odds))
+
+
+def _american(values):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(values < 0, -values / (-values + 100), 100 / (values + 100))
+
+
+def _fractional(odds):
+    text = _text(odds)
+    parts = np.char.partition(text, np.asarray('/', dtype=text.dtype))
+    numerator, separator, denominator = parts if isinstance(parts, tuple) else np.moveaxis(parts, -1, 0)
+    try:
+        numerator, denominator = numerator.astype(float), denominator.astype(float)
+    except ValueError:
+        # Some lines are not fractions; blank them out so they parse as NaN
+        fraction = separator == '/'
+        numerator = _to_float(np.where(fraction, numerator, 'nan').astype(text.dtype))
+        denominator = _to_float(np.where(fraction, denominator, 'nan').astype(text.dtype))
+
+    return (denominator / (numerator + denominator)).reshape(np.shape(odds))
+
+
+def detect_odds_type(odds):
+    """
+    Guess the format of each line of a mixed-format odds column: strings with a '/' are fractional, values below 0,
+    of at least 100 or written with a leading '+' are American, anything else is decimal
+
+    :param odds: Array-like of odds, numbers or strings
+    :return: numpy array of "American", "Decimal" or "Fractional"
+    """
+    text = _text(odds)
+    fractional = np.char.find(text, '/') >= 0
+    values = _to_float(np.where(fractional, 'nan', text).astype(text.dtype))
+    with np.errstate(invalid='ignore'):
+        american = (values < 0) | (values >= 100) | np.char.startswith(text, '+')
+
+    return np.where(fractional, "Fractional", np.where(american, "American", "Decimal")).reshape(np.shape(odds))
+
+
+def implied_probabilities(odds, type="American"):
+    """
+    Vectorized implied_probability for whole odds books
+
+    :param odds: numpy array, pandas Series or list of odds. Fractional odds are strings like '5/2'
+    :param type: "American", "Decimal", "Fractional", "Mixed" to detect the format of each line, or an array with
+        the format of each line
+    :return: numpy array of implied probabilities, or a Series with the same index if odds is a Series. Lines that
+        cannot be parsed are NaN
+    """
+    if isinstance(type, str) and type not in ODDS_TYPES + ("Mixed",):
+        raise ValueError(f'Invalid odds type: {type}')
+
+    if isinstance(type, str) and type == "American":
+        probs = _american(_numbers(odds))
+    elif isinstance(type, str) and type == "Decimal":
+        with np.errstate(divide='ignore'):
+            probs = 1 / _numbers(odds)
+    elif isinstance(type, str) and type == "Fractional":
+        probs = _fractional(odds)
+    else:
+        types = detect_odds_type(odds) if isinstance(type, str) else np.broadcast_to(np.asarray(type), np.shape(odds))
+        fractional = types == "Fractional"
+        text = _text(odds)
+        values = _to_float(np.char.lstrip(np.where(fractional.ravel(), 'nan', text).astype(text.dtype), '+')).reshape(np.shape(odds))
+        with np.errstate(divide='ignore'):
+            decimal = 1 / values
+        probs = np.select([types == "American", types == "Decimal", fractional],
+                          [_american(values), decimal, _fractional(odds)], np.nan)
+
+    if isinstance(odds, pd.Series):
+        return pd.Series(probs, index=odds.index, name=odds.name)
+    return probs
+
+
+def _shin(probs, iterations=20, tolerance=1e-12):
+    """
+    Shin's insider-trading model: find z in [0, 1) per market so the fair probabilities
+    (sqrt(z^2 + 4 (1 - z) p^2 / S) - z) / (2 (1 - z)) sum to 1, by Newton's method over all markets at once
+
+    :param probs: 2D numpy array of implied probabilities, one market per row, NaN padded
+    :return: 2D numpy array of fair probabilities
+    """
+    booksum = np.nansum(probs, axis=1, keepdims=True)
+    a = probs ** 2 / booksum
+
+    def fair(z):
+        root = np.sqrt(z ** 2 + 4 * (1 - z) * a)
+        return root, (root - z) / (2 * (1 - z))
+
+    # The sum of fair probabilities falls as z grows, from sqrt(S) at z = 0; markets without an overround keep z = 0
+    z = np.zeros_like(booksum)
+    for _ in range(iterations):
+        root, p = fair(z)
+        slope = (((z - 2 * a) / root - 1) * 2 * (1 - z) + 2 * (root - z)) / (2 * (1 - z)) ** 2
+        step = (np.nansum(p, axis=1, keepdims=True) - 1) / np.nansum(slope, axis=1, keepdims=True)
+        step = np.where(booksum > 1, step, 0)
+        z = np.clip(z - step, 0, 0.999)
+        if np.nanmax(np.abs(step), initial=0) < tolerance:
+            break
+
+    p = fair(z)[1]
+    return p / np.nansum(p, axis=1, keepdims=True)
+
+
+def remove_vig(probs, method="proportional"):
+    """
+    Remove the bookmaker margin from whole books of two-way or multi-way markets at once
+
+    :param probs: 2D array of implied probabilities with one market per row. Markets with fewer outcomes are padded
+        with NaN. A 1D array is treated as a single market
+    :param method: "proportional" to scale each market to sum to 1, or "shin" for Shin's model, which takes more of
+        the margin out of longshots
+    :return: numpy array of fair probabilities with the shape of probs
+    """
+    probs = np.asarray(probs, dtype=float)
+    single = probs.ndim == 1
+    probs = np.atleast_2d(probs)
+
+    if method == "proportional":
+        fair = probs / np.nansum(probs, axis=1, keepdims=True)
+    elif method == "shin":
+        fair = _shin(probs)
+    else:
+        raise ValueError(f'Invalid vig removal method: {method}')
+
+    return fair[0] if single else fair
+
+
+def remove_vig_long(market_ids, probs, method="proportional"):
+    """
+    remove_vig for odds in long format, one row per outcome, e.g. one row per team and GAME_ID
+
+    :param market_ids: Array-like of market keys, equal for the outcomes of one market
+    :param probs: Array-like of implied probabilities
+    :param method: "proportional" or "shin"
+    :return: numpy array of fair probabilities in the order of the input rows
+    """
+    codes, _ = pd.factorize(np.asarray(market_ids))
+    position = pd.Series(codes).groupby(codes).cumcount().to_numpy()
+
+    matrix = np.full((codes.max() + 1 if len(codes) else 0, position.max() + 1 if len(codes) else 0), np.nan)
+    matrix[codes, position] = np.asarray(probs, dtype=float)
+
+    return remove_vig(matrix, method)[codes, position]
+
+
+def attach_no_vig(games, odds, type="American", method="proportional"):
+    """
+    Add no-vig win probabilities to ALL_GAMES_MERGED rows for calibration backtests
+
+    Usage:
+        games = pd.read_sql_query('SELECT * FROM ALL_GAMES_MERGED', connect())
+        backtest = attach_no_vig(games, odds)
+
+    :param games: DataFrame of ALL_GAMES_MERGED rows with GAME_ID, TEAM_ID_A, TEAM_ID_B and WL_A
+    :param odds: DataFrame of moneyline odds in long format with GAME_ID, TEAM_ID and ODDS, one row per team
+    :param type: Format of odds['ODDS'], see implied_probabilities
+    :param method: "proportional" or "shin"
+    :return: games with PROB_A and PROB_B (no-vig probabilities of team A and B winning, NaN without odds) and WIN_A
+    """
+    odds = odds.assign(GAME_ID=odds['GAME_ID'].astype(str))
+    implied = np.asarray(implied_probabilities(odds['ODDS'], type), dtype=float)
+    odds = odds.assign(PROB=remove_vig_long(odds['GAME_ID'], implied, method))[['GAME_ID', 'TEAM_ID', 'PROB']]
+
+    result = games.assign(GAME_ID=games['GAME_ID'].astype(str))
+    for side in ['A', 'B']:
+        result = result.merge(odds.rename(columns={'TEAM_ID': f'TEAM_ID_{side}', 'PROB': f'PROB_{side}'}),
+                              on=['GAME_ID', f'TEAM_ID_{side}'], how='left')
+    result['WIN_A'] = (result['WL_A'] == 'W').astype(int)
+    result.index = games.index
+
+    return result
@@ -0,0 +1,65 @@
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from frame_accumulator import FrameAccumulator
+
+# Roughly the shape of one PlayerCareerStats SeasonTotalsRegularSeason frame
+ROWS_PER_PLAYER = 10
+COLUMNS = 27
+PLAYER_COUNTS = [250, 500, 1000, 2000, 4000]
+
+
+def synthetic_frames(n_players):
+    """
+    Build one small frame per player, like the per-player results of download_allplayerseasons
+
+    :param n_players: Number of players
+    :return: List of DataFrames
+    """
+    rng = np.random.default_rng(0)
+    columns = [f'COL_{i}' for i in range(COLUMNS)]
+    frames = []
+    for player_id in range(n_players):
+        df = pd.DataFrame(rng.random((ROWS_PER_PLAYER, COLUMNS)), columns=columns)
+        df['PLAYER_ID'] = player_id
+        frames.append(df)
+
+    return frames
+
+
+def concat_in_loop(frames):
+    out = pd.DataFrame()
+    for df in frames:
+        out = pd.concat([out, df])
+    return out
+
+
+def accumulate(frames):
+    acc = FrameAccumulator()
+    for df in frames:
+        acc.add(df)
+    return acc.frame()
+
+
+def measure(func, frames):
+    """
+    :return: Tuple of (seconds, peak traced memory in MB)
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(frames)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return seconds, peak / 2 ** 20
+
+
+if __name__ == '__main__':
+    print(f'{"players":>8} {"concat s":>10} {"concat MB":>10} {"acc s":>8} {"acc MB":>8} {"speedup":>8}')
+    for n in PLAYER_COUNTS:
+        frames = synthetic_frames(n)
+        loop_s, loop_mb = measure(concat_in_loop, frames)
+        acc_s, acc_mb = measure(accumulate, frames)
+        print(f'{n:>8} {loop_s:>10.2f} {loop_mb:>10.1f} {acc_s:>8.2f} {acc_mb:>8.1f} {loop_s / acc_s:>7.1f}x')
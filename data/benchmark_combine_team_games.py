@@ -0,0 +1,99 @@
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from download_games import combine_team_games
+
+ROW_COUNTS = [10_000, 100_000, 1_000_000]
+KEEP_METHODS = ['home', 'away', 'winner', 'loser', None]
+
+
+def combine_team_games_merge(df, keep_method='home'):
+    """
+    The original self-merge implementation of combine_team_games, kept as the reference for output and speed
+    """
+    joined = pd.merge(df, df, suffixes=['_A', '_B'], on=['SEASON_ID', 'GAME_ID', 'GAME_DATE'])
+    result = joined[joined.TEAM_ID_A != joined.TEAM_ID_B]
+    if keep_method is None:
+        pass
+    elif keep_method.lower() == 'home':
+        result = result[result.MATCHUP_A.str.contains(' vs. ')]
+    elif keep_method.lower() == 'away':
+        result = result[result.MATCHUP_A.str.contains(' @ ')]
+    elif keep_method.lower() == 'winner':
+        result = result[result.WL_A == 'W']
+    elif keep_method.lower() == 'loser':
+        result = result[result.WL_A == 'L']
+    else:
+        raise ValueError(f'Invalid keep_method: {keep_method}')
+    return result
+
+
+def synthetic_games(n_rows, seed=0):
+    """
+    Build a team-game history shaped like LeagueGameFinder output: two rows per game, one home and one away,
+    sorted by date like download_games returns it
+
+    :param n_rows: Approximate number of team-game rows
+    :param seed: Random seed
+    :return: DataFrame of team games
+    """
+    rng = np.random.default_rng(seed)
+    n_games = n_rows // 2
+    abbreviations = np.array(['ATL', 'BOS', 'BKN', 'CHA', 'CHI', 'CLE', 'DAL', 'DEN', 'DET', 'GSW', 'HOU', 'IND',
+                              'LAC', 'LAL', 'MEM', 'MIA', 'MIL', 'MIN', 'NOP', 'NYK', 'OKC', 'ORL', 'PHI', 'PHX',
+                              'POR', 'SAC', 'SAS', 'TOR', 'UTA', 'WAS'])
+
+    home = rng.integers(0, 30, n_games)
+    away = (home + rng.integers(1, 30, n_games)) % 30
+    home_pts = rng.integers(80, 140, n_games)
+    away_pts = rng.integers(80, 140, n_games)
+    away_pts = np.where(away_pts == home_pts, away_pts + 1, away_pts)
+    dates = pd.Timestamp('1983-10-28') + pd.to_timedelta(np.sort(rng.integers(0, 40 * 365, n_games)), unit='D')
+    season = 20000 + dates.year - (dates.month < 9)
+
+    def side(team, opp, pts, opp_pts, sep):
+        return pd.DataFrame({
+            'SEASON_ID': season.astype(str),
+            'TEAM_ID': 1610612737 + team,
+            'TEAM_ABBREVIATION': abbreviations[team],
+            'GAME_ID': np.char.zfill(np.arange(n_games).astype(str), 10),
+            'GAME_DATE': dates.strftime('%Y-%m-%d'),
+            'MATCHUP': np.char.add(np.char.add(abbreviations[team], sep), abbreviations[opp]),
+            'WL': np.where(pts > opp_pts, 'W', 'L'),
+            'PTS': pts,
+            'PLUS_MINUS': (pts - opp_pts).astype(float),
+        })
+
+    games = pd.concat([side(home, away, home_pts, away_pts, ' vs. '), side(away, home, away_pts, home_pts, ' @ ')])
+    return games.sort_values(by='GAME_DATE', ascending=False)
+
+
+def measure(func, *args):
+    """
+    :return: Tuple of (result, seconds, peak traced memory in MB)
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, seconds, peak / 2 ** 20
+
+
+if __name__ == '__main__':
+    # Check identical output on a small history with irregular games: single rows and games with three rows
+    games = synthetic_games(2_000, seed=1)
+    games = pd.concat([games.iloc[3:], games.iloc[:1], games.iloc[10:12]]).sample(frac=1, random_state=1)
+    for keep_method in KEEP_METHODS:
+        pd.testing.assert_frame_equal(combine_team_games(games, keep_method), combine_team_games_merge(games, keep_method))
+    print('Output identical for every keep_method\n')
+
+    print(f'{"rows":>9} {"merge s":>8} {"merge MB":>9} {"new s":>7} {"new MB":>7} {"speedup":>8}')
+    for n in ROW_COUNTS:
+        games = synthetic_games(n)
+        _, merge_s, merge_mb = measure(combine_team_games_merge, games)
+        _, new_s, new_mb = measure(combine_team_games, games)
+        print(f'{n:>9} {merge_s:>8.2f} {merge_mb:>9.1f} {new_s:>7.2f} {new_mb:>7.1f} {merge_s / new_s:>7.1f}x')
@@ -0,0 +1,110 @@
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from benchmark_combine_team_games import synthetic_games
+from parquet_store import read_table, sync_table
+
+N_ROWS = 500_000
+TABLE = 'ALL_GAMES_UNMERGED'
+STAT_COLUMNS = ['MIN', 'FGM', 'FGA', 'FG_PCT', 'FG3M', 'FG3A', 'FG3_PCT', 'FTM', 'FTA', 'FT_PCT', 'OREB', 'DREB',
+                'REB', 'AST', 'STL', 'BLK', 'TOV', 'PF']
+
+
+def build_store(path, n_rows):
+    """
+    Write a synthetic ALL_GAMES_UNMERGED with LeagueGameFinder's columns to an SQLite database and its Parquet mirror
+
+    :param path: Directory for the database and the Parquet files
+    :param n_rows: Number of team-game rows
+    :return: Tuple of (database file, Parquet directory, a full season)
+    """
+    rng = np.random.default_rng(0)
+    games = synthetic_games(n_rows)
+    games['TEAM_NAME'] = games['TEAM_ABBREVIATION'] + ' Team Name'
+    for col in STAT_COLUMNS:
+        games[col] = rng.random(len(games)) if col.endswith('_PCT') else rng.integers(0, 60, len(games))
+
+    db = os.path.join(path, 'bench.db')
+    parquet = os.path.join(path, 'parquet')
+    conn = sqlite3.connect(db)
+    games.to_sql(TABLE, conn, index=False)
+    conn.execute(f'CREATE INDEX IX_SEASON_ID ON {TABLE} (SEASON_ID)')
+    conn.commit()
+    sync_table(conn, TABLE, parquet)
+    conn.close()
+
+    return db, parquet, games['SEASON_ID'].value_counts().index[0]
+
+
+def sqlite_all(db, parquet, season):
+    return pd.read_sql_query(f'SELECT * FROM {TABLE}', sqlite3.connect(db))
+
+
+def parquet_all(db, parquet, season):
+    return read_table(TABLE, path=parquet)
+
+
+def sqlite_season(db, parquet, season):
+    return pd.read_sql_query(f'SELECT GAME_DATE, PTS FROM {TABLE} WHERE SEASON_ID = ?', sqlite3.connect(db), params=(season,))
+
+
+def parquet_season(db, parquet, season):
+    return read_table(TABLE, columns=['GAME_DATE', 'PTS'], seasons=[season], path=parquet)
+
+
+def memory_kb(field):
+    """
+    :param field: 'VmRSS' for the current resident set size, 'VmHWM' for its peak
+    :return: Value from /proc/self/status in KiB
+    """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1])
+
+
+def _measure(load, args, results):
+    # Reset the peak RSS, which imports have already raised, so it measures the load alone (Linux only)
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    baseline = memory_kb('VmRSS')
+    start = time.perf_counter()
+    df = load(*args)
+    seconds = time.perf_counter() - start
+    results.put((len(df), seconds, (memory_kb('VmHWM') - baseline) / 1024))
+
+
+def measure(load, *args):
+    """
+    Run a load in a fresh process, so the peak RSS it reports belongs to that load alone
+
+    :return: Tuple of (rows loaded, seconds, peak RSS growth in MB)
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_measure, args=(load, args, results))
+    process.start()
+    result = results.get()
+    process.join()
+
+    return result
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        db, parquet, season = build_store(path, N_ROWS)
+        size = sum(os.path.getsize(os.path.join(parquet, TABLE, f)) for f in os.listdir(os.path.join(parquet, TABLE)))
+        print(f'{N_ROWS} rows: SQLite {os.path.getsize(db) / 2 ** 20:.1f} MB, Parquet {size / 2 ** 20:.1f} MB, '
+              f'built in {time.perf_counter() - start:.1f} s\n')
+
+        print(f'{"load":<36} {"rows":>8} {"seconds":>8} {"RSS MB":>8}')
+        for label, load in [('whole table, SQLite', sqlite_all), ('whole table, Parquet', parquet_all),
+                            (f'GAME_DATE, PTS of {season}, SQLite', sqlite_season),
+                            (f'GAME_DATE, PTS of {season}, Parquet', parquet_season)]:
+            rows, seconds, rss = measure(load, db, parquet, season)
+            print(f'{label:<36} {rows:>8} {seconds:>8.3f} {rss:>8.1f}')
@@ -0,0 +1,247 @@
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import sqlite3
+import subprocess
+import tempfile
+import time
+from collections import namedtuple
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import fake_nba_api
+import metrics
+import response_cache
+from benchmark_parquet_store import memory_kb
+from config import DATA_DIR
+from download_games import combine_team_games, download_games, save_sql
+from download_league_player_stats import download_player_pt_shots
+from download_players_active import download_allplayerseasons
+from download_shots import update_shots
+from fetch_engine import FetchEngine
+
+# Results of every run, appended so later runs can be compared against earlier ones
+RESULTS_FILE = os.environ.get('NBA_BENCHMARK_RESULTS', os.path.join(DATA_DIR, 'benchmark_results.csv'))
+RESULT_COLUMNS = ['RUN_ID', 'COMMIT', 'STAGE', 'SCALE', 'LATENCY', 'FAILURE_RATE', 'ROWS', 'SECONDS', 'PEAK_MB']
+# Runs are only compared with runs of the same stage, scale and simulated network
+COMPARE_KEY = ['STAGE', 'SCALE', 'LATENCY', 'FAILURE_RATE']
+
+# A stage is flagged when it is this much slower or bigger than in the baseline run
+REGRESSION_RATIO = 1.2
+
+# League sizes for the fake endpoints. n_active players are downloaded by the per-player stages
+SCALES = {
+    'small': dict(n_players=1000, n_active=100, n_seasons=2),
+    'medium': dict(n_players=2500, n_active=500, n_seasons=10),
+    'large': dict(n_players=5000, n_active=2000, n_seasons=40),
+}
+
+NEW_DATE = '06/30/2023'
+SEASON = fake_nba_api.season_name(fake_nba_api.LAST_SEASON)
+
+# setup() builds the stage's inputs outside the measurement, run(conn, *inputs) returns the number of rows produced
+Stage = namedtuple('Stage', ['name', 'setup', 'run'])
+
+
+def no_inputs():
+    return ()
+
+
+def league_games():
+    return (fake_nba_api.league_games(fake_nba_api.N_SEASONS).copy(),)
+
+
+def merged_games():
+    games = fake_nba_api.league_games(fake_nba_api.N_SEASONS).copy()
+    return games, combine_team_games(games)
+
+
+def active_players():
+    ids = np.array([player['id'] for player in fake_nba_api.get_active_players()])
+    teams = np.array([fake_nba_api.player_team(id, SEASON) for id in ids])
+    return ids, teams
+
+
+def run_download_games(conn):
+    return download_games(conn, NEW_DATE)
+
+
+def run_combine_team_games(conn, games):
+    return len(combine_team_games(games))
+
+
+def run_download_player_pt_shots(conn, player_ids, team_ids):
+    engine = FetchEngine(max_workers=8, rate=0, backoff=0.01)
+    return download_player_pt_shots(player_ids, team_ids, SEASON, conn, current=False, engine=engine)
+
+
+def run_download_allplayerseasons(conn, player_ids, team_ids):
+    return len(download_allplayerseasons(list(player_ids), conn))
+
+
+def run_download_shots(conn):
+    return update_shots(conn, SEASON)
+
+
+def run_save_sql(conn, games, merged):
+    save_sql(games, merged, conn, NEW_DATE)
+    return len(games) + len(merged)
+
+
+STAGES = [
+    Stage('download_games', no_inputs, run_download_games),
+    Stage('combine_team_games', league_games, run_combine_team_games),
+    Stage('download_player_pt_shots', active_players, run_download_player_pt_shots),
+    Stage('download_allplayerseasons', active_players, run_download_allplayerseasons),
+    Stage('download_shots', no_inputs, run_download_shots),
+    Stage('save_sql', merged_games, run_save_sql),
+]
+
+
+def _measure(name, scale, latency, failure_rate, path, results):
+    fake_nba_api.install()
+    response_cache.enabled = False
+    metrics.enabled = False
+    fake_nba_api.configure(latency=latency, failure_rate=failure_rate, seed=0, **SCALES[scale])
+
+    stage = next(stage for stage in STAGES if stage.name == name)
+    inputs = stage.setup()
+    conn = sqlite3.connect(os.path.join(path, f'{name}.db'))
+
+    # Reset the peak RSS, which imports and setup have already raised, so it measures the stage alone (Linux only)
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    baseline = memory_kb('VmRSS')
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = stage.run(conn, *inputs)
+    seconds = time.perf_counter() - start
+    conn.close()
+
+    results.put((rows, seconds, (memory_kb('VmHWM') - baseline) / 1024))
+
+
+def measure(stage, scale, latency=(0.0, 0.0), failure_rate=0.0):
+    """
+    Run one stage at one scale in a fresh process against the fake nba_api and a fresh database file, so neither
+    warm caches nor memory held by earlier stages affect it. Its printed progress is suppressed
+
+    :param stage: Stage
+    :param scale: Key of SCALES
+    :param latency: (min, max) seconds of simulated latency per request
+    :param failure_rate: Probability in [0, 1] that a simulated request fails
+    :return: Tuple of (rows, seconds, peak RSS growth in MB)
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    with tempfile.TemporaryDirectory() as path:
+        process = context.Process(target=_measure, args=(stage.name, scale, latency, failure_rate, path, results))
+        process.start()
+        result = results.get()
+        process.join()
+
+    return result
+
+
+def current_commit():
+    """
+    :return: Short hash of the checked-out commit, or '' outside a git checkout
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=DATA_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run_benchmarks(stages, scales, latency=(0.0, 0.0), failure_rate=0.0):
+    """
+    Time and memory-profile pipeline stages at several league sizes, against the fake nba_api with the response
+    cache disabled, so no request reaches stats.nba.com
+
+    :param stages: List of Stage
+    :param scales: List of keys of SCALES
+    :param latency: (min, max) seconds of simulated latency per request
+    :param failure_rate: Probability in [0, 1] that a simulated request fails
+    :return: DataFrame of RESULT_COLUMNS, one row per stage and scale
+    """
+    run_id = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    commit = current_commit()
+
+    results = []
+    for scale in scales:
+        for stage in stages:
+            rows, seconds, peak = measure(stage, scale, latency, failure_rate)
+            results.append((run_id, commit, stage.name, scale, f'{latency[0]}-{latency[1]}', failure_rate, rows,
+                            seconds, peak))
+            print(f'{stage.name:<28} {scale:<8} {rows:>9} rows {seconds:>8.2f} s {peak:>8.1f} MB')
+
+    return pd.DataFrame(results, columns=RESULT_COLUMNS)
+
+
+def save_results(results, file=RESULTS_FILE):
+    """
+    Append a run's results to the results file
+    """
+    results.to_csv(file, mode='a', header=not os.path.exists(file), index=False)
+
+
+def load_results(file=RESULTS_FILE):
+    """
+    :return: DataFrame of every stored result, empty if none have been stored
+    """
+    if not os.path.exists(file):
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    return pd.read_csv(file, dtype={'COMMIT': str, 'LATENCY': str})
+
+
+def compare(results, history, baseline=None, ratio=REGRESSION_RATIO):
+    """
+    Compare a run against a baseline run: by default the latest earlier run that measured the same stage and scale
+    with the same simulated latency and failure rate
+
+    :param results: DataFrame of the run's results
+    :param history: DataFrame of stored results from earlier runs
+    :param baseline: RUN_ID or COMMIT of the baseline run. Default the latest earlier run
+    :param ratio: Time or memory ratio above which a stage is flagged as a regression
+    :return: DataFrame of the run's results with the baseline's SECONDS and PEAK_MB, their ratios and a REGRESSION flag
+    """
+    history = history[history['RUN_ID'] < results['RUN_ID'].min()]
+    if baseline is not None:
+        history = history[(history['RUN_ID'] == baseline) | (history['COMMIT'] == baseline)]
+    history = history.sort_values('RUN_ID').drop_duplicates(COMPARE_KEY, keep='last')
+
+    merged = results.merge(history[COMPARE_KEY + ['SECONDS', 'PEAK_MB']], on=COMPARE_KEY, how='left',
+                           suffixes=('', '_BASE'))
+    merged['TIME_RATIO'] = merged['SECONDS'] / merged['SECONDS_BASE']
+    merged['MEMORY_RATIO'] = merged['PEAK_MB'] / merged['PEAK_MB_BASE']
+    merged['REGRESSION'] = (merged['TIME_RATIO'] > ratio) | (merged['MEMORY_RATIO'] > ratio)
+
+    return merged
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages offline against the fake nba_api')
+    parser.add_argument('--stages', nargs='+', choices=[stage.name for stage in STAGES],
+                        default=[stage.name for stage in STAGES])
+    parser.add_argument('--scales', nargs='+', choices=list(SCALES), default=list(SCALES))
+    parser.add_argument('--latency', nargs=2, type=float, default=(0.0, 0.0), metavar=('MIN', 'MAX'))
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--baseline', help='RUN_ID or commit to compare against. Default the previous run')
+    parser.add_argument('--no-save', action='store_true', help='Do not append the results to the results file')
+    args = parser.parse_args()
+
+    stages = [stage for stage in STAGES if stage.name in args.stages]
+    results = run_benchmarks(stages, args.scales, tuple(args.latency), args.failure_rate)
+
+    comparison = compare(results, load_results(), args.baseline)
+    print(f'\n{"stage":<28} {"scale":<8} {"s":>8} {"base s":>8} {"MB":>8} {"base MB":>8}')
+    for row in comparison.itertuples():
+        flag = '  REGRESSION' if row.REGRESSION else ''
+        print(f'{row.STAGE:<28} {row.SCALE:<8} {row.SECONDS:>8.2f} {row.SECONDS_BASE:>8.2f} {row.PEAK_MB:>8.1f} '
+              f'{row.PEAK_MB_BASE:>8.1f}{flag}')
+
+    if not args.no_save:
+        save_results(results)
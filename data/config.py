@@ -0,0 +1,31 @@
+import os
+
+# Settings shared by the download scripts. Each can be overridden with the NBA_-prefixed environment variable shown
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# SQLite database written by the download scripts
+DB_PATH = os.environ.get('NBA_DB_PATH', os.path.join(DATA_DIR, 'nba-data.db'))
+
+# Season currently in progress, in the format 'YYYY-YY'
+CURRENT_SEASON = os.environ.get('NBA_CURRENT_SEASON', '2022-23')
+
+# On-disk cache of nba_api responses
+CACHE_DIR = os.environ.get('NBA_CACHE_DIR', os.path.join(DATA_DIR, 'cache'))
+CACHE_MAX_BYTES = int(os.environ.get('NBA_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+CACHE_ENABLED = os.environ.get('NBA_CACHE_ENABLED', '1') != '0'
+# Local time 'HH:MM' at which daily entries expire, before the scheduled 06:00 run in schedule_update.py
+CACHE_DAILY_CUTOFF = os.environ.get('NBA_CACHE_DAILY_CUTOFF', '05:00')
+
+# Season-partitioned Parquet mirror of the database for analysis. Needs pyarrow; skipped when it is not installed
+PARQUET_DIR = os.environ.get('NBA_PARQUET_DIR', os.path.join(DATA_DIR, 'parquet'))
+PARQUET_ENABLED = os.environ.get('NBA_PARQUET_ENABLED', '1') != '0'
+
+# Request and write instrumentation, stored in the METRICS table. Set a directory to also write Prometheus textfiles
+METRICS_ENABLED = os.environ.get('NBA_METRICS_ENABLED', '1') != '0'
+METRICS_TEXTFILE_DIR = os.environ.get('NBA_METRICS_TEXTFILE_DIR', '')
+
+# Results of the query functions in queries.py, memoized in memory and on disk until the tables they read change
+QUERY_CACHE_DIR = os.environ.get('NBA_QUERY_CACHE_DIR', os.path.join(CACHE_DIR, 'queries'))
+QUERY_CACHE_ENTRIES = int(os.environ.get('NBA_QUERY_CACHE_ENTRIES', 128))
+QUERY_CACHE_MAX_BYTES = int(os.environ.get('NBA_QUERY_CACHE_MAX_BYTES', 512 * 1024 ** 2))
+QUERY_CACHE_ENABLED = os.environ.get('NBA_QUERY_CACHE_ENABLED', '1') != '0'
@@ -1,21 +1,214 @@
+import os
 import sqlite3
 from datetime import datetime
+from config import DB_PATH
 
-def connect():
+# Applied to every new connection. WAL lets notebooks and dashboards read while the daily job writes
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64 * 1024,  # negative values are KiB, so 64 MiB
+    'mmap_size': 256 * 1024 ** 2,
+    'temp_store': 'MEMORY',
+}
+
+# Indexes our queries need, created for every table that exists and has the columns
+INDEXES = {
+    'ALL_GAMES_UNMERGED': [['GAME_ID'], ['TEAM_ID', 'GAME_DATE'], ['GAME_DATE'], ['SEASON_ID']],
+    'ALL_GAMES_MERGED': [['GAME_ID'], ['TEAM_ID_A'], ['TEAM_ID_B'], ['GAME_DATE'], ['SEASON_ID']],
+    'LEAGUE_PLAYER_STATS_PAST': [['PLAYER_ID'], ['SEASON']],
+    'LEAGUE_PLAYER_STATS_CURRENT': [['PLAYER_ID'], ['SEASON']],
+    'PLAYERS_ACTIVE': [['PLAYER_ID'], ['SEASON_ID']],
+    'PLAYERS_INACTIVE': [['PLAYER_ID'], ['SEASON_ID']],
+    'SHOTS': [['PLAYER_ID', 'SEASON'], ['TEAM_ID', 'SEASON'], ['SEASON', 'GAME_DATE']],
+    'TEAM_GAME_RATINGS': [['TEAM_ID', 'SEASON_ID', 'GAME_DATE'], ['GAME_DATE']],
+    **{f'SHOT_{name}_{period}': [['PLAYER_ID', 'SEASON']]
+       for name in ['OVERALL', 'TYPE', 'CLOCK', 'DRIBBLE', 'CLOSEDEF', 'CLOSEDEF_10PLUS', 'TOUCHTIME']
+       for period in ['PAST', 'CURRENT']},
+}
+
+# Tables mirrored to Parquet and the season column each is partitioned on. None writes a single partition
+PARTITIONS = {
+    'ALL_GAMES_UNMERGED': 'SEASON_ID',
+    'ALL_GAMES_MERGED': 'SEASON_ID',
+    'LEAGUE_PLAYER_STATS_PAST': 'SEASON',
+    'LEAGUE_PLAYER_STATS_CURRENT': 'SEASON',
+    **{f'SHOT_{name}_{period}': 'SEASON'
+       for name in ['OVERALL', 'TYPE', 'CLOCK', 'DRIBBLE', 'CLOSEDEF', 'CLOSEDEF_10PLUS', 'TOUCHTIME']
+       for period in ['PAST', 'CURRENT']},
+    'PLAYERS_ACTIVE': 'SEASON_ID',
+    'PLAYERS_INACTIVE': 'SEASON_ID',
+    'SHOTS': 'SEASON',
+    'TEAM_GAME_RATINGS': 'SEASON_ID',
+    'TEAM_SPLITS': 'SEASON_ID',
+    'TEAM_RATINGS': None,
+    'ALLTIMELEADERS': None,
+    'TEAM_LIST': None,
+    'PLAYER_LIST_ACTIVE': None,
+    'PLAYER_LIST_INACTIVE': None,
+}
+
+# Partition key of unpartitioned tables, and of writes that may have touched every partition
+ALL = '_all'
+
+# Write counter per table, bumped once per write call by sql_writer.bump_version so caches of query results can tell
+# when a table changed
+VERSIONS_TABLE = 'TABLE_VERSIONS'
+
+# Version of the last write to each season of a partitioned table, as the JSON key the Parquet manifest uses, so an
+# export only has to fingerprint the seasons written since it last ran
+PARTITION_VERSIONS_TABLE = 'PARTITION_VERSIONS'
+
+# Versioned schema migrations as (version, description, statements). The version reached is stored in
+# PRAGMA user_version, so each migration runs once per database. Append new migrations to the end
+MIGRATIONS = [
+    (1, 'work queue and backfill checkpoint tables', [
+        'CREATE TABLE IF NOT EXISTS WORK_QUEUE (QUEUE TEXT, ITEM_ID INTEGER, PRIMARY KEY (QUEUE, ITEM_ID))',
+        'CREATE TABLE IF NOT EXISTS BACKFILL_CHECKPOINT (QUEUE TEXT, ITEM_ID INTEGER, PRIMARY KEY (QUEUE, ITEM_ID))',
+    ]),
+    (2, 'job runner history', [
+        'CREATE TABLE IF NOT EXISTS RUN_HISTORY (RUN_ID TEXT, JOB TEXT, ATTEMPT INTEGER, STATUS TEXT, '
+        'STARTED TEXT, FINISHED TEXT, SECONDS REAL, ROWS INTEGER, ERROR TEXT)',
+        'CREATE INDEX IF NOT EXISTS IX_RUN_HISTORY_RUN_ID ON RUN_HISTORY (RUN_ID)',
+        'CREATE INDEX IF NOT EXISTS IX_RUN_HISTORY_JOB_STARTED ON RUN_HISTORY (JOB, STARTED)',
+    ]),
+    (3, 'request and write metrics', [
+        'CREATE TABLE IF NOT EXISTS METRICS (RUN_ID TEXT, JOB TEXT, KIND TEXT, NAME TEXT, STARTED TEXT, '
+        'SECONDS REAL, ATTEMPT INTEGER, OUTCOME TEXT, ERROR TEXT, BYTES INTEGER, ROWS INTEGER)',
+        'CREATE INDEX IF NOT EXISTS IX_METRICS_RUN_ID ON METRICS (RUN_ID, JOB)',
+        'CREATE INDEX IF NOT EXISTS IX_METRICS_STARTED ON METRICS (STARTED)',
+    ]),
+    (4, 'table write versions', [
+        f'CREATE TABLE IF NOT EXISTS {VERSIONS_TABLE} (NAME TEXT PRIMARY KEY, VERSION INTEGER NOT NULL DEFAULT 0)',
+    ]),
+    (5, 'drop the per-row table version triggers, replaced by one bump per write call', [
+        f'DROP TRIGGER IF EXISTS "TV_{table}_{event}"' for table in INDEXES for event in ['INSERT', 'UPDATE', 'DELETE']
+    ]),
+    (6, 'per-season write versions', [
+        f'CREATE TABLE IF NOT EXISTS {PARTITION_VERSIONS_TABLE} (NAME TEXT, SEASON TEXT, VERSION INTEGER NOT NULL, '
+        'PRIMARY KEY (NAME, SEASON))',
+    ]),
+]
+
+# One connection per (process, database path), reused by every connect() call in that process
+_connections = {}
+
+
+def migrate(conn):
+    """
+    Apply the schema migrations the database has not seen yet, each in its own transaction
+
+    :param conn: Connection object representing the connection to the SQLite database
+    :return: Schema version after migrating
+    """
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, description, statements in MIGRATIONS:
+        if number <= version:
+            continue
+
+        for statement in statements:
+            conn.execute(statement)
+        conn.execute(f'PRAGMA user_version = {number}')
+        conn.commit()
+        version = number
+
+    return version
+
+
+def ensure_indexes(conn):
+    """
+    Create the indexes in INDEXES for tables that exist and have the indexed columns. Idempotent, and rerun on every
+    new connection because tables are created (and, when written with if_exists='replace', recreated) by the
+    download scripts after the database itself
+
+    :param conn: Connection object representing the connection to the SQLite database
+    """
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for table, indexes in INDEXES.items():
+        if table not in tables:
+            continue
+
+        columns = {row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')}
+        for index in indexes:
+            if set(index) <= columns:
+                names = ', '.join(f'"{col}"' for col in index)
+                conn.execute(f'CREATE INDEX IF NOT EXISTS "IX_{table}_{"_".join(index)}" ON "{table}" ({names})')
+
+    conn.commit()
+
+
+def table_versions(conn, tables):
+    """
+    :param conn: Connection object representing the connection to the SQLite database
+    :param tables: List of table names
+    :return: Dict of table name to its write version, None for tables never written since versions were tracked
+    """
+    placeholders = ', '.join('?' for _ in tables)
+    try:
+        rows = conn.execute(f'SELECT NAME, VERSION FROM {VERSIONS_TABLE} WHERE NAME IN ({placeholders})', list(tables))
+        versions = dict(rows.fetchall())
+    except sqlite3.OperationalError:
+        # Databases that have not been migrated yet have no versions table
+        versions = {}
+    return {table: versions.get(table) for table in tables}
+
+
+def written_partitions(conn, table, since):
+    """
+    :param conn: Connection object representing the connection to the SQLite database
+    :param table: Table name
+    :param since: Table version to look after
+    :return: Set of the partition keys written after the version, ALL among them if a write may have touched every
+        partition. Empty for writes made before partitions were tracked
+    """
+    try:
+        rows = conn.execute(f'SELECT SEASON FROM {PARTITION_VERSIONS_TABLE} WHERE NAME = ? AND VERSION > ?',
+                            (table, since))
+        return {row[0] for row in rows}
+    except sqlite3.OperationalError:
+        return set()
+
+
+def connect(path=None):
     """
-    Establishes a connection to the 'nba-data.db' database.
+    Establishes a connection to the 'nba-data.db' database, or returns the one already open in this process.
+    The location comes from config.DB_PATH (environment variable NBA_DB_PATH). New connections get the PRAGMAS
+    above, pending schema migrations and the query indexes.
 
+    :param path: Database file to connect to instead of config.DB_PATH
     Returns:
     conn (sqlite3.Connection): a Connection object representing the database connection
     """
+    path = path or DB_PATH
+    key = (os.getpid(), path)
+    if key in _connections:
+        return _connections[key]
+
     try:
-        conn = sqlite3.connect("/Users/andrewguo/Library/Mobile Documents/com~apple~CloudDocs/basketball-datascience/data/nba-data.db")
+        conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        for pragma, value in PRAGMAS.items():
+            conn.execute(f'PRAGMA {pragma} = {value}')
+        migrate(conn)
+        ensure_indexes(conn)
     except sqlite3.Error as e:
         print(f"Error connecting to database: {e}")
         raise e
 
+    _connections[key] = conn
     return conn
 
+
+def close(path=None):
+    """
+    Close this process's pooled connection to the database, if one is open
+
+    :param path: Database file of the connection. Default config.DB_PATH
+    """
+    conn = _connections.pop((os.getpid(), path or DB_PATH), None)
+    if conn is not None:
+        conn.close()
+
+
 def get_current_time():
     """
     Returns the current date and time in the format 'MM/DD/YYYY, HH:MM:SS'.
@@ -1,6 +1,11 @@
 import pandas as pd
 from nba_api.stats.endpoints import alltimeleadersgrids
 from connect_sqlite import connect, get_current_time
+from frame_accumulator import FrameAccumulator
+from parquet_store import sync_tables
+from sql_writer import format_counts, rows_written, upsert
+from response_cache import DAILY, cached_call, cache_summary
+from schema import apply_schema
 
 def download_alltimeleaders():
     """
@@ -9,42 +14,45 @@ def download_alltimeleaders():
     :return: DataFrame of top-10 all time leaders in 19 categories
     """
 
-    leaders = alltimeleadersgrids.AllTimeLeadersGrids().get_data_frames()
+    leaders = cached_call(alltimeleadersgrids.AllTimeLeadersGrids, ttl=DAILY)
 
     desc = ['GP', 'PTS', 'AST', 'STL', 'OREB', 'DREB', 'REB', 'BLK', 'FGM', 'FGA', 'FGPCT', 'TOV', 'FG3M', 'FG3A', 'FG3PCT', 'PF', 'FTM', 'FTA', 'FTPCT']
 
-    out = pd.DataFrame()
+    out = FrameAccumulator()
     for df, des in zip(leaders, desc):
         df.columns = ['PLAYER_ID', 'PLAYER_NAME', 'VALUE', 'RANK', 'IS_ACTIVE']
         df['TYPE'] = des
+        out.add(df)
 
-        if len(out) == 0:
-            out = df
-        else:
-            out = pd.concat([out, df])
+    out = out.frame()
 
-    out['IS_ACTIVE'] = out['IS_ACTIVE'].apply(lambda x: False if x=='N' else True)
-
-    COLUMN_TYPES = {
-        'PLAYER_ID': int,
-        'PLAYER_NAME': str,
-        'VALUE': int,
-        'RANK': int,
-        'IS_ACTIVE': bool,
-        'TYPE': str
-    }
-    out = out.astype(COLUMN_TYPES)
+    out['IS_ACTIVE'] = out['IS_ACTIVE'] != 'N'
+    out['PLAYER_NAME'] = out['PLAYER_NAME'].astype(str)
+    out = apply_schema(out, 'ALLTIMELEADERS', lossless=True)
 
     return out
 
 
 
-if __name__ == '__main__':
+def main():
+    """
+    Download all-time NBA leaders and upsert them into ALLTIMELEADERS
+
+    :return: Number of rows written
+    """
     # Download all-time NBA leaders data
     leaders = download_alltimeleaders()
 
     # Save data to SQLite database
     TABLE_NAME = 'ALLTIMELEADERS'
     with connect() as conn:
-        leaders.to_sql(TABLE_NAME, conn, if_exists='replace')
-        print(F'{get_current_time()}: Updated All Time Leaders')
\ No newline at end of file
+        counts = upsert(leaders, TABLE_NAME, conn, ['TYPE', 'PLAYER_ID'], delete_missing=True)
+        print(F'{get_current_time()}: Updated All Time Leaders ({format_counts(TABLE_NAME, counts)})')
+        print(cache_summary())
+        sync_tables(conn, [TABLE_NAME])
+
+    return rows_written(counts)
+
+
+if __name__ == '__main__':
+    main()
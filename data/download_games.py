@@ -1,49 +1,108 @@
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 from nba_api.stats.static import teams
 from nba_api.stats.endpoints import leaguegamefinder
 from connect_sqlite import connect, get_current_time
+from parquet_store import sync_tables
+from response_cache import DAILY, cached_call, cache_summary
+from schema import apply_schema
+from sql_writer import ensure_table, insert_frame, read_frame_by_keys, read_rows, table_exists
+from team_ratings import RATINGS_TABLE, SPLITS_TABLE, STATE_TABLE, update_ratings
+from work_queue import WorkQueue
 
+QUEUE_NAME = 'games'
+UNMERGED_TABLE = 'ALL_GAMES_UNMERGED'
+MERGED_TABLE = 'ALL_GAMES_MERGED'
+BATCH_ROWS = 5000
 
-def download_games():
-    """
-    Downloads all NBA games for all NBA teams
+# Columns identifying a game, shared by the rows of both teams
+GAME_KEYS = ['SEASON_ID', 'GAME_ID', 'GAME_DATE']
 
-    :return: DataFrame of games
+
+def download_games(CONNECTION, new_date, batch_rows=BATCH_ROWS):
     """
+    Downloads all NBA games for all NBA teams, streaming each team's history into the database as it arrives.
+    Every team chunk is paired and written by ingest_games and committed together with its WorkQueue completion mark,
+    so peak memory is one team's history regardless of how long it is, and an interrupted full download resumes with
+    the teams that are still missing. The Last_Updated bookmark is set in the same commit as the final chunk, since
+    it only holds once every team is stored. A team that keeps failing is left pending and the bookmark is not set,
+    so the next run downloads the missing teams.
 
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param new_date: Date of the last NBA game, stored as the new Last_Updated bookmark
+    :param batch_rows: Number of rows per insert batch
+    :return: Number of merged games added
+    """
     nba_teams = teams.get_teams()
     nba_teams = pd.DataFrame(nba_teams)
-    ids = list(nba_teams['id'])
-    games = pd.DataFrame()
+    queue = WorkQueue(CONNECTION, QUEUE_NAME, nba_teams['id'])
 
-    while len(ids) > 0:
+    added = 0
+    for id in queue:
         try:
-            id = ids[-1]
+            print(f'trying team {id}')
+            result = cached_call(leaguegamefinder.LeagueGameFinder, ttl=DAILY, team_id_nullable=id)[0]
+
+            _, merged_added = ingest_games(result, CONNECTION, batch_rows)
+            queue.done(id, commit=False)
+            if len(queue) == 0 and not queue.failed:
+                set_last_update(CONNECTION, 'game', new_date)
+            CONNECTION.commit()
+            added += merged_added
+
+        except Exception as e:
+            CONNECTION.rollback()
+            if queue.retry(id):
+                print(f'retrying team {id}: {e}')
+            else:
+                print(f'{get_current_time()}: Giving up on team {id} until the next run: {e}')
 
-            if len(games) == 0:
-                print(f'initiating with team {id}')
-                result = leaguegamefinder.LeagueGameFinder(team_id_nullable=id)
-                games = result.get_data_frames()[0]
+    if queue.failed:
+        print(f'{get_current_time()}: {len(queue.failed)} teams missing, Last_Updated not moved')
+        return added
 
-            elif id not in list(games['TEAM_ID']):
-                print(f'trying team {id}')
-                result = leaguegamefinder.LeagueGameFinder(team_id_nullable=id)
-                games = pd.concat([games, result.get_data_frames()[0]])
+    queue.finish()
 
-            else:
-                print(f'already have team {id}')
+    return added
 
-            ids.pop()
-
-        except:
-            print(f'retrying player {id}')
 
+def ingest_games(chunk, CONNECTION, batch_rows=BATCH_ROWS):
+    """
+    Append a chunk of team games to ALL_GAMES_UNMERGED, skipping (GAME_ID, TEAM_ID) rows already stored, and append
+    the games whose two rows are now both stored to ALL_GAMES_MERGED, skipping GAME_IDs already merged. A game whose
+    opponent's rows arrive in a later chunk is merged when that chunk is ingested. Does not commit.
 
+    :param chunk: DataFrame of team games, e.g. one team's history
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param batch_rows: Number of rows per insert batch
+    :return: Tuple of (unmerged rows added, merged games added)
+    """
+    if len(chunk) == 0:
+        return 0, 0
+
+    key = ['GAME_ID', 'TEAM_ID']
+    chunk = apply_schema(chunk.drop_duplicates(subset=key), UNMERGED_TABLE, lossless=True)
+    if table_exists(CONNECTION, UNMERGED_TABLE):
+        keys = list(chunk[key].itertuples(index=False, name=None))
+        stored = read_rows(CONNECTION, UNMERGED_TABLE, key, key, keys)
+        chunk = chunk[[k not in stored for k in keys]]
+    unmerged_added = insert_frame(chunk, UNMERGED_TABLE, CONNECTION, batch_rows=batch_rows)
+
+    game_ids = [(game_id,) for game_id in chunk['GAME_ID'].unique()]
+    if len(game_ids) == 0:
+        return unmerged_added, 0
+
+    # Both teams' rows of every game in the chunk, read back from the table so earlier chunks are included
+    games = read_frame_by_keys(CONNECTION, UNMERGED_TABLE, ['GAME_ID'], game_ids)
     games = games.sort_values(by='GAME_DATE', ascending=False)
+    merged = combine_team_games(games)
+    if table_exists(CONNECTION, MERGED_TABLE):
+        stored = read_rows(CONNECTION, MERGED_TABLE, ['GAME_ID'], ['GAME_ID'], game_ids)
+        merged = merged[[(game_id,) not in stored for game_id in merged['GAME_ID']]]
+    merged_added = insert_frame(merged, MERGED_TABLE, CONNECTION, batch_rows=batch_rows)
 
-    return games
-
+    return unmerged_added, merged_added
 
 
 def get_last_update(CONNECTION):
@@ -66,8 +125,8 @@ def get_new_games(start_date):
     :return: DataFrame of games
     """
 
-    result = leaguegamefinder.LeagueGameFinder(date_from_nullable=start_date, league_id_nullable='00')
-    games_toadd = result.get_data_frames()[0]
+    games_toadd = cached_call(leaguegamefinder.LeagueGameFinder, ttl=DAILY,
+                              date_from_nullable=start_date, league_id_nullable='00')[0]
 
     return games_toadd
 
@@ -87,55 +146,106 @@ def combine_team_games(df, keep_method='home'):
     :return: DataFrame of merged games
     """
 
-    # Join every row to all others with the same game ID.
-    joined = pd.merge(df, df, suffixes=['_A', '_B'],
-                      on=['SEASON_ID', 'GAME_ID', 'GAME_DATE'])
-    # Filter out any row that is joined to itself.
-    result = joined[joined.TEAM_ID_A != joined.TEAM_ID_B]
-    # Take action based on the keep_method flag.
+    if keep_method is not None and keep_method.lower() not in ('home', 'away', 'winner', 'loser'):
+        raise ValueError(f'Invalid keep_method: {keep_method}')
+
+    # Equivalent to joining every row to all others with the same game ID and filtering self-joined rows, but works
+    # on integer row positions and only materializes the pairs that are kept. Columns, row order and index labels
+    # are the same as pd.merge(df, df, on=GAME_KEYS) would produce.
+    n = len(df)
+    codes = df.groupby(GAME_KEYS, sort=False, dropna=False).ngroup().to_numpy()
+    counts = np.bincount(codes, minlength=codes.max() + 1 if n else 0)
+    sizes = counts[codes]
+
+    # Rows ordered by game, keeping the input order within each game, and where each game starts in that order
+    order = np.argsort(codes, kind='stable')
+    starts = np.cumsum(counts) - counts
+
+    # Take action based on the keep_method flag, deciding which rows can be TEAM_A before pairing.
     if keep_method is None:
-        # Return all the rows.
-        pass
-    elif keep_method.lower() == 'home':
-        # Keep rows where TEAM_A is the home team.
-        result = result[result.MATCHUP_A.str.contains(' vs. ')]
-    elif keep_method.lower() == 'away':
-        # Keep rows where TEAM_A is the away team.
-        result = result[result.MATCHUP_A.str.contains(' @ ')]
-    elif keep_method.lower() == 'winner':
-        result = result[result.WL_A == 'W']
-    elif keep_method.lower() == 'loser':
-        result = result[result.WL_A == 'L']
+        # Keep all the rows.
+        is_a = np.ones(n, dtype=bool)
+    elif keep_method.lower() in ('home', 'away'):
+        # MATCHUP has few distinct values, so the pattern is matched once per category instead of once per row.
+        matchup = pd.Categorical(df['MATCHUP'])
+        pattern = ' vs. ' if keep_method.lower() == 'home' else ' @ '
+        matches = np.append(np.asarray(matchup.categories.str.contains(pattern), dtype=bool), False)
+        is_a = matches[matchup.codes]
     else:
-        raise ValueError(f'Invalid keep_method: {keep_method}')
+        is_a = df['WL'].to_numpy() == ('W' if keep_method.lower() == 'winner' else 'L')
+
+    left = np.flatnonzero(is_a & (sizes > 1))
+
+    # Pair each kept row with every row of its game, then filter out pairs of a team with itself.
+    reps = sizes[left]
+    pair_left = np.repeat(left, reps)
+    within = np.arange(reps.sum()) - np.repeat(np.cumsum(reps) - reps, reps)
+    pair_right = order[starts[codes[pair_left]] + within]
+
+    team_id = df['TEAM_ID'].to_numpy()
+    not_self = team_id[pair_left] != team_id[pair_right]
+    pair_left, pair_right, within = pair_left[not_self], pair_right[not_self], within[not_self]
+
+    # Position each pair would have in the merged frame: all pairs of earlier rows come first.
+    merged_index = (np.cumsum(sizes) - sizes)[pair_left] + within
+
+    team_a = df.iloc[pair_left]
+    team_a.columns = [col if col in GAME_KEYS else f'{col}_A' for col in df.columns]
+    team_b = df.drop(columns=GAME_KEYS).iloc[pair_right]
+    team_b.columns = [f'{col}_B' for col in team_b.columns]
+
+    result = pd.concat([team_a.reset_index(drop=True), team_b.reset_index(drop=True)], axis=1)
+    result.index = pd.Index(merged_index)
     return result
 
-def save_sql(games_toadd, games_toadd_merged, CONNECTION, new_date):
+def set_last_update(CONNECTION, type, date):
+    """
+    Set the date of a bookmark in the Last_Updated table, without committing, so it can be committed atomically with
+    the rows it describes
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param type: Bookmark type, e.g. 'game'
+    :param date: New date of the bookmark, in the format 'MM/DD/YYYY'
     """
-    Saves NBA game data to a SQLite database
+    ensure_table(pd.DataFrame({'Type': [type], 'Date': [date]}), 'Last_Updated', CONNECTION)
+    updated = CONNECTION.execute('UPDATE Last_Updated SET Date = ? WHERE Type = ?', (date, type)).rowcount
+    if updated == 0:
+        CONNECTION.execute('INSERT INTO Last_Updated (Type, Date) VALUES (?, ?)', (type, date))
+
+
+def save_sql(games_toadd, games_toadd_merged, CONNECTION, new_date, batch_rows=BATCH_ROWS):
+    """
+    Saves NBA game data to a SQLite database. The games and the new Last_Updated date are written in bounded-size
+    batches and committed as one transaction, so the bookmark never moves without its games
     :param games_toadd: DataFrame unmerged NBA games to add to the database
     :param games_toadd_merged: DataFrame merged NBA games to add to the database
     :param CONNECTION: Connection object representing the connection to the SQLite database
     :param new_date: Date of the last NBA game
+    :param batch_rows: Number of rows per insert batch
     :return: None
     """
-    games_toadd.to_sql('ALL_GAMES_UNMERGED', CONNECTION, if_exists='append', index=False)
-    games_toadd_merged.to_sql('ALL_GAMES_MERGED', CONNECTION, if_exists='append', index=False)
-
-    df = pd.read_sql_query('SELECT * FROM Last_Updated', CONNECTION)
-    df = df.set_index('Type')
-    df.at['game', 'Date'] = new_date
-    df.to_sql('Last_Updated', CONNECTION, if_exists='replace')
+    try:
+        insert_frame(apply_schema(games_toadd, UNMERGED_TABLE, lossless=True), UNMERGED_TABLE, CONNECTION,
+                     batch_rows=batch_rows)
+        insert_frame(apply_schema(games_toadd_merged, MERGED_TABLE, lossless=True), MERGED_TABLE, CONNECTION,
+                     batch_rows=batch_rows)
+        set_last_update(CONNECTION, 'game', new_date)
+        CONNECTION.commit()
+    except Exception:
+        CONNECTION.rollback()
+        raise
 
     return 0
 
 
-if __name__ == "__main__":
-    download_all = None
+def main():
+    """
+    Add the games played since the last update, or every game if the database has none yet
 
+    :return: Number of merged games added
+    """
     # Connect to the SQLite database.
     with connect() as CONNECTION:
-        CONNECTION = connect()
 
         try:
             # Get the last update date from the database.
@@ -151,25 +261,34 @@ if __name__ == "__main__":
             print('No games currently in database')
             download_all = True
 
-        if download_all == True:
-            # Download all games
-            games_toadd = download_games()
-            games_toadd_merged = combine_team_games(games_toadd)
+        # Get the current date for the new update.
+        new_date = datetime.today() - timedelta(days=1)
+        new_date = new_date.strftime('%m/%d/%Y')  # WANT TO RUN MORNING AFTER ALL GAMES FROM PREVIOUS NIGHT FINISHED
 
-        elif download_all == False:
-            # Download only new games
+        if download_all:
+            # Stream all games into the database team by team, then update the last update date.
+            games_added = download_games(CONNECTION, new_date)
+
+        else:
+            # Download only new games, save them and update the last update date.
             games_toadd = get_new_games(start_date)
             games_toadd_merged = combine_team_games(games_toadd)
+            save_sql(games_toadd, games_toadd_merged, CONNECTION, new_date)
+            games_added = len(games_toadd_merged)
 
-        else:
-            print('Error downloading games')
+        # Log the number of games downloaded and the new last update date.
+        print(F'{get_current_time()}: Added {games_added} games, up to date through {new_date}')
+        print(cache_summary())
 
-        # Get the current date for the new update.
-        new_date = datetime.today() - timedelta(days=1)
-        new_date = new_date.strftime('%m/%d/%Y')  # WANT TO RUN MORNING AFTER ALL GAMES FROM PREVIOUS NIGHT FINISHED
+        # Carry team ratings, form and splits forward over the new games (a full rebuild on the first run)
+        update_ratings(CONNECTION)
 
-        # Save the downloaded games to the database and update the last update date.
-        save_sql(games_toadd, games_toadd_merged, CONNECTION, new_date)
+        # Mirror the seasons that changed to the Parquet store
+        sync_tables(CONNECTION, [UNMERGED_TABLE, MERGED_TABLE, RATINGS_TABLE, STATE_TABLE, SPLITS_TABLE])
+
+    return games_added
+
+
+if __name__ == "__main__":
+    main()
 
-        # Log the number of games downloaded and the new last update date.
-        print(F'{get_current_time()}: Added {len(games_toadd_merged)} games, up to date through {new_date}')
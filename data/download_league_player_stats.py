@@ -1,6 +1,30 @@
 import pandas as pd
+from functools import partial
+from multiprocessing import Pool
 from nba_api.stats.endpoints import leaguedashplayerstats, playerdashptshots
 from connect_sqlite import connect, get_current_time
+from parquet_store import sync_tables
+from fetch_engine import FetchEngine
+from config import CURRENT_SEASON
+from frame_accumulator import FrameAccumulator
+from response_cache import cached_call, season_ttl, cache_summary
+from schema import apply_schema
+from sql_writer import bump_version, format_counts, insert_frame, rows_written, table_columns, table_exists, upsert
+from work_queue import WorkQueue, create_queue_table
+
+# Completed (season, player) units of the historical backfill
+CHECKPOINT_TABLE = 'BACKFILL_CHECKPOINT'
+PAST_STATS_TABLE = 'LEAGUE_PLAYER_STATS_PAST'
+PAST_SHOT_TABLES = ['SHOT_OVERALL_PAST', 'SHOT_TYPE_PAST', 'SHOT_CLOCK_PAST', 'SHOT_DRIBBLE_PAST', 'SHOT_CLOSEDEF_PAST', 'SHOT_CLOSEDEF_10PLUS_PAST', 'SHOT_TOUCHTIME_PAST']
+BACKFILL_PROCESSES = 4
+
+CURRENT_STATS_TABLE = 'LEAGUE_PLAYER_STATS_CURRENT'
+CURRENT_SHOT_TABLES = ['SHOT_OVERALL_CURRENT', 'SHOT_TYPE_CURRENT', 'SHOT_CLOCK_CURRENT', 'SHOT_DRIBBLE_CURRENT', 'SHOT_CLOSEDEF_CURRENT', 'SHOT_CLOSEDEF_10PLUS_CURRENT', 'SHOT_TOUCHTIME_CURRENT']
+# Column distinguishing the rows of one player in each shot table, part of the natural key
+SHOT_RANGE_COLUMNS = ['SHOT_TYPE', 'SHOT_TYPE', 'SHOT_CLOCK_RANGE', 'DRIBBLE_RANGE', 'CLOSE_DEF_DIST_RANGE', 'CLOSE_DEF_DIST_RANGE', 'TOUCH_TIME_RANGE']
+# League-player stats each player's current shot profile was fetched at. A player is refetched when these move
+SHOT_STATE_TABLE = 'SHOT_REFRESH_STATE'
+SHOT_STATE_COLUMNS = ['PLAYER_ID', 'SEASON', 'TEAM_ID', 'GP', 'MIN']
 
 
 def get_seasons(START: int, END: int):
@@ -32,17 +56,13 @@ def download_league_player_stats(seasons, current_season=False):
         2. 1D numpy array of player IDs for the downloaded statistics.
         3. 1D numpy array of team IDs for the downloaded statistics.
     """
-    league_stats = pd.DataFrame()
+    league_stats = FrameAccumulator()
     for season in seasons:
         while True:
             try:
-                if len(league_stats) == 0:
-                    league_stats = leaguedashplayerstats.LeagueDashPlayerStats(season=season).get_data_frames()[0]
-                    league_stats['SEASON'] = season
-                else:
-                    temp = leaguedashplayerstats.LeagueDashPlayerStats(season=season).get_data_frames()[0]
-                    temp['SEASON'] = season
-                    league_stats = pd.concat([league_stats, temp])
+                temp = cached_call(leaguedashplayerstats.LeagueDashPlayerStats, ttl=season_ttl(season), season=season)[0]
+                temp['SEASON'] = season
+                league_stats.add(temp)
 
             except Exception as e:
                 print("Encountered Error while downloading league-player stats ", e)
@@ -50,7 +70,9 @@ def download_league_player_stats(seasons, current_season=False):
 
             break
 
+    league_stats = league_stats.frame()
     league_stats['SEASON_CURRENT'] = current_season
+    league_stats = apply_schema(league_stats, PAST_STATS_TABLE, lossless=True)
 
     player_id = league_stats['PLAYER_ID'].to_numpy()
     team_id = league_stats['TEAM_ID'].to_numpy()
@@ -58,7 +80,23 @@ def download_league_player_stats(seasons, current_season=False):
     return league_stats, player_id, team_id
 
 
-def download_player_pt_shots(player_id, team_id, season, CONNECTION, current=False):
+def fetch_player_pt_shots(key, timeout, season, refresh=False):
+    """
+    Fetch the seven shooting frames of one player. Called from FetchEngine worker threads.
+
+    :param key: Tuple of (player ID, team ID)
+    :param timeout: Request timeout in seconds
+    :param season: str representing a season, in the format 'YYYY-YY'
+    :param refresh: Whether to bypass the response cache
+    :return: List of seven DataFrames
+    """
+    p_id, t_id = key
+    return cached_call(playerdashptshots.PlayerDashPtShots, ttl=season_ttl(season), refresh=refresh,
+                       team_id=t_id, player_id=p_id, season=season, timeout=timeout)
+
+
+def download_player_pt_shots(player_id, team_id, season, CONNECTION, current=False, engine=None, state=None, delta=False,
+                              gone=None):
     """
     Downloads shooting data for all NBA players for a given season. Shooting data is available beginning in the 2014-15 NBA season.
     More info at https://www.nba.com/stats/players/shots-general
@@ -68,64 +106,351 @@ def download_player_pt_shots(player_id, team_id, season, CONNECTION, current=Fal
     :param season: str representing a season, in the format 'YYYY-YY'
     :param current: bool indicating whether season is the current active season. Default False
     :param CONNECTION: A database connection object
-    :return: Nothing. Tables are saved to database directly
+    :param engine: FetchEngine used for the requests. Default is a new FetchEngine with default limits
+    :param state: Current season only. DataFrame of SHOT_STATE_COLUMNS to record in SHOT_REFRESH_STATE for the
+        players fetched successfully, in the same transaction as their shot rows
+    :param delta: Current season only. Whether player_id is a subset of the league, in which case only these
+        players' rows are upserted and rows of other players are kept. The response cache is bypassed. Otherwise
+        player_id is the whole league and rows of players not in it are deleted. Players whose fetch failed keep
+        their stored rows either way
+    :param gone: Current season only. DataFrame of PLAYER_ID and SEASON of profiles to delete, see drop_players. Deleted
+        after the requests, in the same transaction as the upserts, so the write lock is never held during a fetch
+    :return: Number of rows written. Tables are saved to database directly
     """
 
-    dfs = [pd.DataFrame() for _ in range(7)]
+    if isinstance(season, (list, tuple)):
+        season = season[0]
 
-    for p_id, t_id in zip(player_id, team_id):
-        while True:
-            try:
-                result = playerdashptshots.PlayerDashPtShots(t_id, p_id, season=season).get_data_frames()
-            except Exception as e:
-                print("Encountered Error while downloading Player-Point-Shots ", e)
-                continue
-            break
+    if engine is None:
+        engine = FetchEngine()
+
+    if current:
+        # Current tables are upserted in one transaction at the end so readers never see a half-written table
+        dfs = [FrameAccumulator() for _ in CURRENT_SHOT_TABLES]
 
-        for i, df in enumerate(result):
-            dfs[i] = pd.concat([dfs[i], df])
+    else:
+        # Past tables are appended to in batches as players arrive
+        dfs = [FrameAccumulator(name, CONNECTION, if_exists='append') for name in PAST_SHOT_TABLES]
+
+    keys = [(int(p_id), int(t_id)) for p_id, t_id in zip(player_id, team_id)]
+    fetched = set()
+    for key, result in engine.run(keys, partial(fetch_player_pt_shots, season=season, refresh=delta)):
+        fetched.add(key[0])
+        for acc, df in zip(dfs, result):
+            df['SEASON'] = season
+            acc.add(df)
 
-    df['SEASON'] = season[0]
+    print(engine.summary('players'))
 
+    written = 0
     if current:
-        table_names = ['SHOT_OVERALL_CURRENT', 'SHOT_TYPE_CURRENT', 'SHOT_CLOCK_CURRENT', 'SHOT_DRIBBLE_CURRENT', 'SHOT_CLOSEDEF_CURRENT', 'SHOT_CLOSEDEF_10PLUS_CURRENT', 'SHOT_TOUCHTIME_CURRENT']
-        for name, df in zip(table_names, dfs):
-            df.to_sql(name, CONNECTION, if_exists='replace')
+        failed = {key[0] for key in keys} - fetched
+        if gone is not None:
+            written += drop_players(CONNECTION, gone)
+        for name, range_col, acc in zip(CURRENT_SHOT_TABLES, SHOT_RANGE_COLUMNS, dfs):
+            if len(acc) == 0:
+                continue
+            key = ['PLAYER_ID', 'SEASON', range_col]
+            df = acc.frame()
+            counts = upsert(df, name, CONNECTION, key, commit=False)
+            if not delta:
+                counts['deleted'] = delete_stale(CONNECTION, name, key, df, failed, season)
+            print(format_counts(name, counts))
+            written += rows_written(counts)
+
+        if state is not None:
+            state = state.loc[state['PLAYER_ID'].isin(fetched), SHOT_STATE_COLUMNS]
+            upsert(state, SHOT_STATE_TABLE, CONNECTION, ['PLAYER_ID', 'SEASON'], commit=False)
+            if not delta:
+                delete_stale(CONNECTION, SHOT_STATE_TABLE, ['PLAYER_ID', 'SEASON'], state, failed, season)
+        CONNECTION.commit()
 
     else:
-        table_names = ['SHOT_OVERALL_PAST', 'SHOT_TYPE_PAST', 'SHOT_CLOCK_PAST', 'SHOT_DRIBBLE_PAST', 'SHOT_CLOSEDEF_PAST', 'SHOT_CLOSEDEF_10PLUS_PAST', 'SHOT_TOUCHTIME_PAST']
-        for name, df in zip(table_names, dfs):
-            df.to_sql(name, CONNECTION, if_exists='append')
+        for acc in dfs:
+            acc.close()
+            written += len(acc)
 
-    return
+    return written
 
 
-if __name__ == '__main__':
-    #Check if past table exists
+def shot_queue_name(season):
+    """
+    :param season: str representing a season, in the format 'YYYY-YY'
+    :return: Name of the checkpoint queue of a season's shot profiles
+    """
+    return f'SHOT_PAST_{season}'
+
+
+def seed_checkpoints(CONNECTION):
+    """
+    Record checkpoints for data written before checkpointing existed, so the backfill does not append it a second time.
+    Only runs while the checkpoint table is still empty.
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    """
+    if table_exists(CONNECTION, CHECKPOINT_TABLE) and CONNECTION.execute(f'SELECT 1 FROM {CHECKPOINT_TABLE}').fetchone():
+        return
+    if not table_exists(CONNECTION, PAST_STATS_TABLE):
+        return
+
+    seasons = pd.read_sql_query(f'SELECT DISTINCT SEASON FROM {PAST_STATS_TABLE}', CONNECTION)['SEASON']
+    create_queue_table(CONNECTION, CHECKPOINT_TABLE)
+    for season in seasons:
+        CONNECTION.execute(f'INSERT OR IGNORE INTO {CHECKPOINT_TABLE} VALUES (?, ?)', (PAST_STATS_TABLE, int(season[:4])))
+
+    if table_exists(CONNECTION, PAST_SHOT_TABLES[0]) and 'SEASON' in table_columns(CONNECTION, PAST_SHOT_TABLES[0]):
+        done = pd.read_sql_query(f'SELECT DISTINCT SEASON, PLAYER_ID FROM {PAST_SHOT_TABLES[0]}', CONNECTION)
+        for season, p_id in done.itertuples(index=False):
+            CONNECTION.execute(f'INSERT OR IGNORE INTO {CHECKPOINT_TABLE} VALUES (?, ?)', (shot_queue_name(season), int(p_id)))
+
+    CONNECTION.commit()
+
+
+def backfill_league_player_stats(CONNECTION, seasons):
+    """
+    Download LEAGUE_PLAYER_STATS_PAST one season at a time. Each season's rows are committed in the same transaction
+    as its checkpoint, so a rerun only downloads the seasons that are missing and never appends a season twice.
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param seasons: A list of seasons in the format 'YYYY-YY'
+    :return: Number of rows added
+    """
+    queue = WorkQueue(CONNECTION, PAST_STATS_TABLE, [int(season[:4]) for season in seasons], table=CHECKPOINT_TABLE)
+
+    added = 0
+    for year in queue:
+        league_stats, _, _ = download_league_player_stats(get_seasons(year, year + 1))
+        insert_frame(league_stats, PAST_STATS_TABLE, CONNECTION, index=True)
+        queue.done(year, commit=False)
+        CONNECTION.commit()
+        added += len(league_stats)
+
+    return added
+
+
+def backfill_player_pt_shots(CONNECTION, season, engine=None):
+    """
+    Download the SHOT_*_PAST tables of one completed season, for the players of that season in LEAGUE_PLAYER_STATS_PAST.
+    The seven frames of each player are committed in the same transaction as the (season, player) checkpoint, so a
+    rerun only fetches the players that are missing and never appends a player twice.
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param season: str representing a season, in the format 'YYYY-YY'
+    :param engine: FetchEngine used for the requests. Default is a new FetchEngine with default limits
+    :return: Number of players added
+    """
+    if engine is None:
+        engine = FetchEngine()
+
+    players = pd.read_sql_query(f'SELECT PLAYER_ID, TEAM_ID FROM {PAST_STATS_TABLE} WHERE SEASON = ?', CONNECTION, params=(season,))
+    team_ids = dict(zip(players['PLAYER_ID'], players['TEAM_ID']))
+    queue = WorkQueue(CONNECTION, shot_queue_name(season), players['PLAYER_ID'], table=CHECKPOINT_TABLE)
+    if len(queue) == 0:
+        return 0
+
+    keys = [(p_id, int(team_ids[p_id])) for p_id in queue.pending]
+    added = 0
+    for (p_id, t_id), result in engine.run(keys, partial(fetch_player_pt_shots, season=season)):
+        for name, df in zip(PAST_SHOT_TABLES, result):
+            df['SEASON'] = season
+            insert_frame(df, name, CONNECTION, index=True)
+        queue.done(p_id, commit=False)
+        CONNECTION.commit()
+        added += 1
+
+    print(engine.summary('players'))
+
+    return added
+
+
+def backfill_season_worker(season, rate):
+    """
+    Worker process entry point: backfill the shot profiles of one season on its own connection
+
+    :param season: str representing a season, in the format 'YYYY-YY'
+    :param rate: Requests per second allowed for this worker
+    :return: Tuple of (season, number of players added)
+    """
     with connect() as conn:
-        try:
-            pd.read_sql_query("SELECT * FROM LEAGUE_PLAYER_STATS_PAST", conn)
+        added = backfill_player_pt_shots(conn, season, FetchEngine(rate=rate))
 
-        except Exception as e: #Create the table with stats from previous completed seasons
-            seasons = get_seasons(START=1996, END=2021)
+    return season, added
 
-            league_stats, player_id, team_id = download_league_player_stats(seasons)
-            league_stats.to_sql('LEAGUE_PLAYER_STATS_PAST', conn, if_exists='replace')
-            print(f'{get_current_time()}: Added {len(league_stats)} League-Player Stats (Past)')
 
-            seasons = get_seasons(START=2014, END=2021)
-            for season in seasons:
-                league_stats, player_id, team_id = download_league_player_stats(season)
-                download_player_pt_shots(player_id, team_id, season, conn, current=False)
-                print(f'{get_current_time()}: Updated {len(league_stats)} Shot Profile Stats from season {season} (PAST)')
+def backfill_past(CONNECTION, processes=BACKFILL_PROCESSES, rate=2.0):
+    """
+    Build or complete the tables of previous completed seasons: LEAGUE_PLAYER_STATS_PAST from 1996-97 and the
+    SHOT_*_PAST tables from 2014-15, when shooting data begins. Units finished by an earlier run are skipped.
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param processes: Number of worker processes downloading shot profile seasons in parallel
+    :param rate: Total requests per second, shared evenly between the worker processes
+    :return: Number of League-Player Stats rows and shot profile players added
+    """
+    seed_checkpoints(CONNECTION)
+
+    added = backfill_league_player_stats(CONNECTION, get_seasons(START=1996, END=2021))
+    if added > 0:
+        print(f'{get_current_time()}: Added {added} League-Player Stats (Past)')
+    total = added
+
+    seasons = get_seasons(START=2014, END=2021)
+    if processes > 1:
+        with Pool(processes) as pool:
+            results = pool.imap_unordered(partial(backfill_season_worker, rate=rate / processes), seasons)
+            for season, added in results:
+                if added > 0:
+                    print(f'{get_current_time()}: Updated {added} Shot Profile Stats from season {season} (PAST)')
+                total += added
+    else:
+        for season in seasons:
+            added = backfill_player_pt_shots(CONNECTION, season, FetchEngine(rate=rate))
+            if added > 0:
+                print(f'{get_current_time()}: Updated {added} Shot Profile Stats from season {season} (PAST)')
+            total += added
+
+    return total
+
+
+def backfill():
+    """
+    Build or complete the tables of previous completed seasons. Units finished by an earlier run are skipped
+
+    :return: Number of rows written
+    """
+    with connect() as conn:
+        added = backfill_past(conn)
+        sync_tables(conn, [PAST_STATS_TABLE] + PAST_SHOT_TABLES)
+
+    return added
+
 
+def update_league_stats():
+    """
+    Download the current season's league-player stats and upsert them into LEAGUE_PLAYER_STATS_CURRENT
+
+    :return: Number of rows written
+    """
+    with connect() as conn:
+        league_stats, _, _ = download_league_player_stats([CURRENT_SEASON], current_season=True)
+        counts = upsert(league_stats, CURRENT_STATS_TABLE, conn, ['PLAYER_ID', 'SEASON'], delete_missing=True)
+        print(f'{get_current_time()}: Updated {len(league_stats)} League-Player Stats ({format_counts(CURRENT_STATS_TABLE, counts)})')
+        sync_tables(conn, [CURRENT_STATS_TABLE])
 
-        #Update current season only
-        current_season = ['2022-23']
+    return rows_written(counts)
 
-        league_stats, player_id, team_id = download_league_player_stats(current_season, current_season=True)
-        league_stats.to_sql('LEAGUE_PLAYER_STATS_CURRENT', conn, if_exists='replace')
-        print(f'{get_current_time()}: Updated {len(league_stats)} League-Player Stats')
 
-        download_player_pt_shots(player_id, team_id, current_season, conn, current=True)
-        print(f'{get_current_time()}: Updated {len(league_stats)} Shot Profile Stats from season {current_season}')
+def changed_players(CONNECTION, league_stats):
+    """
+    Compare freshly downloaded league-player stats with the stats each stored shot profile was fetched at
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param league_stats: DataFrame with SHOT_STATE_COLUMNS, e.g. LEAGUE_PLAYER_STATS_CURRENT
+    :return: Tuple of (rows of league_stats whose TEAM_ID, GP or MIN moved or that have no stored profile,
+        DataFrame of PLAYER_ID and SEASON of stored profiles no longer in league_stats),
+        or (None, None) if no profiles have been recorded yet
+    """
+    if not table_exists(CONNECTION, SHOT_STATE_TABLE):
+        return None, None
+    state = pd.read_sql_query(f'SELECT {", ".join(SHOT_STATE_COLUMNS)} FROM {SHOT_STATE_TABLE}', CONNECTION)
+    if state.empty:
+        return None, None
+
+    joined = league_stats[SHOT_STATE_COLUMNS].merge(state, on=['PLAYER_ID', 'SEASON'], how='left', suffixes=['', '_PREV'])
+    moved = joined['GP_PREV'].isna()
+    for col in ['TEAM_ID', 'GP', 'MIN']:
+        moved |= joined[col].to_numpy() != joined[f'{col}_PREV'].to_numpy()
+
+    gone = state.merge(league_stats[['PLAYER_ID', 'SEASON']], how='left', indicator=True)
+    gone = gone.loc[gone['_merge'] == 'left_only', ['PLAYER_ID', 'SEASON']]
+
+    return league_stats[moved.to_numpy()], gone
+
+
+def drop_players(CONNECTION, players):
+    """
+    Delete the current shot profiles and refresh state of players, without committing
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param players: DataFrame of PLAYER_ID and SEASON
+    :return: Number of shot rows deleted
+    """
+    keys = list(players[['PLAYER_ID', 'SEASON']].itertuples(index=False, name=None))
+    deleted = 0
+    for name in CURRENT_SHOT_TABLES:
+        if table_exists(CONNECTION, name):
+            deleted += CONNECTION.executemany(f'DELETE FROM {name} WHERE PLAYER_ID = ? AND SEASON = ?', keys).rowcount
+            bump_version(CONNECTION, name, players)
+    CONNECTION.executemany(f'DELETE FROM {SHOT_STATE_TABLE} WHERE PLAYER_ID = ? AND SEASON = ?', keys)
+    bump_version(CONNECTION, SHOT_STATE_TABLE)
+
+    return deleted
+
+
+def delete_stale(CONNECTION, table, key, df, failed, season):
+    """
+    Delete the rows of a current table whose key is not in a full download, without committing. Rows of players whose
+    fetch failed are kept, so a failed request never drops a profile that was stored before
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param table: Table name, keyed on PLAYER_ID and SEASON first
+    :param key: List of key column names
+    :param df: DataFrame of the rows downloaded for the table
+    :param failed: Set of IDs of the players whose fetch failed
+    :param season: str representing the season downloaded, in the format 'YYYY-YY'
+    :return: Number of rows deleted
+    """
+    incoming = set(df[key].itertuples(index=False, name=None))
+    columns = ', '.join(f'"{col}"' for col in key)
+    stale = [k for k in CONNECTION.execute(f'SELECT {columns} FROM "{table}"')
+             if k not in incoming and not (k[0] in failed and k[1] == season)]
+    where = ' AND '.join(f'"{col}" IS ?' for col in key)
+    CONNECTION.executemany(f'DELETE FROM "{table}" WHERE {where}', stale)
+    if stale:
+        bump_version(CONNECTION, table, pd.DataFrame(stale, columns=key))
+
+    return len(stale)
+
+
+def update_shot_profiles(delta=True):
+    """
+    Download the current season's shot profiles of the players in LEAGUE_PLAYER_STATS_CURRENT. In delta mode only
+    players whose TEAM_ID, GP or MIN changed since their profile was last fetched are downloaded, and profiles of
+    players who left the league stats are deleted. The first run, or delta=False, downloads every player.
+
+    :param delta: Whether to refetch only the players whose stats changed
+    :return: Number of rows written
+    """
+    with connect() as conn:
+        league_stats = pd.read_sql_query(f'SELECT {", ".join(SHOT_STATE_COLUMNS)} FROM {CURRENT_STATS_TABLE}', conn)
+
+        players, gone = changed_players(conn, league_stats) if delta else (None, None)
+        if players is None:
+            players, delta = league_stats, False
+        else:
+            print(f'{get_current_time()}: {len(players)} of {len(league_stats)} players changed, {len(gone)} removed')
+
+        if len(players) > 0:
+            written = download_player_pt_shots(players['PLAYER_ID'], players['TEAM_ID'], CURRENT_SEASON, conn,
+                                               current=True, state=players, delta=delta, gone=gone)
+        else:
+            written = drop_players(conn, gone) if gone is not None else 0
+            conn.commit()
+        print(f'{get_current_time()}: Updated {len(players)} Shot Profile Stats from season {[CURRENT_SEASON]}')
+        print(cache_summary())
+        sync_tables(conn, CURRENT_SHOT_TABLES)
+
+    return written
+
+
+def main():
+    """
+    Backfill past seasons, then update the current season's league-player stats and shot profiles
+
+    :return: Number of rows written
+    """
+    return backfill() + update_league_stats() + update_shot_profiles()
+
+
+if __name__ == '__main__':
+    main()
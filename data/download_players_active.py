@@ -1,35 +1,57 @@
 import pandas as pd
 from nba_api.stats.endpoints import playercareerstats
+from config import CURRENT_SEASON
 from connect_sqlite import connect, get_current_time
-
-
-def download_allplayerseasons(player_ids):
+from frame_accumulator import FrameAccumulator
+from parquet_store import sync_tables
+from sql_writer import bump_version, format_counts, insert_frame, rows_written, table_exists, upsert
+from response_cache import DAILY, cached_call, cache_summary
+from work_queue import WorkQueue, clear_queue, read_staging
+
+QUEUE_NAME = 'players_active'
+STAGING_TABLE = 'PLAYERS_ACTIVE_STAGING'
+# Queue of the incremental update, kept apart so it never picks up the staged rows of an interrupted full run
+DELTA_QUEUE_NAME = 'players_active_delta'
+DELTA_STAGING_TABLE = 'PLAYERS_ACTIVE_DELTA_STAGING'
+KEY = ['id', 'SEASON_ID', 'TEAM_ID']
+PLAYER_INFO_COLUMNS = ['id', 'full_name', 'first_name', 'last_name', 'is_active']
+
+
+def download_allplayerseasons(player_ids, CONNECTION, queue_name=QUEUE_NAME, staging_table=STAGING_TABLE, refresh=False):
     """
-    Download regular season player statistics for all active NBA players
+    Download regular season player statistics for all active NBA players. Each player's rows are staged in
+    PLAYERS_ACTIVE_STAGING together with a WorkQueue completion mark, so an interrupted run resumes where it stopped.
+    A player that keeps failing is left pending in the queue and missing from the result
 
     :param player_ids: List of ids of active players
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param queue_name: Name of the WorkQueue tracking the downloaded players
+    :param staging_table: Table the players' rows are staged in
+    :param refresh: Whether to bypass the response cache, for players known to have new games
     :return: DataFrame of all regular season player statistics for the given player IDs, with additional columns for PPG, RPG, and APG
     """
 
-    allplayerseasons = pd.DataFrame()
+    queue = WorkQueue(CONNECTION, queue_name, player_ids)
+    # Completion marks are held in memory and written by the flush that writes the players' rows, so no write
+    # transaction stays open across the requests
+    staged = FrameAccumulator(staging_table, CONNECTION, flush_rows=500, on_flush=queue.write_marks, index=False)
 
-    while len(player_ids) > 0:
+    for id in queue:
         try:
-            id = player_ids[-1]
-
-            if len(allplayerseasons) == 0:
-                playercareer = playercareerstats.PlayerCareerStats(player_id=id, timeout=100)
-                allplayerseasons = playercareer.get_data_frames()[0]
+            result = cached_call(playercareerstats.PlayerCareerStats, ttl=DAILY, refresh=refresh, player_id=id, timeout=100)[0]
 
-            elif id not in list(allplayerseasons['PLAYER_ID']):
-                playercareer = playercareerstats.PlayerCareerStats(player_id=id, timeout=100)
-                allplayerseasons = pd.concat([allplayerseasons, playercareer.get_data_frames()[0]])
-
-            player_ids.pop()
+            queue.done(id, defer=True)
+            staged.add(result)
 
         except Exception as e:
             print(f'Error downloading active player {id}: {e}')
-            continue
+            if not queue.retry(id):
+                print(f'{get_current_time()}: Giving up on active player {id} until the next run')
+
+    staged.close()
+    allplayerseasons = read_staging(CONNECTION, staging_table)
+    if allplayerseasons.empty:
+        return allplayerseasons.reindex(columns=['PLAYER_ID', 'SEASON_ID', 'TEAM_ID'])
 
     allplayerseasons['PPG'] = allplayerseasons['PTS']/allplayerseasons['GP']
     allplayerseasons['RPG'] = allplayerseasons['REB']/allplayerseasons['GP']
@@ -38,14 +60,159 @@ def download_allplayerseasons(player_ids):
     return allplayerseasons
 
 
-if __name__ == '__main__':
+def fill_keys(allplayerseasons):
+    """
+    Players without any career rows still get one row, keyed with an empty season
+    """
+    allplayerseasons['SEASON_ID'] = allplayerseasons['SEASON_ID'].fillna('')
+    allplayerseasons['TEAM_ID'] = allplayerseasons['TEAM_ID'].fillna(0).astype(int)
+
+    return allplayerseasons
 
+
+def changed_players(CONNECTION, season=CURRENT_SEASON):
+    """
+    Find the players whose season line in LEAGUE_PLAYER_STATS_CURRENT is ahead of their stored line in PLAYERS_ACTIVE.
+    A traded player's largest GP and PTS are those of the combined (TOT) row, which is what the league stats report
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param season: str representing the current season, in the format 'YYYY-YY'
+    :return: List of player ids
+    """
+    league = pd.read_sql_query('SELECT PLAYER_ID AS id, GP, PTS FROM LEAGUE_PLAYER_STATS_CURRENT WHERE SEASON = ?',
+                               CONNECTION, params=(season,))
+    stored = pd.read_sql_query('SELECT id, MAX(GP) AS GP, MAX(PTS) AS PTS FROM PLAYERS_ACTIVE WHERE SEASON_ID = ? GROUP BY id',
+                               CONNECTION, params=(season,))
+
+    joined = league.merge(stored, on='id', how='left', suffixes=['', '_STORED'])
+    moved = (joined['GP'].to_numpy() != joined['GP_STORED'].to_numpy()) | (joined['PTS'].to_numpy() != joined['PTS_STORED'].to_numpy())
+
+    return list(joined.loc[moved, 'id'])
+
+
+def migrate_inactive(CONNECTION, player_ids):
+    """
+    Move the rows of players who left PLAYER_LIST_ACTIVE from PLAYERS_ACTIVE into PLAYERS_INACTIVE, with their
+    PLAYER_LIST_INACTIVE info, instead of rebuilding PLAYERS_INACTIVE. Players in neither list are only removed.
+    Does not commit.
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param player_ids: List of ids no longer in PLAYER_LIST_ACTIVE
+    :return: Number of players moved to PLAYERS_INACTIVE
+    """
+    if not player_ids:
+        return 0
+
+    keys = [(int(id),) for id in player_ids]
+    placeholders = ', '.join('?' for _ in keys)
+    rows = pd.read_sql_query(f'SELECT * FROM PLAYERS_ACTIVE WHERE id IN ({placeholders})', CONNECTION, params=[k[0] for k in keys])
+    info = pd.read_sql_query(f'SELECT {", ".join(PLAYER_INFO_COLUMNS)} FROM PLAYER_LIST_INACTIVE WHERE id IN ({placeholders})',
+                             CONNECTION, params=[k[0] for k in keys])
+
+    # PLAYERS_INACTIVE keeps the rows of players without a career unkeyed, as the inactive rebuild writes them
+    rows = rows.drop(columns=PLAYER_INFO_COLUMNS[1:]).merge(info, on='id')
+    placeholder = rows['SEASON_ID'] == ''
+    rows['SEASON_ID'] = rows['SEASON_ID'].mask(placeholder)
+    rows['TEAM_ID'] = rows['TEAM_ID'].mask(placeholder)
+
+    if table_exists(CONNECTION, 'PLAYERS_INACTIVE'):
+        CONNECTION.executemany('DELETE FROM PLAYERS_INACTIVE WHERE id = ?', keys)
+        bump_version(CONNECTION, 'PLAYERS_INACTIVE')
+    insert_frame(rows, 'PLAYERS_INACTIVE', CONNECTION)
+    CONNECTION.executemany('DELETE FROM PLAYERS_ACTIVE WHERE id = ?', keys)
+    bump_version(CONNECTION, 'PLAYERS_ACTIVE')
+
+    return int(rows['id'].nunique())
+
+
+def update_incremental(CONNECTION, season=CURRENT_SEASON):
+    """
+    Bring PLAYERS_ACTIVE up to date without refetching every career. Prior-season rows are frozen: players whose
+    season line moved in LEAGUE_PLAYER_STATS_CURRENT are refetched and only their current-season rows replaced,
+    players new to PLAYER_LIST_ACTIVE get their whole career, and players who left it are migrated to PLAYERS_INACTIVE
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param season: str representing the current season, in the format 'YYYY-YY'
+    :return: Number of rows written
+    """
+    player_info = pd.read_sql_query(f'SELECT {", ".join(PLAYER_INFO_COLUMNS)} FROM PLAYER_LIST_ACTIVE', CONNECTION)
+    stored_ids = set(pd.read_sql_query('SELECT DISTINCT id FROM PLAYERS_ACTIVE', CONNECTION)['id'])
+    active_ids = set(player_info['id'])
+
+    new_ids = active_ids - stored_ids
+    changed_ids = set(changed_players(CONNECTION, season)) & active_ids - new_ids
+    moved = migrate_inactive(CONNECTION, sorted(stored_ids - active_ids))
+    written = moved
+
+    player_ids = sorted(new_ids | changed_ids)
+    if player_ids:
+        allplayerseasons = download_allplayerseasons(player_ids, CONNECTION, DELTA_QUEUE_NAME, DELTA_STAGING_TABLE, refresh=True)
+        # Players that failed to download keep their stored rows and are retried by the next run
+        fetched = WorkQueue(CONNECTION, DELTA_QUEUE_NAME, player_ids).completed
+        if not allplayerseasons.empty:
+            frozen = ~allplayerseasons['PLAYER_ID'].isin(new_ids) & (allplayerseasons['SEASON_ID'] != season)
+            allplayerseasons = allplayerseasons[~frozen.to_numpy()]
+        allplayerseasons = fill_keys(allplayerseasons.merge(player_info[player_info['id'].isin(fetched)],
+                                                            how='right', left_on='PLAYER_ID', right_on='id'))
+
+        counts = upsert(allplayerseasons, 'PLAYERS_ACTIVE', CONNECTION, KEY, commit=False)
+        written += rows_written(counts)
+
+        # Current-season and empty-career rows of the refetched players that the new download no longer has
+        refetched = changed_ids & fetched
+        incoming = set(allplayerseasons[KEY].itertuples(index=False, name=None))
+        stale = [key for key in CONNECTION.execute("SELECT id, SEASON_ID, TEAM_ID FROM PLAYERS_ACTIVE WHERE SEASON_ID IN (?, '')", (season,))
+                 if key[0] in refetched and key not in incoming]
+        CONNECTION.executemany('DELETE FROM PLAYERS_ACTIVE WHERE id = ? AND SEASON_ID = ? AND TEAM_ID = ?', stale)
+        if stale:
+            bump_version(CONNECTION, 'PLAYERS_ACTIVE', pd.DataFrame(stale, columns=KEY))
+        written += len(stale)
+        print(format_counts('PLAYERS_ACTIVE', {**counts, 'deleted': len(stale)}))
+
+    CONNECTION.commit()
+    clear_queue(CONNECTION, DELTA_QUEUE_NAME, DELTA_STAGING_TABLE)
+    print(f'{get_current_time()}: {len(changed_ids)} players changed, {len(new_ids)} new, {moved} moved to PLAYERS_INACTIVE')
+
+    return written
+
+
+def main(incremental=True):
+    """
+    Update PLAYERS_ACTIVE incrementally, or download the careers of all players in PLAYER_LIST_ACTIVE and upsert
+    them into PLAYERS_ACTIVE. The full download runs when incremental is False or there is nothing to build on yet
+
+    :param incremental: Whether to use update_incremental when PLAYERS_ACTIVE and LEAGUE_PLAYER_STATS_CURRENT exist
+    :return: Number of rows written
+    """
     with connect() as conn:
-        player_info = pd.read_sql_query("SELECT id, full_name, first_name, last_name, is_active FROM PLAYER_LIST_ACTIVE", conn, params=())
+        if incremental and table_exists(conn, 'PLAYERS_ACTIVE') and table_exists(conn, 'LEAGUE_PLAYER_STATS_CURRENT'):
+            written = update_incremental(conn)
+            print(F'{get_current_time()}: Updated Active Players Table (incremental)')
+            print(cache_summary())
+            sync_tables(conn, ['PLAYERS_ACTIVE', 'PLAYERS_INACTIVE'])
+            return written
+
+        player_info = pd.read_sql_query(f'SELECT {", ".join(PLAYER_INFO_COLUMNS)} FROM PLAYER_LIST_ACTIVE', conn)
         player_ids = list(player_info['id'])
 
-        allplayerseasons = download_allplayerseasons(player_ids)
-        allplayerseasons = allplayerseasons.merge(player_info, how='right', left_on='PLAYER_ID', right_on='id')
+        allplayerseasons = download_allplayerseasons(player_ids, conn)
+        fetched = WorkQueue(conn, QUEUE_NAME, player_ids).completed
+        allplayerseasons = fill_keys(allplayerseasons.merge(player_info[player_info['id'].isin(fetched)],
+                                                            how='right', left_on='PLAYER_ID', right_on='id'))
 
-        allplayerseasons.to_sql('PLAYERS_ACTIVE', conn, if_exists='replace')
-        print(F'{get_current_time()}: Updated Active Players Table')
+        # Players that failed to download keep their stored rows, and the queue is kept so the next run resumes them
+        complete = len(fetched) == len(player_info)
+        counts = upsert(allplayerseasons, 'PLAYERS_ACTIVE', conn, KEY, delete_missing=complete)
+        if complete:
+            clear_queue(conn, QUEUE_NAME, STAGING_TABLE)
+        else:
+            print(f'{get_current_time()}: {len(player_info) - len(fetched)} active players missing, kept for the next run')
+        print(F'{get_current_time()}: Updated Active Players Table ({format_counts("PLAYERS_ACTIVE", counts)})')
+        print(cache_summary())
+        sync_tables(conn, ['PLAYERS_ACTIVE'])
+
+    return rows_written(counts)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,50 @@
 import pandas as pd
 from nba_api.stats.endpoints import playercareerstats
 from connect_sqlite import connect, get_current_time
+from frame_accumulator import FrameAccumulator
+from metrics import measure
+from parquet_store import sync_tables
+from sql_writer import bump_version
+from response_cache import NEVER, cached_call, cache_summary
+from work_queue import WorkQueue, clear_queue, read_staging
 
+QUEUE_NAME = 'players_inactive'
+STAGING_TABLE = 'PLAYERS_INACTIVE_STAGING'
 
-def download_allplayerseasons(player_ids):
+
+def download_allplayerseasons(player_ids, CONNECTION):
     """
-    Download regular season player statistics for all inactive NBA players
+    Download regular season player statistics for all inactive NBA players. Each player's rows are staged in
+    PLAYERS_INACTIVE_STAGING together with a WorkQueue completion mark, so an interrupted run resumes where it stopped.
+    A player that keeps failing is left pending in the queue and missing from the result
+
     :param player_ids: List of ids of inactive players
+    :param CONNECTION: Connection object representing the connection to the SQLite database
     :return: DataFrame of all regular season player statistics for the given player IDs, with additional columns for PPG, RPG, and APG
     """
 
-    allplayerseasons = pd.DataFrame()
+    queue = WorkQueue(CONNECTION, QUEUE_NAME, player_ids)
+    # Completion marks are held in memory and written by the flush that writes the players' rows, so no write
+    # transaction stays open across the requests
+    staged = FrameAccumulator(STAGING_TABLE, CONNECTION, flush_rows=500, on_flush=queue.write_marks, index=False)
 
-    while len(player_ids) > 0:
+    for id in queue:
         try:
-            id = player_ids[-1]
-
-            if len(allplayerseasons) == 0:
-                playercareer = playercareerstats.PlayerCareerStats(player_id=id, timeout=100)
-                allplayerseasons = playercareer.get_data_frames()[0]
+            # Careers of retired players cannot change, so their responses never expire
+            result = cached_call(playercareerstats.PlayerCareerStats, ttl=NEVER, player_id=id, timeout=100)[0]
 
-            elif id not in list(allplayerseasons['PLAYER_ID']):
-                playercareer = playercareerstats.PlayerCareerStats(player_id=id, timeout=100)
-                allplayerseasons = pd.concat([allplayerseasons, playercareer.get_data_frames()[0]])
-
-            player_ids.pop()
+            queue.done(id, defer=True)
+            staged.add(result)
 
         except Exception as e:
             print(f'Error downloading inactive player {id}: {e}')
-            continue
+            if not queue.retry(id):
+                print(f'{get_current_time()}: Giving up on inactive player {id} until the next run')
 
+    staged.close()
+    allplayerseasons = read_staging(CONNECTION, STAGING_TABLE)
+    if allplayerseasons.empty:
+        return allplayerseasons.reindex(columns=['PLAYER_ID', 'SEASON_ID', 'TEAM_ID'])
 
     allplayerseasons['PPG'] = allplayerseasons['PTS']/allplayerseasons['GP']
     allplayerseasons['RPG'] = allplayerseasons['REB']/allplayerseasons['GP']
@@ -38,14 +53,34 @@ def download_allplayerseasons(player_ids):
     return allplayerseasons
 
 
-if __name__ == '__main__':
+def main():
+    """
+    Download the careers of all players in PLAYER_LIST_INACTIVE and rebuild PLAYERS_INACTIVE
 
+    :return: Number of rows written
+    """
     with connect() as conn:
         player_info = pd.read_sql_query("SELECT id, full_name, first_name, last_name, is_active FROM PLAYER_LIST_INACTIVE", conn, params=())
         player_ids = list(player_info['id'])
 
-        allplayerseasons = download_allplayerseasons(player_ids)
+        allplayerseasons = download_allplayerseasons(player_ids, conn)
+        missing = len(WorkQueue(conn, QUEUE_NAME, player_ids))
+        if missing:
+            # Rebuilding now would drop the careers of the missing players, so the staged rows wait for the next run
+            print(f'{get_current_time()}: {missing} inactive players missing, PLAYERS_INACTIVE kept for the next run')
+            return 0
         allplayerseasons = allplayerseasons.merge(player_info, how='right', left_on='PLAYER_ID', right_on='id')
 
-        allplayerseasons.to_sql('PLAYERS_INACTIVE', conn, if_exists='replace')
+        with measure('write', 'PLAYERS_INACTIVE', rows=len(allplayerseasons)):
+            bump_version(conn, 'PLAYERS_INACTIVE')
+            allplayerseasons.to_sql('PLAYERS_INACTIVE', conn, if_exists='replace')
+        clear_queue(conn, QUEUE_NAME, STAGING_TABLE)
         print(F'{get_current_time()}: Updated Inactive Players Table')
+        print(cache_summary())
+        sync_tables(conn, ['PLAYERS_INACTIVE'])
+
+    return len(allplayerseasons)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from nba_api.stats.endpoints import shotchartdetail
+from config import CURRENT_SEASON
+from connect_sqlite import connect, get_current_time
+from download_league_player_stats import get_seasons
+from parquet_store import sync_tables
+from response_cache import cached_call, season_ttl, cache_summary
+from schema import apply_schema
+from sql_writer import bump_version, ensure_table, ensure_unique_index, frame_rows, insert_frame, read_rows, table_exists
+from work_queue import WorkQueue
+
+SHOTS_TABLE = 'SHOTS'
+HEXBIN_TABLE = 'SHOT_HEXBINS'
+ZONE_TABLE = 'SHOT_ZONES'
+# Completed past seasons, by start year
+QUEUE_NAME = 'shots'
+FIRST_SEASON = 1996
+
+SHOT_KEY = ['GAME_ID', 'GAME_EVENT_ID']
+# Columns kept from ShotChartDetail. Names, GRID_TYPE, EVENT_TYPE, SHOT_ATTEMPTED_FLAG, HTM and VTM are redundant
+SHOT_COLUMNS = SHOT_KEY + ['PLAYER_ID', 'TEAM_ID', 'SEASON', 'GAME_DATE', 'PERIOD', 'MINUTES_REMAINING',
+                           'SECONDS_REMAINING', 'ACTION_TYPE', 'SHOT_TYPE', 'SHOT_ZONE_BASIC', 'SHOT_ZONE_AREA',
+                           'SHOT_ZONE_RANGE', 'SHOT_DISTANCE', 'LOC_X', 'LOC_Y', 'SHOT_MADE_FLAG']
+ZONE_COLUMNS = ['SHOT_ZONE_BASIC', 'SHOT_ZONE_AREA', 'SHOT_ZONE_RANGE']
+
+# Hexbin grid of analysis/Shotchart.ipynb: LOC_Y is shifted by Y_OFFSET so the baseline is at 0
+GRID_SIZE = (30, 30)
+GRID_EXTENT = (-300, 300, 0, 940)
+Y_OFFSET = 60
+
+# Aggregate scopes. LEAGUE rows have ID 0
+SCOPES = {'PLAYER': 'PLAYER_ID', 'TEAM': 'TEAM_ID', 'LEAGUE': None}
+
+
+def hexbin_cells(x, y, gridsize=GRID_SIZE, extent=GRID_EXTENT):
+    """
+    Assign points to the cells of a hexagonal grid the way matplotlib's hexbin does: two offset rectangular lattices,
+    each point going to the nearer lattice point
+
+    :param x: 1D numpy array of x coordinates
+    :param y: 1D numpy array of y coordinates
+    :param gridsize: Tuple of (number of hexagons in x, number in y)
+    :param extent: Tuple of (xmin, xmax, ymin, ymax)
+    :return: 1D numpy array of cell ids, -1 for points outside the grid
+    """
+    nx, ny = gridsize
+    xmin, xmax, ymin, ymax = extent
+    ix = (np.asarray(x, dtype=float) - xmin) / ((xmax - xmin) / nx)
+    iy = (np.asarray(y, dtype=float) - ymin) / ((ymax - ymin) / ny)
+
+    ix1, iy1 = np.round(ix).astype(int), np.round(iy).astype(int)
+    ix2, iy2 = np.floor(ix).astype(int), np.floor(iy).astype(int)
+    first = (ix - ix1) ** 2 + 3.0 * (iy - iy1) ** 2 < (ix - ix2 - 0.5) ** 2 + 3.0 * (iy - iy2 - 0.5) ** 2
+
+    # Cells of the first lattice come first: (nx + 1) * (ny + 1) of them, then nx * ny of the second
+    inside1 = (ix1 >= 0) & (ix1 <= nx) & (iy1 >= 0) & (iy1 <= ny)
+    inside2 = (ix2 >= 0) & (ix2 < nx) & (iy2 >= 0) & (iy2 < ny)
+    cell1 = ix1 * (ny + 1) + iy1
+    cell2 = (nx + 1) * (ny + 1) + ix2 * ny + iy2
+
+    return np.where(first, np.where(inside1, cell1, -1), np.where(inside2, cell2, -1))
+
+
+def cell_centers(gridsize=GRID_SIZE, extent=GRID_EXTENT):
+    """
+    :param gridsize: Tuple of (number of hexagons in x, number in y)
+    :param extent: Tuple of (xmin, xmax, ymin, ymax)
+    :return: Tuple of 1D numpy arrays (x, y) of the center of every cell, indexed by cell id
+    """
+    nx, ny = gridsize
+    xmin, xmax, ymin, ymax = extent
+    sx, sy = (xmax - xmin) / nx, (ymax - ymin) / ny
+
+    i1, j1 = np.meshgrid(np.arange(nx + 1), np.arange(ny + 1), indexing='ij')
+    i2, j2 = np.meshgrid(np.arange(nx), np.arange(ny), indexing='ij')
+    x = np.concatenate([xmin + i1.ravel() * sx, xmin + (i2.ravel() + 0.5) * sx])
+    y = np.concatenate([ymin + j1.ravel() * sy, ymin + (j2.ravel() + 0.5) * sy])
+
+    return x, y
+
+
+def compact_shots(df, season):
+    """
+    :param df: Shot_Chart_Detail frame returned by ShotChartDetail
+    :param season: str representing a season, in the format 'YYYY-YY'
+    :return: DataFrame of SHOT_COLUMNS with GAME_DATE as 'YYYY-MM-DD' like ALL_GAMES_UNMERGED, in compact dtypes
+    """
+    df = df.assign(SEASON=season)
+    df['GAME_DATE'] = pd.to_datetime(df['GAME_DATE'].astype(str), format='%Y%m%d').dt.strftime('%Y-%m-%d')
+
+    return apply_schema(df[SHOT_COLUMNS], SHOTS_TABLE, lossless=True)
+
+
+def aggregate_shots(shots):
+    """
+    Count attempts and makes per hexbin cell and per shot zone, for every player, team and the league in each season
+
+    :param shots: DataFrame of SHOT_COLUMNS
+    :return: Tuple of (hexbin DataFrame keyed on SCOPE, ID, SEASON, CELL; zone DataFrame keyed on SCOPE, ID, SEASON
+        and ZONE_COLUMNS), both with FGA and FGM columns
+    """
+    shots = shots.assign(CELL=hexbin_cells(shots['LOC_X'].to_numpy(), shots['LOC_Y'].to_numpy() + Y_OFFSET),
+                         FGA=1, FGM=shots['SHOT_MADE_FLAG'].astype(int))
+
+    hexbins, zones = [], []
+    for scope, id_col in SCOPES.items():
+        ids = shots[id_col] if id_col else 0
+        scoped = shots.assign(SCOPE=scope, ID=ids)
+        hexbins.append(scoped[scoped['CELL'] >= 0].groupby(['SCOPE', 'ID', 'SEASON', 'CELL'], as_index=False)[['FGA', 'FGM']].sum())
+        zones.append(scoped.groupby(['SCOPE', 'ID', 'SEASON'] + ZONE_COLUMNS, as_index=False)[['FGA', 'FGM']].sum())
+
+    return pd.concat(hexbins, ignore_index=True), pd.concat(zones, ignore_index=True)
+
+
+def add_counts(df, table, CONNECTION, key):
+    """
+    Add FGA and FGM counts to an aggregate table, inserting new keys and incrementing existing ones, and keep FG_PCT
+    in step. Does not commit.
+
+    :param df: DataFrame of the key columns, FGA and FGM
+    :param table: Aggregate table name
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param key: List of key column names
+    """
+    df = df.assign(FG_PCT=df['FGM'] / df['FGA'])
+    ensure_table(df, table, CONNECTION)
+    ensure_unique_index(CONNECTION, table, key)
+
+    names = ', '.join(f'"{col}"' for col in df.columns)
+    placeholders = ', '.join('?' for _ in df.columns)
+    CONNECTION.executemany(
+        f'INSERT INTO "{table}" ({names}) VALUES ({placeholders}) ON CONFLICT ({", ".join(key)}) DO UPDATE SET '
+        'FGA = FGA + excluded.FGA, FGM = FGM + excluded.FGM, '
+        'FG_PCT = CAST(FGM + excluded.FGM AS REAL) / (FGA + excluded.FGA)',
+        frame_rows(df))
+    bump_version(CONNECTION, table, df)
+
+
+def ingest_shots(shots, CONNECTION):
+    """
+    Insert the shots not yet in SHOTS and add them to the hexbin and zone aggregates, in the caller's transaction.
+    Shots already stored are skipped, so overlapping downloads never count a shot twice.
+
+    :param shots: DataFrame of SHOT_COLUMNS
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :return: Number of shots added
+    """
+    shots = shots.drop_duplicates(subset=SHOT_KEY)
+    if table_exists(CONNECTION, SHOTS_TABLE):
+        keys = frame_rows(shots[SHOT_KEY])
+        existing = read_rows(CONNECTION, SHOTS_TABLE, SHOT_KEY, SHOT_KEY, keys)
+        shots = shots[[key not in existing for key in keys]]
+    if shots.empty:
+        return 0
+
+    insert_frame(shots, SHOTS_TABLE, CONNECTION)
+    ensure_unique_index(CONNECTION, SHOTS_TABLE, SHOT_KEY)
+
+    hexbins, zones = aggregate_shots(shots)
+    add_counts(hexbins, HEXBIN_TABLE, CONNECTION, ['SCOPE', 'ID', 'SEASON', 'CELL'])
+    add_counts(zones, ZONE_TABLE, CONNECTION, ['SCOPE', 'ID', 'SEASON'] + ZONE_COLUMNS)
+
+    return len(shots)
+
+
+def fetch_season_shots(season, date_from=''):
+    """
+    Download every regular season shot of a season in a single request: ShotChartDetail with player and team 0
+    returns the whole league
+
+    :param season: str representing a season, in the format 'YYYY-YY'
+    :param date_from: Only return shots from games on or after this date, 'MM/DD/YYYY'. Default the whole season
+    :return: DataFrame of SHOT_COLUMNS
+    """
+    df = cached_call(shotchartdetail.ShotChartDetail, ttl=season_ttl(season), team_id=0, player_id=0,
+                     context_measure_simple='FGA', season_nullable=season, season_type_all_star='Regular Season',
+                     date_from_nullable=date_from, timeout=100)[0]
+
+    return compact_shots(df, season)
+
+
+def last_shot_date(CONNECTION, season):
+    """
+    :return: Latest GAME_DATE stored for the season as 'MM/DD/YYYY', or '' if none
+    """
+    if not table_exists(CONNECTION, SHOTS_TABLE):
+        return ''
+    date = CONNECTION.execute(f'SELECT MAX(GAME_DATE) FROM {SHOTS_TABLE} WHERE SEASON = ?', (season,)).fetchone()[0]
+
+    return datetime.strptime(date, '%Y-%m-%d').strftime('%m/%d/%Y') if date else ''
+
+
+def update_shots(CONNECTION, current_season=CURRENT_SEASON):
+    """
+    Backfill completed seasons one request each, skipping seasons finished by earlier runs, then add the current
+    season's shots from the last stored game date on. Each season is committed with its aggregates. A season that
+    keeps failing is left pending for the next run, so it never holds up the current season's update.
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param current_season: str representing the current season, in the format 'YYYY-YY'
+    :return: Number of shots added
+    """
+    past = get_seasons(START=FIRST_SEASON, END=int(current_season[:4]))
+    queue = WorkQueue(CONNECTION, QUEUE_NAME, [int(season[:4]) for season in past])
+
+    added = 0
+    for year in queue:
+        season = get_seasons(START=year, END=year + 1)[0]
+        try:
+            count = ingest_shots(fetch_season_shots(season), CONNECTION)
+            queue.done(year, commit=False)
+            CONNECTION.commit()
+        except Exception as e:
+            CONNECTION.rollback()
+            print(f'Error downloading shots of season {season}: {e}')
+            if not queue.retry(year):
+                print(f'{get_current_time()}: Giving up on shots of season {season} until the next run')
+            continue
+
+        print(f'{get_current_time()}: Added {count} shots from season {season} (PAST)')
+        added += count
+
+    # The last stored date is downloaded again, in case its games were still in progress. Stored shots are skipped
+    count = ingest_shots(fetch_season_shots(current_season, last_shot_date(CONNECTION, current_season)), CONNECTION)
+    CONNECTION.commit()
+    print(f'{get_current_time()}: Added {count} shots from season {current_season}')
+
+    return added + count
+
+
+def shot_chart(CONNECTION, scope, id, season):
+    """
+    Read the precomputed hexbin grid of a player, team or the league. Render with
+    ax.hexbin(chart['X'], chart['Y'], C=chart['FGA'], reduce_C_function=np.sum, gridsize=GRID_SIZE, extent=GRID_EXTENT)
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param scope: 'PLAYER', 'TEAM' or 'LEAGUE'
+    :param id: PLAYER_ID or TEAM_ID. Ignored for the league
+    :param season: str representing a season, in the format 'YYYY-YY'
+    :return: DataFrame of the non-empty cells: CELL, X, Y (cell center, LOC_Y + Y_OFFSET), FGA, FGM, FG_PCT
+    """
+    chart = pd.read_sql_query(f'SELECT CELL, FGA, FGM, FG_PCT FROM {HEXBIN_TABLE} WHERE SCOPE = ? AND ID = ? AND SEASON = ?',
+                              CONNECTION, params=(scope, 0 if scope == 'LEAGUE' else int(id), season))
+    x, y = cell_centers()
+    chart.insert(1, 'X', x[chart['CELL']])
+    chart.insert(2, 'Y', y[chart['CELL']])
+
+    return chart
+
+
+def zone_comparison(CONNECTION, player_id, season):
+    """
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param player_id: PLAYER_ID
+    :param season: str representing a season, in the format 'YYYY-YY'
+    :return: DataFrame of the player's FGA, FGM and FG_PCT per shot zone next to the league's FG_PCT
+    """
+    zones = ', '.join(f'p.{col}' for col in ZONE_COLUMNS)
+    join = ' AND '.join(f'l.{col} = p.{col}' for col in ZONE_COLUMNS)
+    return pd.read_sql_query(
+        f'SELECT {zones}, p.FGA, p.FGM, p.FG_PCT, l.FG_PCT AS LEAGUE_FG_PCT, p.FG_PCT - l.FG_PCT AS FG_PCT_DIFF '
+        f'FROM {ZONE_TABLE} p JOIN {ZONE_TABLE} l ON l.SCOPE = \'LEAGUE\' AND l.ID = 0 AND l.SEASON = p.SEASON AND {join} '
+        f'WHERE p.SCOPE = \'PLAYER\' AND p.ID = ? AND p.SEASON = ? ORDER BY p.FGA DESC',
+        CONNECTION, params=(int(player_id), season))
+
+
+def main():
+    """
+    Bring SHOTS and its hexbin and zone aggregates up to date
+
+    :return: Number of shots added
+    """
+    with connect() as conn:
+        added = update_shots(conn)
+        print(cache_summary())
+        sync_tables(conn, [SHOTS_TABLE])
+
+    return added
+
+
+if __name__ == '__main__':
+    main()
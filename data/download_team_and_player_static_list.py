@@ -1,6 +1,8 @@
 import pandas as pd
 from nba_api.stats.static import teams, players
 from connect_sqlite import connect
+from parquet_store import sync_tables
+from sql_writer import format_counts, rows_written, upsert
 
 def download_static(conn):
     """
@@ -8,26 +10,44 @@ def download_static(conn):
         - List of NBA Teams
         - List of Active Players
         - List of Inactive Players
-    Saves to separate table in connected SQLite database
+    Saves to separate table in connected SQLite database, keyed on id
 
     :param conn: Connection object representing the connection to the SQLite database
+    :return: Number of rows written
     """
     team_list = pd.DataFrame(teams.get_teams())
-    team_list = team_list.set_index('id')
-    team_list.to_sql('TEAM_LIST', conn, if_exists='replace')
+    counts = upsert(team_list, 'TEAM_LIST', conn, ['id'], delete_missing=True)
+    print(format_counts('TEAM_LIST', counts))
+    written = rows_written(counts)
 
     active_player_list = pd.DataFrame(players.get_active_players())
-    active_player_list = active_player_list.set_index('id')
-    active_player_list.to_sql('PLAYER_LIST_ACTIVE', conn, if_exists='replace')
+    counts = upsert(active_player_list, 'PLAYER_LIST_ACTIVE', conn, ['id'], delete_missing=True)
+    print(format_counts('PLAYER_LIST_ACTIVE', counts))
+    written += rows_written(counts)
 
     inactive_player_list = pd.DataFrame(players.get_inactive_players())
-    inactive_player_list = inactive_player_list.set_index('id')
-    inactive_player_list.to_sql('PLAYER_LIST_INACTIVE', conn, if_exists='replace')
+    counts = upsert(inactive_player_list, 'PLAYER_LIST_INACTIVE', conn, ['id'], delete_missing=True)
+    print(format_counts('PLAYER_LIST_INACTIVE', counts))
+    written += rows_written(counts)
 
-if __name__ == '__main__':
+    return written
+
+def main():
+    """
+    Download the static team and player lists into the database
+
+    :return: Number of rows written
+    """
     with connect() as conn:
-        download_static(conn)
+        written = download_static(conn)
+        sync_tables(conn, ['TEAM_LIST', 'PLAYER_LIST_ACTIVE', 'PLAYER_LIST_INACTIVE'])
 
     print('Updated Team List')
     print('Updated Active Player List')
-    print('Updated Inactive Player List')
\ No newline at end of file
+    print('Updated Inactive Player List')
+
+    return written
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,496 @@
+import random
+import sqlite3
+import time
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from nba_api.stats.endpoints import alltimeleadersgrids, leaguedashplayerstats, leaguegamefinder, playercareerstats, \
+    playerdashptshots, shotchartdetail
+from nba_api.stats.static import players, teams
+import metrics
+
+# Simulated network behaviour, changed with configure()
+LATENCY = (0.05, 0.25)
+FAILURE_RATE = 0.1
+
+# Simulated league size, changed with configure(): players in the static lists (the first N_ACTIVE of them active),
+# and seasons of game history ending with LAST_SEASON
+N_PLAYERS = 5000
+N_ACTIVE = 500
+N_SEASONS = 40
+LAST_SEASON = 2022
+GAMES_PER_SEASON = 1230
+FIRST_PLAYER_ID = 1000
+
+GAME_STAT_COLUMNS = ['MIN', 'FGM', 'FGA', 'FG_PCT', 'FG3M', 'FG3A', 'FG3_PCT', 'FTM', 'FTA', 'FT_PCT', 'OREB', 'DREB',
+                     'REB', 'AST', 'STL', 'BLK', 'TOV', 'PF']
+BOX_COLUMNS = ['FGM', 'FGA', 'FG_PCT', 'FG3M', 'FG3A', 'FG3_PCT', 'FTM', 'FTA', 'FT_PCT', 'OREB', 'DREB', 'REB', 'AST',
+               'STL', 'BLK', 'TOV', 'PF', 'PTS']
+LEADER_CATEGORIES = ['GP', 'PTS', 'AST', 'STL', 'OREB', 'DREB', 'REB', 'BLK', 'FGM', 'FGA', 'FG_PCT', 'TOV', 'FG3M',
+                     'FG3A', 'FG3_PCT', 'PF', 'FTM', 'FTA', 'FT_PCT']
+
+SHOT_COLUMNS = ['FGA_FREQUENCY', 'FGM', 'FGA', 'FG_PCT', 'EFG_PCT', 'FG2A_FREQUENCY', 'FG2M', 'FG2A', 'FG2_PCT',
+                'FG3A_FREQUENCY', 'FG3M', 'FG3A', 'FG3_PCT']
+
+# Field goal attempts per team game returned by ShotChartDetail, roughly the league's
+SHOTS_PER_GAME = (75, 95)
+ACTION_TYPES = ['Jump Shot', 'Layup Shot', 'Driving Layup Shot', 'Pullup Jump shot', 'Step Back Jump shot',
+                'Dunk Shot', 'Floating Jump shot', 'Tip Layup Shot']
+
+# (range column, values) for each of the seven PlayerDashPtShots result sets, in response order
+PT_SHOT_GROUPS = [
+    ('SHOT_TYPE', ['Overall']),
+    ('SHOT_TYPE', ['Catch and Shoot', 'Pull Ups', 'Less than 10 ft', 'Other']),
+    ('SHOT_CLOCK_RANGE', ['24-22', '22-18 Very Early', '18-15 Early', '15-7 Average', '7-4 Late', '4-0 Very Late']),
+    ('DRIBBLE_RANGE', ['0 Dribbles', '1 Dribble', '2 Dribbles', '3-6 Dribbles', '7+ Dribbles']),
+    ('CLOSE_DEF_DIST_RANGE', ['0-2 Feet - Very Tight', '2-4 Feet - Tight', '4-6 Feet - Open', '6+ Feet - Wide Open']),
+    ('CLOSE_DEF_DIST_RANGE', ['0-2 Feet - Very Tight', '2-4 Feet - Tight', '4-6 Feet - Open', '6+ Feet - Wide Open']),
+    ('TOUCH_TIME_RANGE', ['Touch < 2 Seconds', 'Touch 2-6 Seconds', 'Touch 6+ Seconds']),
+]
+
+
+class FakeEndpointError(Exception):
+    pass
+
+
+def configure(latency=None, failure_rate=None, seed=None, n_players=None, n_active=None, n_seasons=None):
+    """
+    Change the simulated network behaviour and league size of every fake endpoint
+
+    :param latency: (min, max) seconds each request sleeps before responding
+    :param failure_rate: Probability in [0, 1] that a request raises FakeEndpointError
+    :param seed: Seed for the random generators, for reproducible runs
+    :param n_players: Number of players in the static player lists
+    :param n_active: Number of those players that are active
+    :param n_seasons: Number of seasons of game history returned by LeagueGameFinder
+    """
+    global LATENCY, FAILURE_RATE, N_PLAYERS, N_ACTIVE, N_SEASONS
+    if latency is not None:
+        LATENCY = latency
+    if failure_rate is not None:
+        FAILURE_RATE = failure_rate
+    if seed is not None:
+        random.seed(seed)
+    if n_players is not None:
+        N_PLAYERS = n_players
+    if n_active is not None:
+        N_ACTIVE = n_active
+    if n_seasons is not None:
+        N_SEASONS = n_seasons
+
+
+def simulate_request():
+    """
+    Sleep for a random latency and fail with probability FAILURE_RATE, like a flaky stats.nba.com
+    """
+    time.sleep(random.uniform(*LATENCY))
+    if random.random() < FAILURE_RATE:
+        raise FakeEndpointError('Simulated timeout from fake endpoint')
+
+
+def shot_frames(player_id):
+    """
+    Build the seven canned PlayerDashPtShots frames for a player
+
+    :param player_id: Player ID
+    :return: List of seven DataFrames
+    """
+    rng = np.random.default_rng(int(player_id))
+    frames = []
+    for range_col, values in PT_SHOT_GROUPS:
+        n = len(values)
+        df = pd.DataFrame({
+            'PLAYER_ID': player_id,
+            'PLAYER_NAME_LAST_FIRST': f'Player, {player_id}',
+            'SORT_ORDER': np.arange(1, n + 1),
+            'GP': 60,
+            'G': 60,
+            range_col: values,
+        })
+        for col in SHOT_COLUMNS:
+            df[col] = rng.random(n) if col.endswith(('PCT', 'FREQUENCY')) else rng.integers(0, 500, n)
+        frames.append(df)
+
+    return frames
+
+
+def season_name(year):
+    """
+    :return: Season starting in the given year, in the format 'YYYY-YY'
+    """
+    return f'{year}-{str(year + 1)[2:]}'
+
+
+@lru_cache(maxsize=8)
+def player_list(n_players, n_active):
+    """
+    Build the static player list: dicts with id, full_name, first_name, last_name and is_active, like
+    nba_api.stats.static.players.get_players()
+
+    :param n_players: Number of players
+    :param n_active: Number of active players, the ones with the highest IDs
+    :return: List of dicts
+    """
+    rng = np.random.default_rng(n_players)
+    first_names = ['James', 'Chris', 'Kevin', 'Anthony', 'Marcus', 'Jalen', 'Tyrese', 'Luka', 'Nikola', 'Stephen']
+    last_names = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Miller', 'Davis', 'Wilson', 'Moore', 'Taylor',
+                  'Thomas', 'Jackson', 'White', 'Harris', 'Martin', 'Thompson', 'Young', 'Allen', 'King', 'Green']
+    firsts = rng.choice(first_names, n_players)
+    lasts = rng.choice(last_names, n_players)
+
+    return [{'id': FIRST_PLAYER_ID + i, 'full_name': f'{first} {last} {i}', 'first_name': first,
+             'last_name': f'{last} {i}', 'is_active': i >= n_players - n_active}
+            for i, (first, last) in enumerate(zip(firsts, lasts))]
+
+
+def get_players():
+    return [dict(player) for player in player_list(N_PLAYERS, N_ACTIVE)]
+
+
+def get_active_players():
+    return [player for player in get_players() if player['is_active']]
+
+
+def get_inactive_players():
+    return [player for player in get_players() if not player['is_active']]
+
+
+def player_team(player_id, season):
+    """
+    :return: Team ID a player played for in a season, stable within the season
+    """
+    team_ids = [team['id'] for team in teams.get_teams()]
+    return team_ids[(int(player_id) * 7 + int(season[:4])) % len(team_ids)]
+
+
+@lru_cache(maxsize=8)
+def league_games(n_seasons, last_season=LAST_SEASON):
+    """
+    Build the league's game history shaped like LeagueGameFinder output: two rows per game, one per team, with
+    GAME_IDs, dates and matchups consistent between the two rows
+
+    :param n_seasons: Number of seasons, ending with last_season
+    :param last_season: Start year of the last season
+    :return: DataFrame of team games, newest first
+    """
+    rng = np.random.default_rng(n_seasons)
+    nba_teams = pd.DataFrame(teams.get_teams())
+    team_ids = nba_teams['id'].to_numpy()
+    abbreviations = nba_teams['abbreviation'].to_numpy()
+    names = nba_teams['full_name'].to_numpy()
+
+    years = np.repeat(np.arange(last_season - n_seasons + 1, last_season + 1), GAMES_PER_SEASON)
+    n_games = len(years)
+    number = np.tile(np.arange(1, GAMES_PER_SEASON + 1), n_seasons)
+    home = rng.integers(0, len(team_ids), n_games)
+    away = (home + rng.integers(1, len(team_ids), n_games)) % len(team_ids)
+    home_pts = rng.integers(80, 140, n_games)
+    away_pts = rng.integers(80, 140, n_games)
+    away_pts = np.where(away_pts == home_pts, away_pts + 1, away_pts)
+    days = np.sort(rng.integers(0, 170, (n_seasons, GAMES_PER_SEASON)), axis=1).ravel()
+    dates = pd.to_datetime(years.astype(str) + '-10-20') + pd.to_timedelta(days, unit='D')
+    game_ids = ['002' + f'{year % 100:02d}' + f'{n:05d}' for year, n in zip(years, number)]
+
+    def side(team, opp, pts, opp_pts, sep):
+        df = pd.DataFrame({
+            'SEASON_ID': (20000 + years).astype(str),
+            'TEAM_ID': team_ids[team],
+            'TEAM_ABBREVIATION': abbreviations[team],
+            'TEAM_NAME': names[team],
+            'GAME_ID': game_ids,
+            'GAME_DATE': dates.strftime('%Y-%m-%d'),
+            'MATCHUP': np.char.add(np.char.add(abbreviations[team].astype(str), sep), abbreviations[opp].astype(str)),
+            'WL': np.where(pts > opp_pts, 'W', 'L'),
+        })
+        for col in GAME_STAT_COLUMNS:
+            df[col] = rng.random(n_games).round(3) if col.endswith('_PCT') else rng.integers(0, 60, n_games)
+        df['MIN'] = 240
+        df['PTS'] = pts
+        df['PLUS_MINUS'] = (pts - opp_pts).astype(float)
+        return df
+
+    games = pd.concat([side(home, away, home_pts, away_pts, ' vs. '), side(away, home, away_pts, home_pts, ' @ ')])
+    return games.sort_values(by='GAME_DATE', ascending=False, kind='stable').reset_index(drop=True)
+
+
+class LeagueGameFinder:
+    """
+    Stand-in for nba_api's LeagueGameFinder over league_games, filtered by team and start date
+    """
+
+    def __init__(self, team_id_nullable=None, date_from_nullable=None, league_id_nullable=None, timeout=30, **kwargs):
+        simulate_request()
+        games = league_games(N_SEASONS)
+        if team_id_nullable:
+            games = games[games['TEAM_ID'] == int(team_id_nullable)]
+        if date_from_nullable:
+            start = pd.to_datetime(date_from_nullable, format='%m/%d/%Y').strftime('%Y-%m-%d')
+            games = games[games['GAME_DATE'] >= start]
+        self.data_frames = [games.reset_index(drop=True)]
+
+    def get_data_frames(self):
+        return [df.copy() for df in self.data_frames]
+
+
+class LeagueDashPlayerStats:
+    """
+    Stand-in for nba_api's LeagueDashPlayerStats: one row per player of a season, about 500 players
+    """
+
+    def __init__(self, season=None, timeout=30, **kwargs):
+        simulate_request()
+        season = season or season_name(LAST_SEASON)
+        rng = np.random.default_rng(int(season[:4]))
+        roster = pd.DataFrame(get_players())
+        roster = roster[rng.random(len(roster)) < min(1.0, 500 / max(len(roster), 1))]
+        n = len(roster)
+
+        df = pd.DataFrame({
+            'PLAYER_ID': roster['id'].to_numpy(),
+            'PLAYER_NAME': roster['full_name'].to_numpy(),
+            'TEAM_ID': [player_team(id, season) for id in roster['id']],
+            'AGE': rng.integers(19, 40, n).astype(float),
+            'GP': rng.integers(1, 83, n),
+        })
+        df['TEAM_ABBREVIATION'] = df['TEAM_ID'].map({team['id']: team['abbreviation'] for team in teams.get_teams()})
+        df['W'] = rng.integers(0, df['GP'] + 1)
+        df['L'] = df['GP'] - df['W']
+        df['W_PCT'] = (df['W'] / df['GP']).round(3)
+        df['MIN'] = (df['GP'] * rng.uniform(2, 38, n)).round(1)
+        for col in BOX_COLUMNS:
+            df[col] = rng.random(n).round(3) if col.endswith('_PCT') else rng.integers(0, 40, n) * df['GP']
+        df['PLUS_MINUS'] = rng.integers(-300, 300, n).astype(float)
+        df['NBA_FANTASY_PTS'] = (df['PTS'] * 1.2).astype(float)
+        df['DD2'] = rng.integers(0, 20, n)
+        df['TD3'] = rng.integers(0, 3, n)
+        self.data_frames = [df]
+
+    def get_data_frames(self):
+        return [df.copy() for df in self.data_frames]
+
+
+def career_frame(player_id):
+    """
+    Build a PlayerCareerStats SeasonTotalsRegularSeason frame: one row per season, up to 15 seasons, ending with the
+    last season for active players
+
+    :param player_id: Player ID
+    :return: DataFrame of 27 columns
+    """
+    rng = np.random.default_rng(int(player_id))
+    n = int(rng.integers(1, 16))
+    active = int(player_id) - FIRST_PLAYER_ID >= N_PLAYERS - N_ACTIVE
+    last = LAST_SEASON if active else int(rng.integers(1950, LAST_SEASON - 1))
+    seasons = [season_name(year) for year in range(last - n + 1, last + 1)]
+
+    df = pd.DataFrame({
+        'PLAYER_ID': int(player_id),
+        'SEASON_ID': seasons,
+        'LEAGUE_ID': '00',
+        'TEAM_ID': [player_team(player_id, season) for season in seasons],
+        'PLAYER_AGE': np.arange(22, 22 + n).astype(float),
+        'GP': rng.integers(1, 83, n),
+    })
+    df.insert(4, 'TEAM_ABBREVIATION', df['TEAM_ID'].map({team['id']: team['abbreviation'] for team in teams.get_teams()}))
+    df['GS'] = rng.integers(0, df['GP'] + 1)
+    df['MIN'] = (df['GP'] * rng.uniform(2, 38, n)).round(1)
+    for col in BOX_COLUMNS:
+        df[col] = rng.random(n).round(3) if col.endswith('_PCT') else rng.integers(0, 40, n) * df['GP']
+
+    return df
+
+
+class PlayerCareerStats:
+    """
+    Stand-in for nba_api's PlayerCareerStats returning the season totals and career totals frames
+    """
+
+    def __init__(self, player_id, timeout=30, **kwargs):
+        simulate_request()
+        seasons = career_frame(player_id)
+        totals = seasons.drop(columns=['SEASON_ID', 'TEAM_ID', 'TEAM_ABBREVIATION', 'PLAYER_AGE']).groupby(
+            ['PLAYER_ID', 'LEAGUE_ID'], as_index=False).sum()
+        self.data_frames = [seasons, totals]
+
+    def get_data_frames(self):
+        return [df.copy() for df in self.data_frames]
+
+
+class AllTimeLeadersGrids:
+    """
+    Stand-in for nba_api's AllTimeLeadersGrids: the top 10 of each of 19 categories
+    """
+
+    def __init__(self, timeout=30, **kwargs):
+        simulate_request()
+        rng = np.random.default_rng(0)
+        roster = pd.DataFrame(get_players())
+        self.data_frames = []
+        for category in LEADER_CATEGORIES:
+            leaders = roster.sample(10, random_state=rng.integers(2 ** 31))
+            self.data_frames.append(pd.DataFrame({
+                'PLAYER_ID': leaders['id'].to_numpy(),
+                'PLAYER_NAME': leaders['full_name'].to_numpy(),
+                category: np.sort(rng.integers(1000, 40000, 10))[::-1],
+                f'{category}_RANK': np.arange(1, 11),
+                'IS_ACTIVE_FLAG': np.where(leaders['is_active'], 'Y', 'N'),
+            }))
+
+    def get_data_frames(self):
+        return [df.copy() for df in self.data_frames]
+
+
+class PlayerDashPtShots:
+    """
+    Stand-in for nba_api's PlayerDashPtShots returning canned frames with injected latency and failures
+    """
+
+    def __init__(self, team_id, player_id, season=None, timeout=30, **kwargs):
+        simulate_request()
+        self.data_frames = shot_frames(player_id)
+
+    def get_data_frames(self):
+        return self.data_frames
+
+
+@lru_cache(maxsize=4)
+def season_shots(year, n_seasons, n_players, n_active):
+    """
+    Build every shot of a season's games in league_games, shaped like ShotChartDetail's Shot_Chart_Detail frame:
+    SHOTS_PER_GAME attempts per team game by players of the team, with zones, distance and made flag consistent with
+    the location. Empty for seasons outside the game history
+
+    :param year: Start year of the season
+    :param n_seasons: Number of seasons in league_games
+    :param n_players: Number of players in the static player lists
+    :param n_active: Number of those players that are active
+    :return: DataFrame of shots, GAME_DATE as 'YYYYMMDD'
+    """
+    rng = np.random.default_rng(year)
+    season = season_name(year)
+    games = league_games(n_seasons)
+    games = games[games['SEASON_ID'] == str(20000 + year)].sort_values(['GAME_DATE', 'GAME_ID'], kind='stable')
+
+    counts = rng.integers(*SHOTS_PER_GAME, len(games))
+    shots = games.loc[games.index.repeat(counts), ['GAME_ID', 'GAME_DATE', 'TEAM_ID', 'TEAM_NAME']].reset_index(drop=True)
+    n = len(shots)
+
+    ids = np.array([player['id'] for player in player_list(n_players, n_active)])
+    player_teams = np.array([player_team(id, season) for id in ids])
+    player_id = np.zeros(n, dtype=np.int64)
+    for team_id, rows in shots.groupby('TEAM_ID').indices.items():
+        roster = ids[player_teams == team_id]
+        player_id[rows] = rng.choice(roster if len(roster) else ids, len(rows))
+
+    # Distance in feet drawn per band like the league's shot diet: rim, paint, mid-range, three
+    band = rng.choice(4, n, p=[0.3, 0.2, 0.15, 0.35])
+    feet = rng.uniform(np.array([0, 4, 14, 23.75])[band], np.array([4, 14, 23, 27])[band])
+    angle = rng.uniform(-0.1, np.pi + 0.1, n)
+    loc_x = np.round(10 * feet * np.cos(angle)).astype(int)
+    loc_y = np.round(10 * feet * np.sin(angle)).astype(int)
+    distance = np.hypot(loc_x, loc_y) / 10
+    three = (distance >= 23.75) | ((np.abs(loc_x) >= 220) & (loc_y <= 90))
+    basic = np.select([three & (loc_y <= 90), three, distance < 4, distance < 16],
+                      ['Left Corner 3', 'Above the Break 3', 'Restricted Area', 'In The Paint (Non-RA)'], 'Mid-Range')
+    basic = np.where((basic == 'Left Corner 3') & (loc_x > 0), 'Right Corner 3', basic)
+
+    shots.insert(0, 'GRID_TYPE', 'Shot Chart Detail')
+    shots.insert(2, 'GAME_EVENT_ID', shots.groupby('GAME_ID').cumcount() + 2)
+    shots.insert(3, 'PLAYER_ID', player_id)
+    shots.insert(4, 'PLAYER_NAME', [f'Player {id}' for id in player_id])
+    shots['PERIOD'] = rng.integers(1, 5, n)
+    shots['MINUTES_REMAINING'] = rng.integers(0, 12, n)
+    shots['SECONDS_REMAINING'] = rng.integers(0, 60, n)
+    shots['ACTION_TYPE'] = rng.choice(ACTION_TYPES, n)
+    shots['SHOT_TYPE'] = np.where(three, '3PT Field Goal', '2PT Field Goal')
+    shots['SHOT_ZONE_BASIC'] = basic
+    shots['SHOT_ZONE_AREA'] = np.select([np.abs(loc_x) < 80, loc_x < 0], ['Center(C)', 'Left Side(L)'], 'Right Side(R)')
+    shots['SHOT_ZONE_RANGE'] = np.select([distance < 8, distance < 16, distance < 24],
+                                         ['Less Than 8 ft.', '8-16 ft.', '16-24 ft.'], '24+ ft.')
+    shots['SHOT_DISTANCE'] = distance.astype(int)
+    shots['LOC_X'] = loc_x
+    shots['LOC_Y'] = loc_y
+    shots['SHOT_ATTEMPTED_FLAG'] = 1
+    made = rng.random(n) < np.clip(0.65 - 0.012 * distance, 0.3, 0.65)
+    shots['SHOT_MADE_FLAG'] = made.astype(int)
+    shots['EVENT_TYPE'] = np.where(made, 'Made Shot', 'Missed Shot')
+    shots['GAME_DATE'] = shots['GAME_DATE'].str.replace('-', '')
+
+    return shots
+
+
+class ShotChartDetail:
+    """
+    Stand-in for nba_api's ShotChartDetail over season_shots. Only the league-wide request of download_shots, player
+    and team 0, is supported: the whole season, from date_from_nullable on if given
+    """
+
+    def __init__(self, team_id=0, player_id=0, season_nullable=None, date_from_nullable=None, timeout=30, **kwargs):
+        simulate_request()
+        shots = season_shots(int((season_nullable or season_name(LAST_SEASON))[:4]), N_SEASONS, N_PLAYERS, N_ACTIVE)
+        if date_from_nullable:
+            start = pd.to_datetime(date_from_nullable, format='%m/%d/%Y').strftime('%Y%m%d')
+            shots = shots[shots['GAME_DATE'] >= start]
+        averages = pd.DataFrame({'GRID_TYPE': 'League Averages', 'SHOT_ZONE_BASIC': shots['SHOT_ZONE_BASIC'].unique()})
+        self.data_frames = [shots.reset_index(drop=True), averages]
+
+    def get_data_frames(self):
+        return [df.copy() for df in self.data_frames]
+
+
+# (module, attribute, fake) for everything install() patches
+PATCHES = [
+    (leaguegamefinder, 'LeagueGameFinder', LeagueGameFinder),
+    (leaguedashplayerstats, 'LeagueDashPlayerStats', LeagueDashPlayerStats),
+    (playerdashptshots, 'PlayerDashPtShots', PlayerDashPtShots),
+    (shotchartdetail, 'ShotChartDetail', ShotChartDetail),
+    (playercareerstats, 'PlayerCareerStats', PlayerCareerStats),
+    (alltimeleadersgrids, 'AllTimeLeadersGrids', AllTimeLeadersGrids),
+    (players, 'get_players', get_players),
+    (players, 'get_active_players', get_active_players),
+    (players, 'get_inactive_players', get_inactive_players),
+]
+ORIGINALS = {(module.__name__, name): getattr(module, name) for module, name, _ in PATCHES}
+# metrics.enabled before install(), restored by uninstall()
+_metrics_enabled = metrics.enabled
+
+
+def install():
+    """
+    Monkeypatch the nba_api endpoint classes and static player lists with the fakes in this module. The static team
+    list is bundled with nba_api and needs no network, so the real one is kept. Metrics are disabled while the fakes
+    are installed, so simulated requests and the writes they feed never reach the METRICS table of config.DB_PATH
+    """
+    global _metrics_enabled
+    if leaguegamefinder.LeagueGameFinder is not LeagueGameFinder:
+        _metrics_enabled = metrics.enabled
+    metrics.enabled = False
+    for module, name, fake in PATCHES:
+        setattr(module, name, fake)
+
+
+def uninstall():
+    """
+    Restore the nba_api attributes replaced by install(), and metrics.enabled
+    """
+    for module, name, _ in PATCHES:
+        setattr(module, name, ORIGINALS[(module.__name__, name)])
+    metrics.enabled = _metrics_enabled
+
+
+if __name__ == '__main__':
+    # Run the shot-profile download against the fake endpoint and an in-memory database
+    from download_league_player_stats import download_player_pt_shots
+    from fetch_engine import FetchEngine
+    import response_cache
+
+    install()
+    response_cache.enabled = False
+    configure(latency=(0.05, 0.25), failure_rate=0.1, seed=0)
+
+    player_id = np.arange(1, 201)
+    team_id = np.full(len(player_id), 1610612744)
+    with sqlite3.connect(':memory:') as conn:
+        download_player_pt_shots(player_id, team_id, '2022-23', conn, current=True,
+                                 engine=FetchEngine(max_workers=8, rate=20.0, backoff=0.1))
+        print(pd.read_sql_query('SELECT COUNT(*) AS ROWS FROM SHOT_OVERALL_CURRENT', conn))
@@ -0,0 +1,126 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from connect_sqlite import get_current_time
+
+
+class RateLimiter:
+    """
+    Spaces calls so that no more than `rate` requests per second are started across all threads
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block until the caller is allowed to start its next request
+        """
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+
+        if start > now:
+            time.sleep(start - now)
+
+
+def backoff_delay(attempt, base, cap):
+    """
+    Exponential backoff with full jitter: a random delay in [0, min(cap, base * 2^attempt)]
+
+    :param attempt: Number of failed attempts so far (0 for the first retry)
+    :param base: Base delay in seconds
+    :param cap: Maximum delay in seconds
+    :return: Delay in seconds
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class FetchEngine:
+    """
+    Bounded thread-pool fetcher with a shared requests-per-second limit, per-request timeout and jittered exponential
+    backoff. Results are yielded as soon as each key finishes, in completion order.
+
+    Usage:
+        engine = FetchEngine(max_workers=8, rate=2.0)
+        for key, result in engine.run(keys, fetch):
+            ...
+        print(engine.summary('players'))
+
+    `fetch(key, timeout)` is called from a worker thread and should raise on failure.
+    """
+
+    def __init__(self, max_workers=8, rate=2.0, timeout=30, retries=5, backoff=2.0, max_backoff=60.0):
+        self.max_workers = max_workers
+        self.limiter = RateLimiter(rate)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.completed = 0
+        self.retried = 0
+        self.failed = []
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+
+    def _fetch_with_retry(self, key, fetch):
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            try:
+                return fetch(key, self.timeout)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                with self.lock:
+                    self.retried += 1
+                delay = backoff_delay(attempt, self.backoff, self.max_backoff)
+                print(f'Error fetching {key} ({type(e).__name__}: {e}), retrying in {delay:.1f}s')
+                time.sleep(delay)
+
+    def run(self, keys, fetch):
+        """
+        Fetch every key and yield (key, result) pairs as they finish. Keys that still fail after all retries are not
+        yielded; they are collected in `self.failed` as (key, exception) pairs.
+
+        :param keys: Iterable of hashable keys, e.g. (player_id, team_id) tuples
+        :param fetch: Callable fetch(key, timeout) returning the result for one key
+        :return: Generator of (key, result) tuples
+        """
+        start = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = {pool.submit(self._fetch_with_retry, key, fetch): key for key in keys}
+                for future in as_completed(futures):
+                    key = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print(f'Giving up on {key} after {self.retries + 1} attempts: {e}')
+                        self.failed.append((key, e))
+                        continue
+
+                    self.completed += 1
+                    yield key, result
+        finally:
+            self.elapsed += time.monotonic() - start
+
+    def throughput(self):
+        """
+        :return: Completed keys per minute over all runs of this engine
+        """
+        if self.elapsed == 0:
+            return 0.0
+        return self.completed / (self.elapsed / 60)
+
+    def summary(self, unit='items'):
+        """
+        :param unit: Name of the fetched unit for the log line, e.g. 'players'
+        :return: One-line throughput report
+        """
+        return (f'{get_current_time()}: Fetched {self.completed} {unit} in {self.elapsed / 60:.1f} min '
+                f'({self.throughput():.1f} {unit}/min), {self.retried} retries, {len(self.failed)} failed')
@@ -0,0 +1,94 @@
+import pandas as pd
+from metrics import measure
+from sql_writer import bump_version
+
+
+class FrameAccumulator:
+    """
+    Collects DataFrame chunks in a list and concatenates them once, instead of growing a DataFrame with pd.concat
+    inside a loop (which copies every row already collected on each iteration).
+
+    Without a table the chunks are kept in memory until frame() is called. With a table and connection, buffered
+    chunks are written to SQLite whenever more than `flush_rows` rows are pending, and the rest on close().
+
+    Usage:
+        acc = FrameAccumulator()
+        for df in chunks:
+            acc.add(df)
+        out = acc.frame()
+    """
+
+    def __init__(self, table=None, conn=None, if_exists='append', flush_rows=50000, on_flush=None, **to_sql_kwargs):
+        """
+        :param table: Name of the SQLite table to flush to. Default None keeps everything in memory
+        :param conn: Connection object representing the connection to the SQLite database
+        :param if_exists: {'append', 'replace', 'fail'} used for the first flush, later flushes always append
+        :param flush_rows: Number of pending rows that triggers a flush to the table
+        :param on_flush: Function called before each flush writes, in the transaction the flush commits, e.g.
+            WorkQueue.write_marks to commit completion marks with their rows
+        :param to_sql_kwargs: Extra keyword arguments passed to DataFrame.to_sql
+        """
+        self.table = table
+        self.conn = conn
+        self.if_exists = if_exists
+        self.flush_rows = flush_rows
+        self.on_flush = on_flush
+        self.to_sql_kwargs = to_sql_kwargs
+
+        self.chunks = []
+        self.pending_rows = 0
+        self.flushed_rows = 0
+
+    def __len__(self):
+        return self.pending_rows + self.flushed_rows
+
+    def add(self, df):
+        """
+        Buffer a chunk, flushing to the table if enough rows are pending
+
+        :param df: DataFrame chunk
+        """
+        self.chunks.append(df)
+        self.pending_rows += len(df)
+
+        if self.table is not None and self.pending_rows >= self.flush_rows:
+            self.flush()
+
+    def frame(self):
+        """
+        Concatenate the buffered chunks into a single DataFrame
+
+        :return: DataFrame of all buffered rows. Empty DataFrame if nothing was added
+        """
+        if len(self.chunks) == 0:
+            return pd.DataFrame()
+        if len(self.chunks) > 1:
+            self.chunks = [pd.concat(self.chunks)]
+
+        return self.chunks[0]
+
+    def flush(self):
+        """
+        Write the buffered chunks to the table and clear the buffer
+        """
+        if len(self.chunks) == 0:
+            return
+
+        if_exists = self.if_exists if self.flushed_rows == 0 else 'append'
+        with measure('write', self.table, rows=self.pending_rows):
+            # Bumped first so it joins the transaction to_sql commits. A replacing flush touches every season
+            bump_version(self.conn, self.table, self.frame() if if_exists == 'append' else None)
+            if self.on_flush is not None:
+                self.on_flush()
+            self.frame().to_sql(self.table, self.conn, if_exists=if_exists, **self.to_sql_kwargs)
+
+        self.flushed_rows += self.pending_rows
+        self.chunks = []
+        self.pending_rows = 0
+
+    def close(self):
+        """
+        Flush any remaining rows to the table
+        """
+        if self.table is not None:
+            self.flush()
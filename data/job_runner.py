@@ -0,0 +1,228 @@
+import importlib
+import multiprocessing
+import sys
+import time
+import traceback
+import uuid
+from collections import namedtuple
+from datetime import datetime
+import metrics
+from connect_sqlite import connect, get_current_time
+from fetch_engine import backoff_delay
+
+# A refresh step: module.function() is called in its own process and returns the number of rows it wrote.
+# The step starts once every job named in depends has succeeded, and is skipped if one of them fails for good
+Job = namedtuple('Job', ['name', 'module', 'function', 'depends', 'timeout', 'retries'],
+                 defaults=[(), 60 * 60, 1])
+
+# Steps of the daily refresh. Jobs without a path between them in the DAG run concurrently
+DAILY_JOBS = [
+    Job('static_lists', 'download_team_and_player_static_list', 'main', timeout=10 * 60),
+    Job('games', 'download_games', 'main'),
+    Job('backfill', 'download_league_player_stats', 'backfill', timeout=24 * 60 * 60),
+    Job('league_stats', 'download_league_player_stats', 'update_league_stats', timeout=30 * 60),
+    Job('shot_profiles', 'download_league_player_stats', 'update_shot_profiles', depends=('league_stats',),
+        timeout=4 * 60 * 60),
+    Job('active_players', 'download_players_active', 'main', depends=('static_lists', 'league_stats'),
+        timeout=4 * 60 * 60),
+    Job('alltimeleaders', 'download_alltimeleaders', 'main', timeout=30 * 60),
+    Job('shots', 'download_shots', 'main', timeout=4 * 60 * 60),
+]
+
+# Concurrent jobs. Every job rate-limits its own requests, so this also bounds the total request rate
+MAX_WORKERS = 3
+HISTORY_TABLE = 'RUN_HISTORY'
+
+
+def _run_step(module, function, pipe, run_id=None, job=None):
+    """
+    Entry point of a job's process: run module.function() and send (status, rows, error) back through the pipe.
+    The job's request and write metrics are recorded under the run id and job name
+    """
+    metrics.set_context(run_id, job)
+    try:
+        rows = getattr(importlib.import_module(module), function)()
+        pipe.send(('success', int(rows or 0), None))
+    except BaseException:
+        pipe.send(('failed', 0, traceback.format_exc()))
+    finally:
+        metrics.flush()
+        pipe.close()
+
+
+def check_jobs(jobs):
+    """
+    Raise ValueError if job names repeat, a dependency is not in jobs, or the dependencies form a cycle
+
+    :param jobs: List of Job
+    :return: List of job names in a valid run order
+    """
+    names = [job.name for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Duplicate job names: {names}')
+
+    depends = {job.name: set(job.depends) for job in jobs}
+    for name, deps in depends.items():
+        if not deps <= depends.keys():
+            raise ValueError(f'Job {name} depends on unknown jobs: {sorted(deps - depends.keys())}')
+
+    order = []
+    while depends:
+        ready = [name for name, deps in depends.items() if deps <= set(order)]
+        if not ready:
+            raise ValueError(f'Dependency cycle between jobs: {sorted(depends)}')
+        order += ready
+        for name in ready:
+            del depends[name]
+
+    return order
+
+
+def select_jobs(jobs, names):
+    """
+    :param jobs: List of Job
+    :param names: Names of the jobs to run
+    :return: The named jobs and everything they depend on, in the order of jobs
+    """
+    by_name = {job.name: job for job in jobs}
+    unknown = set(names) - by_name.keys()
+    if unknown:
+        raise ValueError(f'Unknown jobs: {sorted(unknown)}')
+
+    selected = set()
+    stack = list(names)
+    while stack:
+        name = stack.pop()
+        if name not in selected:
+            selected.add(name)
+            stack += by_name[name].depends
+
+    return [job for job in jobs if job.name in selected]
+
+
+def record_attempt(CONNECTION, run_id, job, attempt, status, started, finished, rows=0, error=None):
+    """
+    Write one attempt of a job to the run-history table and commit
+
+    :param started: datetime the attempt started, or None for skipped jobs
+    :param finished: datetime the attempt ended
+    """
+    seconds = (finished - started).total_seconds() if started else 0.0
+    CONNECTION.execute(f'INSERT INTO {HISTORY_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (run_id, job, attempt, status, started and started.isoformat(sep=' ', timespec='seconds'),
+                        finished.isoformat(sep=' ', timespec='seconds'), seconds, rows, error))
+    CONNECTION.commit()
+
+
+def run_jobs(jobs=DAILY_JOBS, max_workers=MAX_WORKERS, CONNECTION=None, poll=1.0):
+    """
+    Run a DAG of jobs, each attempt in a fresh process, up to max_workers at a time. An attempt that fails or
+    runs past its job's timeout (and is terminated) is retried after a backoff; the downloads checkpoint their
+    progress, so a retry resumes rather than starts over. Every attempt, and every job skipped because a
+    dependency failed, is recorded in RUN_HISTORY.
+
+    :param jobs: List of Job
+    :param max_workers: Number of jobs running at the same time
+    :param CONNECTION: Connection the run history is written to. Default connect()
+    :param poll: Seconds between checks of the running jobs
+    :return: Tuple of (run id, dict of job name to final status: 'success', 'failed', 'timeout' or 'skipped')
+    """
+    check_jobs(jobs)
+    CONNECTION = CONNECTION or connect()
+    context = multiprocessing.get_context('spawn')
+    run_id = uuid.uuid4().hex[:12]
+
+    pending = {job.name: job for job in jobs}
+    not_before = {}
+    attempts = {}
+    running = {}
+    status = {}
+
+    print(f'{get_current_time()}: Run {run_id} started with jobs {list(pending)}')
+    while pending or running:
+        # Skip jobs whose dependencies will never succeed
+        for name, job in list(pending.items()):
+            failed = [dep for dep in job.depends if status.get(dep, 'success') != 'success']
+            if failed:
+                status[name] = 'skipped'
+                del pending[name]
+                record_attempt(CONNECTION, run_id, name, 0, 'skipped', None, datetime.now(),
+                               error=f'Dependencies did not succeed: {failed}')
+                print(f'{get_current_time()}: {name} skipped, dependencies did not succeed: {failed}')
+
+        # Start jobs whose dependencies have succeeded
+        for name, job in list(pending.items()):
+            if len(running) >= max_workers:
+                break
+            if any(dep not in status for dep in job.depends) or time.monotonic() < not_before.get(name, 0):
+                continue
+
+            attempts[name] = attempts.get(name, 0) + 1
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_run_step, args=(job.module, job.function, sender, run_id, name),
+                                      name=name)
+            process.start()
+            sender.close()
+            running[name] = (job, process, receiver, datetime.now(), time.monotonic() + job.timeout)
+            del pending[name]
+
+        time.sleep(poll)
+
+        # Collect finished and timed-out jobs
+        for name, (job, process, receiver, started, deadline) in list(running.items()):
+            result = None
+            if receiver.poll():
+                try:
+                    result = receiver.recv()
+                except EOFError:
+                    pass
+            elif process.is_alive():
+                if time.monotonic() < deadline:
+                    continue
+                process.terminate()
+                result = ('timeout', 0, f'Terminated after {job.timeout} s')
+
+            process.join()
+            receiver.close()
+            del running[name]
+            if result is None:
+                result = ('failed', 0, f'Process exited with code {process.exitcode}')
+
+            outcome, rows, error = result
+            finished = datetime.now()
+            record_attempt(CONNECTION, run_id, name, attempts[name], outcome, started, finished, rows, error)
+            seconds = (finished - started).total_seconds()
+
+            if outcome == 'success':
+                status[name] = outcome
+                print(f'{get_current_time()}: {name} finished in {seconds / 60:.1f} min, {rows} rows written')
+            elif attempts[name] <= job.retries:
+                pending[name] = job
+                not_before[name] = time.monotonic() + backoff_delay(attempts[name], 30.0, 10 * 60.0)
+                print(f'{get_current_time()}: {name} {outcome} after {seconds / 60:.1f} min, retrying')
+            else:
+                status[name] = outcome
+                print(f'{get_current_time()}: {name} {outcome} after {attempts[name]} attempts')
+
+    succeeded = sum(1 for outcome in status.values() if outcome == 'success')
+    print(f'{get_current_time()}: Run {run_id} finished, {succeeded}/{len(status)} jobs succeeded')
+
+    return run_id, status
+
+
+def run_history(CONNECTION, run_id):
+    """
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param run_id: Run id returned by run_jobs
+    :return: List of (job, attempt, status, seconds, rows, error) rows of the run
+    """
+    return CONNECTION.execute(f'SELECT JOB, ATTEMPT, STATUS, SECONDS, ROWS, ERROR FROM {HISTORY_TABLE} '
+                              'WHERE RUN_ID = ? ORDER BY rowid', (run_id,)).fetchall()
+
+
+if __name__ == '__main__':
+    # python job_runner.py [job ...] runs the named jobs and their dependencies, or the whole daily refresh
+    jobs = select_jobs(DAILY_JOBS, sys.argv[1:]) if len(sys.argv) > 1 else DAILY_JOBS
+    run_id, _ = run_jobs(jobs)
+    for job, attempt, outcome, seconds, rows, error in run_history(connect(), run_id):
+        print(f'{job:<16} attempt {attempt}  {outcome:<8} {seconds:>8.1f} s {rows:>8} rows')
@@ -0,0 +1,302 @@
+import atexit
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+import numpy as np
+import pandas as pd
+from config import DB_PATH, METRICS_ENABLED, METRICS_TEXTFILE_DIR
+from connect_sqlite import connect, get_current_time, migrate
+
+# One row per nba_api request attempt or table write, created by migration 3 in connect_sqlite
+METRICS_TABLE = 'METRICS'
+COLUMNS = ['RUN_ID', 'JOB', 'KIND', 'NAME', 'STARTED', 'SECONDS', 'ATTEMPT', 'OUTCOME', 'ERROR', 'BYTES', 'ROWS']
+
+# Buffered events are written once this many have accumulated, and when the process exits
+FLUSH_EVENTS = 1000
+# Seconds a flush waits for another writer before keeping its events for the next one
+FLUSH_TIMEOUT = 1.0
+
+# Upper bounds of the Prometheus latency histogram buckets, in seconds
+BUCKETS = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+enabled = METRICS_ENABLED
+textfile_dir = METRICS_TEXTFILE_DIR
+# Database file the events are written to, e.g. the scratch database of a test run. Default config.DB_PATH
+database = None
+
+_events = []
+_attempts = Counter()
+_lock = threading.Lock()
+_context = {
+    'run_id': datetime.now().strftime('%Y%m%d-%H%M%S') + f'-{os.getpid()}',
+    'job': os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0],
+}
+
+
+def set_context(run_id, job):
+    """
+    Tag the events of this process with a run and job, e.g. the job runner's run id and job name. Scripts run on
+    their own get a run id from their start time and their script name as job
+
+    :param run_id: Run id
+    :param job: Job name
+    """
+    _context['run_id'] = run_id
+    _context['job'] = job
+
+
+def run_id():
+    """
+    :return: Run id the events of this process are recorded under
+    """
+    return _context['run_id']
+
+
+def next_attempt(name, key):
+    """
+    Count an attempt of a request. A request with the same endpoint and parameters made again in the same process,
+    by FetchEngine or a retry loop, is a retry
+
+    :param name: Endpoint name
+    :param key: Key identifying the request's parameters, e.g. ResponseCache.key
+    :return: Attempt number, 1 for the first
+    """
+    with _lock:
+        _attempts[(name, key)] += 1
+        return _attempts[(name, key)]
+
+
+def record(kind, name, seconds, outcome='ok', error=None, attempt=1, bytes=0, rows=0, started=None):
+    """
+    Buffer one event
+
+    :param kind: 'request' for nba_api calls, 'write' for table writes
+    :param name: Endpoint or table name
+    :param seconds: Duration in seconds
+    :param outcome: 'ok', 'error', or 'cache' for requests served from the response cache
+    :param error: Exception type name for failed events
+    :param attempt: Attempt number, see next_attempt
+    :param bytes: Payload size in bytes
+    :param rows: Rows received or written
+    :param started: datetime the event started. Default now
+    """
+    if not enabled:
+        return
+
+    started = (started or datetime.now()).isoformat(sep=' ', timespec='milliseconds')
+    event = (_context['run_id'], _context['job'], kind, name, started, seconds, attempt, outcome, error, int(bytes),
+             int(rows))
+    with _lock:
+        _events.append(event)
+        full = len(_events) >= FLUSH_EVENTS
+
+    if full:
+        flush()
+
+
+@contextmanager
+def measure(kind, name, attempt=1, bytes=0, rows=0):
+    """
+    Record the duration and outcome of a block. The yielded dict's 'bytes' and 'rows' can be set inside the block.
+    Exceptions are recorded with their type and re-raised
+
+    Usage:
+        with measure('write', 'PLAYERS_INACTIVE', rows=len(df)):
+            df.to_sql('PLAYERS_INACTIVE', conn, if_exists='replace')
+    """
+    event = {'bytes': bytes, 'rows': rows}
+    started = datetime.now()
+    start = time.perf_counter()
+    try:
+        yield event
+    except BaseException as e:
+        record(kind, name, time.perf_counter() - start, 'error', type(e).__name__, attempt, event['bytes'],
+               event['rows'], started)
+        raise
+
+    record(kind, name, time.perf_counter() - start, 'ok', None, attempt, event['bytes'], event['rows'], started)
+
+
+def timed_write(function):
+    """
+    Decorator recording every call of a writer function(df, table, ...) returning a row count or upsert counts
+    """
+    @wraps(function)
+    def wrapper(df, table, *args, **kwargs):
+        with measure('write', table, bytes=df.memory_usage(index=False).sum()) as event:
+            result = function(df, table, *args, **kwargs)
+            event['rows'] = result if isinstance(result, int) else \
+                result['inserted'] + result['updated'] + result['deleted']
+
+        return result
+
+    return wrapper
+
+
+def payload_bytes(response, frames):
+    """
+    :param response: nba_api endpoint object
+    :param frames: DataFrames parsed from it
+    :return: Size of the raw response body, or of the frames for endpoints without one
+    """
+    try:
+        return len(response.nba_response.get_response())
+    except AttributeError:
+        return sum(int(df.memory_usage(index=False).sum()) for df in frames)
+
+
+def flush(path=None):
+    """
+    Write the buffered events to the metrics table, through a connection of its own so the write never commits a
+    transaction the pipeline still has open, then rewrite this job's Prometheus textfile if one is configured.
+    Events are kept for the next flush if the database stays locked
+
+    :param path: Database file. Default the module's database, or config.DB_PATH if it is not set
+    :return: Number of events written
+    """
+    with _lock:
+        events = _events[:]
+        del _events[:]
+    if not events:
+        return 0
+
+    try:
+        conn = sqlite3.connect(path or database or DB_PATH, timeout=FLUSH_TIMEOUT)
+        try:
+            migrate(conn)
+            conn.executemany(f'INSERT INTO {METRICS_TABLE} VALUES ({", ".join("?" for _ in COLUMNS)})', events)
+            conn.commit()
+            if textfile_dir:
+                write_textfile(conn, textfile_dir)
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f'{get_current_time()}: Could not write {len(events)} metrics, keeping them for later: {e}')
+        with _lock:
+            _events[:0] = events
+        return 0
+
+    return len(events)
+
+
+def read_metrics(CONNECTION, run_id=None, job=None):
+    """
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param run_id: Run to read. Default the run with the latest event
+    :param job: Job to read. Default all jobs of the run
+    :return: DataFrame of the run's events
+    """
+    if run_id is None:
+        row = CONNECTION.execute(f'SELECT RUN_ID FROM {METRICS_TABLE} ORDER BY STARTED DESC LIMIT 1').fetchone()
+        run_id = row[0] if row else None
+
+    query = f'SELECT * FROM {METRICS_TABLE} WHERE RUN_ID = ?' + (' AND JOB = ?' if job else '')
+    return pd.read_sql_query(query, CONNECTION, params=(run_id, job) if job else (run_id,))
+
+
+def summarize(events):
+    """
+    Group events by kind and endpoint or table
+
+    :param events: DataFrame of METRICS rows
+    :return: DataFrame with, per KIND and NAME: calls, cache hits, errors, retries, the most common exception type,
+        latency percentiles and total of the calls that went to the network or database, MB and rows. Slowest first
+    """
+    columns = ['KIND', 'NAME', 'CALLS', 'CACHED', 'ERRORS', 'RETRIES', 'TOP_ERROR', 'P50', 'P95', 'P99', 'MAX',
+               'TOTAL_S', 'MB', 'ROWS']
+    if events.empty:
+        return pd.DataFrame(columns=columns)
+
+    rows = []
+    for (kind, name), group in events.groupby(['KIND', 'NAME']):
+        live = group[group['OUTCOME'] != 'cache']
+        seconds = live['SECONDS'].to_numpy()
+        errors = group['ERROR'].dropna()
+        p50, p95, p99 = np.percentile(seconds, [50, 95, 99]) if len(seconds) else (np.nan,) * 3
+        rows.append((kind, name, len(group), int((group['OUTCOME'] == 'cache').sum()), len(errors),
+                     int((group['ATTEMPT'] > 1).sum()), errors.mode().iloc[0] if len(errors) else None,
+                     p50, p95, p99, seconds.max(initial=0), seconds.sum(), group['BYTES'].sum() / 2 ** 20,
+                     int(group['ROWS'].sum())))
+
+    return pd.DataFrame(rows, columns=columns).sort_values('TOTAL_S', ascending=False, ignore_index=True)
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+def write_textfile(CONNECTION, directory):
+    """
+    Write the metrics of this process's run and job in the Prometheus text format, for node_exporter's textfile
+    collector: a latency histogram and counters of attempts, retries, errors, bytes and rows per endpoint or table
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param directory: Directory scraped by the textfile collector. One file per job is replaced atomically
+    """
+    events = read_metrics(CONNECTION, _context['run_id'], _context['job'])
+    lines = [
+        '# HELP nba_seconds Duration of nba_api requests and table writes',
+        '# TYPE nba_seconds histogram',
+    ]
+    totals = []
+    for (kind, name), group in events.groupby(['KIND', 'NAME']):
+        labels = dict(job=_context['job'], kind=kind, name=name)
+        seconds = group.loc[group['OUTCOME'] != 'cache', 'SECONDS'].to_numpy()
+        for bound in BUCKETS:
+            lines.append(f'nba_seconds_bucket{_labels(**labels, le=bound)} {int((seconds <= bound).sum())}')
+        lines.append(f'nba_seconds_bucket{_labels(**labels, le="+Inf")} {len(seconds)}')
+        lines.append(f'nba_seconds_sum{_labels(**labels)} {seconds.sum()}')
+        lines.append(f'nba_seconds_count{_labels(**labels)} {len(seconds)}')
+
+        for outcome, count in group['OUTCOME'].value_counts().items():
+            totals.append(('nba_attempts_total', {**labels, 'outcome': outcome}, count))
+        totals.append(('nba_retries_total', labels, int((group['ATTEMPT'] > 1).sum())))
+        totals.append(('nba_bytes_total', labels, int(group['BYTES'].sum())))
+        totals.append(('nba_rows_total', labels, int(group['ROWS'].sum())))
+
+    for metric in sorted({metric for metric, _, _ in totals}):
+        lines.append(f'# TYPE {metric} counter')
+        lines += [f'{metric}{_labels(**labels)} {value}' for name, labels, value in totals if name == metric]
+
+    os.makedirs(directory, exist_ok=True)
+    file = os.path.join(directory, f'nba_{_context["job"]}.prom')
+    with open(f'{file}.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(f'{file}.tmp', file)
+
+
+def report(CONNECTION, run_id=None, top=15):
+    """
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param run_id: Run to report. Default the latest run
+    :param top: Number of endpoints and tables listed
+    :return: Report of the run's slowest endpoints and tables, as printable text
+    """
+    events = read_metrics(CONNECTION, run_id)
+    if events.empty:
+        return 'No metrics recorded'
+
+    summary = summarize(events).head(top)
+    lines = [f'Run {events["RUN_ID"].iloc[0]}: {len(events)} events from jobs {", ".join(events["JOB"].unique())}',
+             f'{"kind":<8} {"name":<28} {"calls":>7} {"cached":>7} {"errors":>6} {"retries":>7} {"p50 s":>7} '
+             f'{"p95 s":>7} {"p99 s":>7} {"total s":>9} {"MB":>8} {"rows":>9}  top error']
+    for row in summary.itertuples():
+        lines.append(f'{row.KIND:<8} {row.NAME:<28} {row.CALLS:>7} {row.CACHED:>7} {row.ERRORS:>6} {row.RETRIES:>7} '
+                     f'{row.P50:>7.2f} {row.P95:>7.2f} {row.P99:>7.2f} {row.TOTAL_S:>9.1f} {row.MB:>8.1f} '
+                     f'{row.ROWS:>9}  {row.TOP_ERROR if isinstance(row.TOP_ERROR, str) else ""}')
+
+    return '\n'.join(lines)
+
+
+atexit.register(flush)
+
+
+if __name__ == '__main__':
+    # python metrics.py [run_id] summarizes the slowest endpoints and tables of a run, by default the latest
+    print(report(connect(), sys.argv[1] if len(sys.argv) > 1 else None))
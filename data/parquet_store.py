@@ -0,0 +1,267 @@
+import json
+import os
+import sys
+import zlib
+import pandas as pd
+from config import PARQUET_DIR, PARQUET_ENABLED
+from connect_sqlite import ALL, PARTITIONS, connect, get_current_time, table_versions, written_partitions
+from schema import apply_schema
+from sql_writer import table_columns, table_exists
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+MANIFEST = '_manifest.json'
+
+
+def available():
+    """
+    :return: Whether the Parquet store is enabled and pyarrow is installed
+    """
+    return PARQUET_ENABLED and pa is not None
+
+
+def partition_file(table, partition, path=PARQUET_DIR):
+    """
+    :param table: Table name
+    :param partition: Season value of the partition, ALL for unpartitioned tables, or None for rows without a season
+    :param path: Root directory of the store
+    :return: Path of the partition's Parquet file
+    """
+    name = '_none' if partition is None else str(partition).replace(os.sep, '_')
+    return os.path.join(path, table, f'{name}.parquet')
+
+
+def load_manifest(table, path=PARQUET_DIR):
+    """
+    :return: Tuple of (TABLE_VERSIONS version of the table at the last sync or None, dict of the table's partitions
+        to the fingerprints they were exported at)
+    """
+    try:
+        with open(os.path.join(path, table, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None, {}
+
+    # Manifests written before versions were recorded hold the partitions alone
+    if 'PARTITIONS' not in manifest:
+        return None, manifest
+    return manifest['VERSION'], manifest['PARTITIONS']
+
+
+def read_manifest(table, path=PARQUET_DIR):
+    """
+    :return: Dict of the table's partitions to the fingerprints they were exported at
+    """
+    return load_manifest(table, path)[1]
+
+
+def write_manifest(table, version, partitions, path=PARQUET_DIR):
+    file = os.path.join(path, table, MANIFEST)
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    with open(f'{file}.tmp', 'w') as f:
+        json.dump({'VERSION': version, 'PARTITIONS': partitions}, f, indent=1, sort_keys=True)
+    os.replace(f'{file}.tmp', file)
+
+
+def row_checksum(*values):
+    """
+    CRC-32 of a row's values, registered as the SQLite function ROW_CHECKSUM. Stable across processes, unlike hash()
+    """
+    return zlib.crc32(repr(values).encode())
+
+
+def fingerprints(conn, table, season_col, seasons=None):
+    """
+    Summarize the partitions of a table in one aggregate query: row count and the sum of the CRC-32 of every row's
+    values, so any edited value changes the fingerprint. A partition whose fingerprint is unchanged since the last
+    export is not rewritten.
+
+    :param conn: Connection object representing the connection to the SQLite database
+    :param table: Table name
+    :param season_col: Partition column, or None
+    :param seasons: List of season values to summarize. Default every partition
+    :return: Dict of partition (season value as a JSON key, or ALL) to fingerprint list
+    """
+    conn.create_function('ROW_CHECKSUM', -1, row_checksum, deterministic=True)
+    columns = ', '.join(f'"{row[1]}"' for row in conn.execute(f'PRAGMA table_info("{table}")'))
+    # 32-bit checksums summed over up to 2 ** 31 rows cannot overflow SUM's 64-bit integer
+    parts = f'COUNT(*), SUM(ROW_CHECKSUM({columns}))'
+
+    if season_col is None:
+        row = conn.execute(f'SELECT {parts} FROM "{table}"').fetchone()
+        return {ALL: list(row)}
+
+    where, params = '', ()
+    if seasons is not None:
+        where = f' WHERE "{season_col}" IN ({", ".join("?" for _ in seasons)})'
+        params = tuple(seasons)
+    rows = conn.execute(f'SELECT "{season_col}", {parts} FROM "{table}"{where} GROUP BY "{season_col}"', params)
+    return {json.dumps(row[0]): list(row[1:]) for row in rows}
+
+
+def compact_frame(df, table=None):
+    """
+    Convert columns to the compact dtypes of the schema registry, so categoricals are stored dictionary-encoded and
+    percentages as float32, and downcast the other integer columns to the smallest integer type that fits
+
+    :param df: DataFrame read from SQLite
+    :param table: Table name, for the per-table dtypes of the registry
+    :return: DataFrame with compact dtypes
+    """
+    df = apply_schema(df, table)
+    for col in df.columns:
+        if df[col].dtype.kind in 'iu':
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+
+    return df
+
+
+def export_partition(conn, table, season_col, partition, path=PARQUET_DIR):
+    """
+    Write one partition of a table to its Parquet file, replacing the previous file atomically
+
+    :return: Number of rows written
+    """
+    if season_col is None:
+        df = pd.read_sql_query(f'SELECT * FROM "{table}"', conn)
+    else:
+        df = pd.read_sql_query(f'SELECT * FROM "{table}" WHERE "{season_col}" IS ?', conn, params=(partition,))
+
+    file = partition_file(table, partition if season_col else ALL, path)
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    pq.write_table(pa.Table.from_pandas(compact_frame(df, table), preserve_index=False), f'{file}.tmp', compression='zstd')
+    os.replace(f'{file}.tmp', file)
+
+    return len(df)
+
+
+def sync_table(conn, table, path=PARQUET_DIR):
+    """
+    Bring a table's Parquet mirror up to date: partitions that changed in SQLite are rewritten, partitions that no
+    longer exist are removed, the rest are left alone. A table whose TABLE_VERSIONS version has not moved since the
+    last sync is skipped without reading it; otherwise the partitions written since, per PARTITION_VERSIONS, are
+    compared by fingerprint, or every partition when a write may have touched them all
+
+    :param conn: Connection object representing the connection to the SQLite database
+    :param table: Table name, a key of PARTITIONS
+    :param path: Root directory of the store
+    :return: Number of partitions rewritten
+    """
+    if not available() or not table_exists(conn, table):
+        return 0
+
+    season_col = PARTITIONS.get(table)
+    if season_col is not None and season_col not in table_columns(conn, table):
+        season_col = None
+
+    synced, manifest = load_manifest(table, path)
+    version = table_versions(conn, [table])[table]
+    if version is not None and version == synced:
+        return 0
+
+    touched = written_partitions(conn, table, synced) if synced is not None and season_col is not None else set()
+    if version is None or not touched or ALL in touched or ALL in manifest:
+        current = fingerprints(conn, table, season_col)
+    else:
+        # Partitions not written since the last sync keep their manifest fingerprints. Seasons are matched as
+        # strings, since a writer's season values may be typed differently from the stored ones
+        seasons = [json.loads(key) for key in touched]
+        names = {str(season) for season in seasons}
+        current = {key: value for key, value in manifest.items() if str(json.loads(key)) not in names}
+        current.update(fingerprints(conn, table, season_col, seasons))
+
+    written = 0
+    for key, fingerprint in current.items():
+        if manifest.get(key) != fingerprint:
+            export_partition(conn, table, season_col, json.loads(key) if season_col else ALL, path)
+            written += 1
+
+    for key in manifest.keys() - current.keys():
+        try:
+            os.remove(partition_file(table, json.loads(key) if key != ALL else ALL, path))
+        except OSError:
+            pass
+
+    if written or manifest.keys() != current.keys() or version != synced:
+        write_manifest(table, version, current, path)
+
+    return written
+
+
+def sync_tables(conn, tables=None, path=PARQUET_DIR):
+    """
+    Sync several tables, e.g. right after a script has committed its writes. Does nothing without pyarrow
+
+    :param conn: Connection object representing the connection to the SQLite database
+    :param tables: List of table names. Default every table in PARTITIONS
+    :param path: Root directory of the store
+    :return: Number of partitions rewritten
+    """
+    if not available():
+        return 0
+
+    written = 0
+    for table in tables or PARTITIONS:
+        written += sync_table(conn, table, path)
+
+    if written > 0:
+        print(f'{get_current_time()}: Exported {written} Parquet partitions of {", ".join(tables or PARTITIONS)}')
+
+    return written
+
+
+def table_seasons(table, path=PARQUET_DIR):
+    """
+    :return: Season values of a table's partitions, as exported
+    """
+    return [json.loads(key) for key in read_manifest(table, path) if key != ALL]
+
+
+def read_table(table, columns=None, seasons=None, path=PARQUET_DIR):
+    """
+    Load a mirrored table, reading only the requested columns of the requested seasons' files. Files are memory
+    mapped, so unselected columns are never read from disk.
+
+    Usage:
+        games = read_table('ALL_GAMES_UNMERGED', columns=['GAME_DATE', 'PTS'], seasons=['22022'])
+
+    :param table: Table name
+    :param columns: List of columns to load. Default all
+    :param seasons: List of season values to load, compared as strings. Default all
+    :param path: Root directory of the store
+    :return: DataFrame in the compact dtypes of the schema registry
+    """
+    if pa is None:
+        raise ImportError('read_table needs pyarrow: pip install pyarrow')
+
+    manifest = read_manifest(table, path)
+    if not manifest:
+        raise FileNotFoundError(f'{table} has not been exported to {path}. Run python parquet_store.py')
+
+    if ALL in manifest:
+        files = [partition_file(table, ALL, path)]
+    else:
+        wanted = None if seasons is None else {str(season) for season in seasons}
+        files = [partition_file(table, json.loads(key), path) for key in manifest
+                 if wanted is None or str(json.loads(key)) in wanted]
+
+    tables = [pq.read_table(file, columns=columns, memory_map=True) for file in files]
+    if not tables:
+        return pd.DataFrame(columns=columns)
+
+    # Partitions exported before the registry, or before a column's dtype changed, are converted on read
+    return apply_schema(pa.concat_tables(tables, promote_options='permissive').to_pandas(), table)
+
+
+if __name__ == '__main__':
+    # python parquet_store.py [table ...] exports the named tables, or every table in PARTITIONS
+    if not available():
+        print('Parquet store disabled or pyarrow not installed')
+        sys.exit(1)
+
+    with connect() as conn:
+        sync_tables(conn, sys.argv[1:] or None)
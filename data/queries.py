@@ -0,0 +1,373 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+import pandas as pd
+from config import QUERY_CACHE_DIR, QUERY_CACHE_ENABLED, QUERY_CACHE_ENTRIES, QUERY_CACHE_MAX_BYTES
+from connect_sqlite import connect, table_versions
+from resolver import get_resolver
+from response_cache import NEVER, ResponseCache
+from schema import apply_schema
+from sql_writer import table_columns, table_exists
+
+GAMES_TABLE = 'ALL_GAMES_UNMERGED'
+RATINGS_TABLE = 'TEAM_GAME_RATINGS'
+STATS_TABLES = ['LEAGUE_PLAYER_STATS_PAST', 'LEAGUE_PLAYER_STATS_CURRENT']
+SHOT_KINDS = ['OVERALL', 'TYPE', 'CLOCK', 'DRIBBLE', 'CLOSEDEF', 'CLOSEDEF_10PLUS', 'TOUCHTIME']
+BOOKMARK_TABLE = 'Last_Updated'
+
+# TEAM_GAME_RATINGS columns team_games adds to each box score row, when ratings have been computed
+RATING_COLUMNS = ['OPP_TEAM_ID', 'HOME', 'POSS', 'OPP_POSS', 'ELO_PRE', 'ELO_POST', 'OPP_ELO_PRE', 'ELO_WIN_PROB',
+                  'FORM_GAMES', 'FORM_WINS', 'FORM_MARGIN', 'FORM_NET_RTG']
+
+enabled = QUERY_CACHE_ENABLED
+
+
+class QueryCache:
+    """
+    Two-level cache of query results: a bounded LRU of DataFrames in this process, in front of a ResponseCache on
+    disk shared by every process. Keys include the data version of the tables a query reads, so a result is never
+    served once those tables have been written to, and stale entries age out of both levels by LRU eviction.
+    """
+
+    def __init__(self, entries=QUERY_CACHE_ENTRIES, path=QUERY_CACHE_DIR, max_bytes=QUERY_CACHE_MAX_BYTES):
+        """
+        :param entries: Number of results kept in memory
+        :param path: Directory of the on-disk cache, or None to keep results in memory only
+        :param max_bytes: Total size of the on-disk cache above which the least recently used results are evicted
+        """
+        self.entries = entries
+        self.memory = OrderedDict()
+        self.disk = ResponseCache(path, max_bytes) if path else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, name, params):
+        """
+        :param name: Query name
+        :param params: Dict identifying the result, data version included
+        :return: Cached DataFrame, or None on a miss
+        """
+        key = ResponseCache.key(name, params)
+        with self.lock:
+            df = self.memory.get(key)
+            if df is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return df
+
+        df = self.disk.get(name, params) if self.disk is not None else None
+        with self.lock:
+            if df is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, df)
+
+        return df
+
+    def put(self, name, params, df):
+        """
+        Store a result in memory and on disk
+
+        :param name: Query name
+        :param params: Dict identifying the result, data version included
+        :param df: DataFrame
+        """
+        with self.lock:
+            self._remember(ResponseCache.key(name, params), df)
+        if self.disk is not None:
+            self.disk.put(name, params, df, ttl=NEVER)
+
+    def _remember(self, key, df):
+        self.memory[key] = df
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.entries:
+            self.memory.popitem(last=False)
+
+    def clear(self):
+        """
+        Drop the results held in memory. The on-disk cache is left alone
+        """
+        with self.lock:
+            self.memory.clear()
+
+    def summary(self):
+        """
+        :return: One-line hit/miss report
+        """
+        requests = self.hits + self.disk_hits + self.misses
+        rate = 100 * (self.hits + self.disk_hits) / requests if requests else 0.0
+        return (f'Query cache: {self.hits} memory hits, {self.disk_hits} disk hits, {self.misses} misses '
+                f'({rate:.1f}% hit rate), {len(self.memory)} results in memory')
+
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+def get_query_cache():
+    """
+    :return: The QueryCache of this process, created on first use
+    """
+    global _cache, _cache_pid
+    with _cache_lock:
+        if _cache is None or _cache_pid != os.getpid():
+            _cache = QueryCache()
+            _cache_pid = os.getpid()
+
+    return _cache
+
+
+def data_version(CONNECTION, tables):
+    """
+    Everything a cached result over some tables depends on: the write versions of the tables, the Last_Updated
+    bookmarks and the schema version, which changes when a table is created, dropped or altered. Read before the
+    query itself, so a write committed in between can only make the result newer than its version, never older.
+    Only reads: the versions are bumped by the writers, see sql_writer.bump_version
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param tables: List of table names the result is read from
+    :return: Dict of version components
+    """
+    bookmarks = CONNECTION.execute(f'SELECT Type, Date FROM {BOOKMARK_TABLE} ORDER BY Type').fetchall() \
+        if table_exists(CONNECTION, BOOKMARK_TABLE) else []
+
+    return {
+        'database': CONNECTION.execute('PRAGMA database_list').fetchone()[2],
+        'schema': CONNECTION.execute('PRAGMA schema_version').fetchone()[0],
+        'bookmarks': bookmarks,
+        'tables': table_versions(CONNECTION, tables),
+    }
+
+
+def cached_query(name, tables, params, compute, CONNECTION=None):
+    """
+    Return compute(CONNECTION), memoized until one of the tables it reads is written to or a Last_Updated bookmark
+    moves. Connections with uncommitted writes bypass the cache, since their versions may still be rolled back
+
+    Usage:
+        cached_query('team_names', ['TEAM_LIST'], {}, lambda conn: pd.read_sql_query('SELECT * FROM TEAM_LIST', conn))
+
+    :param name: Query name
+    :param tables: List of table names compute reads
+    :param params: Dict of the query's arguments
+    :param compute: Function of the connection returning a DataFrame
+    :param CONNECTION: Connection object representing the connection to the SQLite database. Default connect()
+    :return: DataFrame, a copy the caller is free to modify
+    """
+    CONNECTION = CONNECTION or connect()
+    if not enabled or CONNECTION.in_transaction:
+        return compute(CONNECTION)
+
+    params = {**params, 'version': data_version(CONNECTION, tables)}
+    cache = get_query_cache()
+    df = cache.get(name, params)
+    if df is None:
+        df = compute(CONNECTION)
+        cache.put(name, params, df)
+
+    return df.copy()
+
+
+def query_summary():
+    """
+    :return: One-line hit/miss report of this process's query cache, or a note that caching is disabled
+    """
+    if not enabled:
+        return 'Query cache: disabled'
+
+    return get_query_cache().summary()
+
+
+def _date(value):
+    """
+    :return: 'YYYY-MM-DD' text of a date, datetime, Timestamp or date string, as GAME_DATE is stored
+    """
+    return pd.Timestamp(value).strftime('%Y-%m-%d')
+
+
+def _team(team):
+    """
+    :return: TEAM_ID of a team ID, name, nickname or abbreviation
+    """
+    if isinstance(team, str):
+        id = get_resolver().team_id(team)
+        if id is None:
+            raise ValueError(f'Unknown team: {team}')
+        return id
+
+    return int(team)
+
+
+def _player(player):
+    """
+    :return: PLAYER_ID of a player ID or name
+    """
+    if isinstance(player, str):
+        id = get_resolver().player_id(player)
+        if id is None:
+            raise ValueError(f'Unknown player: {player}')
+        return id
+
+    return int(player)
+
+
+def _season_filter(season):
+    """
+    :param season: Season as 'YYYY-YY', which matches every season type, or a SEASON_ID like '22022'
+    :return: Tuple of (SQL condition on SEASON_ID, parameter)
+    """
+    if re.fullmatch(r'\d{4}-\d{2}', season):
+        return 'substr(SEASON_ID, 2) = ?', season[:4]
+
+    return 'SEASON_ID = ?', season
+
+
+def _read(CONNECTION, table, where, params, order):
+    """
+    :return: Rows of a table matching the conditions, in the compact dtypes of the schema registry. Empty if the
+        table does not exist yet
+    """
+    if not table_exists(CONNECTION, table):
+        return pd.DataFrame()
+
+    query = f'SELECT * FROM "{table}"' + (f' WHERE {" AND ".join(where)}' if where else '') + f' ORDER BY {order}'
+    return apply_schema(pd.read_sql_query(query, CONNECTION, params=params), table)
+
+
+def games_between(start, end, team=None, CONNECTION=None):
+    """
+    Box scores of every team game played between two dates
+
+    Usage:
+        games = games_between('2023-01-01', '2023-01-31', team='GSW')
+
+    :param start: First date, inclusive: 'YYYY-MM-DD', date, datetime or Timestamp
+    :param end: Last date, inclusive
+    :param team: Only this team's games: TEAM_ID, name, nickname or abbreviation. Default every team
+    :param CONNECTION: Connection object representing the connection to the SQLite database. Default connect()
+    :return: DataFrame of ALL_GAMES_UNMERGED rows ordered by GAME_DATE and GAME_ID
+    """
+    where, params = ['GAME_DATE BETWEEN ? AND ?'], [_date(start), _date(end)]
+    if team is not None:
+        where.append('TEAM_ID = ?')
+        params.append(_team(team))
+
+    return cached_query('games_between', [GAMES_TABLE], {'where': where, 'params': params},
+                        lambda conn: _read(conn, GAMES_TABLE, where, params, 'GAME_DATE, GAME_ID, TEAM_ID'),
+                        CONNECTION)
+
+
+def team_games(team, season=None, CONNECTION=None):
+    """
+    A team's game log: its box score rows, with opponent, possessions, Elo and rolling form from TEAM_GAME_RATINGS
+    once team_ratings.py has rated the games
+
+    :param team: TEAM_ID, name, nickname or abbreviation
+    :param season: Season as 'YYYY-YY' (every season type) or a SEASON_ID like '22022'. Default every season
+    :param CONNECTION: Connection object representing the connection to the SQLite database. Default connect()
+    :return: DataFrame ordered by GAME_DATE
+    """
+    where, params = ['TEAM_ID = ?'], [_team(team)]
+    if season is not None:
+        condition, value = _season_filter(season)
+        where.append(condition)
+        params.append(value)
+
+    def compute(conn):
+        games = _read(conn, GAMES_TABLE, where, params, 'GAME_DATE, GAME_ID')
+        if games.empty or not table_exists(conn, RATINGS_TABLE):
+            return games
+
+        columns = [col for col in RATING_COLUMNS if col in table_columns(conn, RATINGS_TABLE)]
+        ratings = _read(conn, RATINGS_TABLE, where, params, 'GAME_DATE, GAME_ID')[['GAME_ID', 'TEAM_ID'] + columns]
+        return games.merge(ratings, on=['GAME_ID', 'TEAM_ID'], how='left')
+
+    return cached_query('team_games', [GAMES_TABLE, RATINGS_TABLE], {'where': where, 'params': params}, compute,
+                        CONNECTION)
+
+
+def player_season_stats(season=None, player=None, CONNECTION=None):
+    """
+    League-player stats by season, from LEAGUE_PLAYER_STATS_PAST and LEAGUE_PLAYER_STATS_CURRENT
+
+    Usage:
+        league = player_season_stats('2015-16')
+        curry = player_season_stats(player='Stephen Curry')
+
+    :param season: Season as 'YYYY-YY'. Default every season
+    :param player: Only this player: PLAYER_ID or name. Default every player
+    :param CONNECTION: Connection object representing the connection to the SQLite database. Default connect()
+    :return: DataFrame ordered by SEASON and PLAYER_ID
+    """
+    where, params = [], []
+    if season is not None:
+        where.append('SEASON = ?')
+        params.append(season)
+    if player is not None:
+        where.append('PLAYER_ID = ?')
+        params.append(_player(player))
+
+    def compute(conn):
+        frames = [_read(conn, table, where, params, 'SEASON, PLAYER_ID') for table in STATS_TABLES]
+        frames = [df.drop(columns=['index'], errors='ignore') for df in frames if not df.empty]
+        if not frames:
+            return pd.DataFrame()
+        return apply_schema(pd.concat(frames, ignore_index=True), STATS_TABLES[0])
+
+    return cached_query('player_season_stats', STATS_TABLES, {'where': where, 'params': params}, compute, CONNECTION)
+
+
+def shot_profile(player, season=None, kind='OVERALL', CONNECTION=None):
+    """
+    A player's shooting splits from the SHOT_*_PAST and SHOT_*_CURRENT tables
+
+    :param player: PLAYER_ID or name
+    :param season: Season as 'YYYY-YY'. Default every season
+    :param kind: Split, one of SHOT_KINDS: 'OVERALL', 'TYPE', 'CLOCK', 'DRIBBLE', 'CLOSEDEF', 'CLOSEDEF_10PLUS' or
+        'TOUCHTIME'
+    :param CONNECTION: Connection object representing the connection to the SQLite database. Default connect()
+    :return: DataFrame ordered by SEASON
+    """
+    if kind not in SHOT_KINDS:
+        raise ValueError(f'Invalid shot profile kind: {kind}')
+
+    tables = [f'SHOT_{kind}_PAST', f'SHOT_{kind}_CURRENT']
+    where, params = ['PLAYER_ID = ?'], [_player(player)]
+    if season is not None:
+        where.append('SEASON = ?')
+        params.append(season)
+
+    def compute(conn):
+        frames = [_read(conn, table, where, params, 'SEASON') for table in tables]
+        frames = [df.drop(columns=['index'], errors='ignore') for df in frames if not df.empty]
+        if not frames:
+            return pd.DataFrame()
+        return apply_schema(pd.concat(frames, ignore_index=True), tables[0])
+
+    return cached_query('shot_profile', tables, {'kind': kind, 'where': where, 'params': params}, compute,
+                        CONNECTION)
+
+
+if __name__ == '__main__':
+    # Time a cold and a warm call of each query against the local database
+    for label, call in [('games_between', lambda: games_between('2022-10-01', '2023-06-30')),
+                        ('player_season_stats', lambda: player_season_stats()),
+                        ('team_games', lambda: team_games('GSW')),
+                        ('shot_profile', lambda: shot_profile('Stephen Curry'))]:
+        timings = []
+        try:
+            for _ in range(2):
+                start = time.perf_counter()
+                rows = len(call())
+                timings.append(time.perf_counter() - start)
+        except ValueError as e:
+            print(f'{label:<20} {e}')
+            continue
+        print(f'{label:<20} {rows:>8} rows  first {timings[0] * 1000:>8.1f} ms  repeat {timings[1] * 1000:>6.1f} ms')
+    print(query_summary())
@@ -0,0 +1,226 @@
+import difflib
+import re
+import threading
+import unicodedata
+from functools import lru_cache
+import pandas as pd
+from connect_sqlite import connect
+from sql_writer import table_exists
+
+PLAYER_TABLES = ['PLAYER_LIST_ACTIVE', 'PLAYER_LIST_INACTIVE']
+TEAM_TABLE = 'TEAM_LIST'
+
+# Minimum difflib similarity ratio for a fuzzy match, and how many distinct misspellings are remembered
+FUZZY_CUTOFF = 0.85
+FUZZY_CACHE_SIZE = 4096
+
+SUFFIXES = re.compile(r'\s+(jr|sr|ii|iii|iv|v)$')
+
+
+@lru_cache(maxsize=65536)
+def normalize_name(name):
+    """
+    Normalize a name for lookups: accents, case, periods and apostrophes are dropped, hyphens become spaces, so
+    'Nikola Jokić', 'nikola jokic' and 'NIKOLA JOKIC' share one key
+
+    :param name: Player or team name
+    :return: Normalized name, '' for missing values
+    """
+    if not isinstance(name, str):
+        return ''
+
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii').lower()
+    name = re.sub(r"[.'`,]", '', name).replace('-', ' ')
+    return ' '.join(name.split())
+
+
+class Resolver:
+    """
+    In-memory indexes over the static player and team lists, mapping IDs, names, last names, team abbreviations and
+    nicknames to IDs with dict lookups. Names that miss every index fall back to difflib fuzzy matching, cached per
+    distinct misspelling.
+
+    Usage:
+        resolver = get_resolver()
+        resolver.player_id('Stephen Curry')
+        shots['PLAYER_ID'] = resolver.resolve_players(shots['NAME'])
+    """
+
+    def __init__(self, players, teams, cutoff=FUZZY_CUTOFF):
+        """
+        :param players: DataFrame of PLAYER_LIST_ACTIVE and PLAYER_LIST_INACTIVE rows: id, full_name, first_name,
+            last_name, is_active
+        :param teams: DataFrame of TEAM_LIST rows: id, full_name, abbreviation, nickname, city
+        :param cutoff: Minimum similarity ratio in [0, 1] for fuzzy matches
+        """
+        self.cutoff = cutoff
+
+        # Where several players share a name, active players win, then the most recent (highest) ID
+        players = players.sort_values(['is_active', 'id'], ascending=False).drop_duplicates('id')
+        self.players = players.set_index('id', drop=False)
+        self.teams = teams.set_index('id', drop=False)
+
+        self.player_by_name = {}
+        self.player_by_last = {}
+        keys = [normalize_name(name) for name in players['full_name']]
+        for id, key, last_name in zip(players['id'], keys, players['last_name']):
+            self.player_by_name.setdefault(key, int(id))
+            self.player_by_last.setdefault(normalize_name(last_name), []).append(int(id))
+        # Names without their suffix come second, so 'Gary Payton' stays Gary Payton rather than Gary Payton II
+        for id, key in zip(players['id'], keys):
+            self.player_by_name.setdefault(SUFFIXES.sub('', key), int(id))
+
+        self.team_by_name = {}
+        for column in ['full_name', 'nickname', 'abbreviation']:
+            for id, name in zip(teams['id'], teams[column]):
+                self.team_by_name.setdefault(normalize_name(name), int(id))
+
+        self.player_names = list(self.player_by_name)
+        self.team_names = list(self.team_by_name)
+        self._fuzzy_player = lru_cache(maxsize=FUZZY_CACHE_SIZE)(self._fuzzy_player)
+        self._fuzzy_team = lru_cache(maxsize=FUZZY_CACHE_SIZE)(self._fuzzy_team)
+
+    @classmethod
+    def from_db(cls, conn, cutoff=FUZZY_CUTOFF):
+        """
+        Build a resolver from the local database, without any network access
+
+        :param conn: Connection object representing the connection to the SQLite database
+        :param cutoff: Minimum similarity ratio for fuzzy matches
+        :return: Resolver
+        """
+        players = [pd.read_sql_query(f'SELECT id, full_name, first_name, last_name, is_active FROM {table}', conn)
+                   for table in PLAYER_TABLES if table_exists(conn, table)]
+        players = pd.concat(players, ignore_index=True) if players else \
+            pd.DataFrame(columns=['id', 'full_name', 'first_name', 'last_name', 'is_active'])
+
+        if table_exists(conn, TEAM_TABLE):
+            teams = pd.read_sql_query(f'SELECT id, full_name, abbreviation, nickname, city FROM {TEAM_TABLE}', conn)
+        else:
+            teams = pd.DataFrame(columns=['id', 'full_name', 'abbreviation', 'nickname', 'city'])
+
+        return cls(players, teams, cutoff)
+
+    def _fuzzy_player(self, key):
+        match = difflib.get_close_matches(key, self.player_names, n=1, cutoff=self.cutoff)
+        return self.player_by_name[match[0]] if match else None
+
+    def _fuzzy_team(self, key):
+        match = difflib.get_close_matches(key, self.team_names, n=1, cutoff=self.cutoff)
+        return self.team_by_name[match[0]] if match else None
+
+    def _player_key(self, key, fuzzy):
+        id = self.player_by_name.get(key)
+        if id is None:
+            id = self.player_by_name.get(SUFFIXES.sub('', key))
+        if id is None:
+            # A bare last name resolves only when a single player has it
+            ids = self.player_by_last.get(key, [])
+            id = ids[0] if len(ids) == 1 else None
+        if id is None and fuzzy and key:
+            id = self._fuzzy_player(key)
+
+        return id
+
+    def _team_key(self, key, fuzzy):
+        id = self.team_by_name.get(key)
+        if id is None and fuzzy and key:
+            id = self._fuzzy_team(key)
+
+        return id
+
+    def player_id(self, name, fuzzy=True):
+        """
+        :param name: Full name, or a last name that only one player has. Case, accents and suffixes are ignored
+        :param fuzzy: Whether to fall back to the closest name for misspellings
+        :return: Player ID, or None if the name cannot be resolved
+        """
+        return self._player_key(normalize_name(name), fuzzy)
+
+    def team_id(self, name, fuzzy=True):
+        """
+        :param name: Full name ('Golden State Warriors'), nickname ('Warriors') or abbreviation ('GSW')
+        :param fuzzy: Whether to fall back to the closest name for misspellings
+        :return: Team ID, or None if the name cannot be resolved
+        """
+        return self._team_key(normalize_name(name), fuzzy)
+
+    def _resolve(self, names, lookup, fuzzy):
+        names = pd.Series(names)
+        codes, uniques = pd.factorize(names, use_na_sentinel=True)
+
+        # Each distinct name is normalized and looked up once, then broadcast back to every row
+        ids = pd.array([lookup(normalize_name(name), fuzzy) for name in uniques], dtype='Int64')
+        result = pd.Series(ids.take(codes, allow_fill=True), index=names.index, dtype='Int64')
+
+        return result.rename(names.name)
+
+    def resolve_players(self, names, fuzzy=True):
+        """
+        Bulk player_id for a column of names
+
+        :param names: Series or array-like of player names
+        :param fuzzy: Whether to fall back to the closest name for misspellings
+        :return: Int64 Series of player IDs with the index of names, <NA> where a name cannot be resolved
+        """
+        return self._resolve(names, self._player_key, fuzzy)
+
+    def resolve_teams(self, names, fuzzy=True):
+        """
+        Bulk team_id for a column of team names, nicknames or abbreviations
+
+        :param names: Series or array-like of team names
+        :param fuzzy: Whether to fall back to the closest name for misspellings
+        :return: Int64 Series of team IDs with the index of names, <NA> where a name cannot be resolved
+        """
+        return self._resolve(names, self._team_key, fuzzy)
+
+    def player(self, id):
+        """
+        :return: Dict of the player's PLAYER_LIST row, or None for an unknown ID
+        """
+        return self.players.loc[id].to_dict() if id in self.players.index else None
+
+    def team(self, id):
+        """
+        :return: Dict of the team's TEAM_LIST row, or None for an unknown ID
+        """
+        return self.teams.loc[id].to_dict() if id in self.teams.index else None
+
+    def players_named(self, last_name):
+        """
+        :return: List of IDs of every player with the given last name
+        """
+        return list(self.player_by_last.get(normalize_name(last_name), []))
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_resolver(refresh=False):
+    """
+    :param refresh: Whether to reload the indexes, e.g. after download_team_and_player_static_list.py has run
+    :return: The Resolver of this process, loaded from the database on first use
+    """
+    global _resolver
+    with _resolver_lock:
+        if _resolver is None or refresh:
+            with connect() as conn:
+                _resolver = Resolver.from_db(conn)
+
+    return _resolver
+
+
+def player_id(name, fuzzy=True):
+    """
+    :return: Player ID of a name, or None. See Resolver.player_id
+    """
+    return get_resolver().player_id(name, fuzzy)
+
+
+def team_id(name, fuzzy=True):
+    """
+    :return: Team ID of a name, or None. See Resolver.team_id
+    """
+    return get_resolver().team_id(name, fuzzy)
@@ -0,0 +1,236 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+import metrics
+from config import CACHE_DAILY_CUTOFF, CACHE_DIR, CACHE_ENABLED, CACHE_MAX_BYTES, CURRENT_SEASON
+
+# TTL policies: seconds, NEVER, or DAILY. NEVER entries are only removed by LRU eviction. DAILY entries expire at the
+# next CACHE_DAILY_CUTOFF, so every scheduled run after the cutoff downloads fresh data, however late the previous
+# run stored its response
+NEVER = None
+DAILY = 'daily'
+
+# Endpoint arguments that do not change the response and are left out of the cache key
+TRANSPORT_PARAMS = ('timeout', 'proxy', 'headers')
+
+
+def season_ttl(season):
+    """
+    TTL policy for season-scoped responses: completed seasons never change, the current season expires at the daily
+    cutoff
+
+    :param season: str representing a season, in the format 'YYYY-YY'
+    :return: DAILY or NEVER
+    """
+    return DAILY if season >= CURRENT_SEASON else NEVER
+
+
+def expires_at(ttl, now):
+    """
+    :param ttl: TTL policy: seconds, NEVER or DAILY
+    :param now: Time the entry is stored, as a Unix timestamp
+    :return: Unix timestamp the entry expires at, or None for NEVER
+    """
+    if ttl is NEVER:
+        return None
+    if ttl != DAILY:
+        return now + ttl
+
+    hour, minute = (int(part) for part in CACHE_DAILY_CUTOFF.split(':'))
+    stored = datetime.fromtimestamp(now)
+    cutoff = stored.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if cutoff <= stored:
+        cutoff += timedelta(days=1)
+    return cutoff.timestamp()
+
+
+class ResponseCache:
+    """
+    On-disk cache of nba_api responses keyed by endpoint and parameters, with per-entry TTL and size-bounded LRU
+    eviction. Each entry is a pickle of the endpoint's data frames; an SQLite index next to the files tracks size,
+    expiry and last access. Safe to share between threads, and between processes through the index database.
+    """
+
+    def __init__(self, path=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        """
+        :param path: Directory holding the cache files
+        :param max_bytes: Total size of cached files above which the least recently used entries are evicted
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        self.index = sqlite3.connect(os.path.join(path, 'index.db'), timeout=30, check_same_thread=False)
+        self.index.execute('CREATE TABLE IF NOT EXISTS ENTRIES (KEY TEXT PRIMARY KEY, ENDPOINT TEXT, SIZE INTEGER, '
+                           'CREATED REAL, EXPIRES REAL, LAST_ACCESS REAL)')
+        self.index.commit()
+
+    @staticmethod
+    def key(endpoint, params):
+        """
+        :param endpoint: Name of the endpoint
+        :param params: Dict of endpoint parameters
+        :return: Cache key
+        """
+        params = {k: v for k, v in params.items() if k not in TRANSPORT_PARAMS}
+        text = endpoint + json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def file(self, key):
+        return os.path.join(self.path, key[:2], f'{key}.pkl')
+
+    def get(self, endpoint, params):
+        """
+        :param endpoint: Name of the endpoint
+        :param params: Dict of endpoint parameters
+        :return: Cached list of DataFrames, or None on a miss or expired entry
+        """
+        key = self.key(endpoint, params)
+        now = time.time()
+        with self.lock:
+            row = self.index.execute('SELECT EXPIRES FROM ENTRIES WHERE KEY = ?', (key,)).fetchone()
+            if row is None or (row[0] is not None and row[0] < now):
+                self.misses += 1
+                return None
+
+            try:
+                with open(self.file(key), 'rb') as f:
+                    frames = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                self.index.execute('DELETE FROM ENTRIES WHERE KEY = ?', (key,))
+                self.index.commit()
+                self.misses += 1
+                return None
+
+            self.index.execute('UPDATE ENTRIES SET LAST_ACCESS = ? WHERE KEY = ?', (now, key))
+            self.index.commit()
+            self.hits += 1
+
+        return frames
+
+    def put(self, endpoint, params, frames, ttl=DAILY):
+        """
+        Store a response and evict least recently used entries if the cache is over its size limit
+
+        :param endpoint: Name of the endpoint
+        :param params: Dict of endpoint parameters
+        :param frames: List of DataFrames returned by the endpoint
+        :param ttl: TTL policy: seconds until the entry expires, DAILY or NEVER
+        """
+        key = self.key(endpoint, params)
+        file = self.file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+
+        # Write to a temporary file first so readers never see a partial pickle
+        tmp = f'{file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(frames, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, file)
+
+        now = time.time()
+        expires = expires_at(ttl, now)
+        with self.lock:
+            self.index.execute('INSERT OR REPLACE INTO ENTRIES VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, endpoint, os.path.getsize(file), now, expires, now))
+            self.index.commit()
+            self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache is within max_bytes. Called with the lock held.
+        """
+        total = self.index.execute('SELECT COALESCE(SUM(SIZE), 0) FROM ENTRIES').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        for key, size in self.index.execute('SELECT KEY, SIZE FROM ENTRIES ORDER BY LAST_ACCESS').fetchall():
+            try:
+                os.remove(self.file(key))
+            except OSError:
+                pass
+            self.index.execute('DELETE FROM ENTRIES WHERE KEY = ?', (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+        self.index.commit()
+
+    def summary(self):
+        """
+        :return: One-line hit/miss report for the run log
+        """
+        requests = self.hits + self.misses
+        rate = 100 * self.hits / requests if requests else 0.0
+        entries, size = self.index.execute('SELECT COUNT(*), COALESCE(SUM(SIZE), 0) FROM ENTRIES').fetchone()
+        return (f'Response cache: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate), '
+                f'{entries} entries, {size / 1024 ** 2:.1f} MB')
+
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+enabled = CACHE_ENABLED
+
+
+def get_cache():
+    """
+    :return: The ResponseCache of this process, created on first use
+    """
+    global _cache, _cache_pid
+    with _cache_lock:
+        if _cache is None or _cache_pid != os.getpid():
+            _cache = ResponseCache()
+            _cache_pid = os.getpid()
+
+    return _cache
+
+
+def cached_call(endpoint, ttl=DAILY, refresh=False, **params):
+    """
+    Return endpoint(**params).get_data_frames(), served from the response cache when a fresh entry exists
+
+    :param endpoint: nba_api endpoint class, e.g. leaguegamefinder.LeagueGameFinder
+    :param ttl: TTL policy of a newly stored response: seconds, DAILY or NEVER. See season_ttl
+    :param refresh: Whether to ignore a cached entry and store a new response, for data known to have changed
+    :param params: Keyword arguments for the endpoint
+    :return: List of DataFrames
+    """
+    name = endpoint.__name__
+    cache = get_cache() if enabled else None
+    if cache is not None and not refresh:
+        start = time.perf_counter()
+        frames = cache.get(name, params)
+        if frames is not None:
+            metrics.record('request', name, time.perf_counter() - start, 'cache',
+                           rows=sum(len(df) for df in frames))
+            return frames
+
+    # Every request that reaches the network is recorded, failed attempts with their exception type
+    with metrics.measure('request', name, metrics.next_attempt(name, ResponseCache.key(name, params))) as event:
+        response = endpoint(**params)
+        frames = response.get_data_frames()
+        event['bytes'] = metrics.payload_bytes(response, frames)
+        event['rows'] = sum(len(df) for df in frames)
+
+    if cache is not None:
+        cache.put(name, params, frames, ttl)
+
+    return frames
+
+
+def cache_summary():
+    """
+    :return: One-line hit/miss report of this process's cache, or a note that caching is disabled
+    """
+    if not enabled:
+        return 'Response cache: disabled'
+
+    return get_cache().summary()
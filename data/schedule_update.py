@@ -1,14 +1,16 @@
 import schedule
 import time
-import os
+from job_runner import DAILY_JOBS, run_jobs
 
 
 def job():
-    os.system('python3 download_games.py >> log.txt 2')
-    os.system('python3 download_league_player_stats.py >> log.txt 2>&1')
+    run_jobs(DAILY_JOBS)
 
-schedule.every().day.at('06:00').do(job)
 
-while True:
-    schedule.run_pending()
-    time.sleep(1)
\ No newline at end of file
+if __name__ == '__main__':
+    # Guarded so the job processes, which import this module when spawned, do not start their own scheduler
+    schedule.every().day.at('06:00').do(job)
+
+    while True:
+        schedule.run_pending()
+        time.sleep(1)
@@ -0,0 +1,248 @@
+import io
+import sqlite3
+import sys
+import numpy as np
+import pandas as pd
+from connect_sqlite import connect
+from sql_writer import table_exists
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Compact dtypes by column name, shared by every table with the column. The _A and _B columns of ALL_GAMES_MERGED
+# use the dtype of their base column, and *_PCT and *_FREQUENCY columns are float32.
+#   'category' - low-cardinality text, stored once per distinct value
+#   'int8', 'int16', 'int32' - IDs and counts. Columns with missing values become the nullable Int8/Int16/Int32,
+#       and values outside the range keep the smallest integer type they fit
+#   'float32' - percentages and other fractions, which nba_api rounds to three decimals anyway
+#   'bool' - flags
+#   'date' - ISO date text, parsed to datetime64
+COLUMN_DTYPES = {
+    **dict.fromkeys(['PLAYER_ID', 'TEAM_ID', 'OPP_TEAM_ID', 'id', 'ID'], 'int32'),
+    **dict.fromkeys(['SEASON_ID', 'SEASON', 'LEAGUE_ID', 'TEAM_ABBREVIATION', 'TEAM_NAME', 'MATCHUP', 'WL', 'TYPE',
+                     'SCOPE', 'SHOT_TYPE', 'SHOT_CLOCK_RANGE', 'DRIBBLE_RANGE', 'CLOSE_DEF_DIST_RANGE',
+                     'TOUCH_TIME_RANGE', 'ACTION_TYPE', 'SHOT_ZONE_BASIC', 'SHOT_ZONE_AREA', 'SHOT_ZONE_RANGE',
+                     'abbreviation', 'city', 'state', 'nickname'], 'category'),
+    **dict.fromkeys(['GP', 'GS', 'G', 'W', 'L', 'FGM', 'FGA', 'FG2M', 'FG2A', 'FG3M', 'FG3A', 'FTM', 'FTA', 'OREB',
+                     'DREB', 'REB', 'AST', 'STL', 'BLK', 'TOV', 'PF', 'PTS', 'OPP_PTS', 'PLUS_MINUS', 'MARGIN', 'RANK',
+                     'SORT_ORDER', 'GAME_EVENT_ID', 'SHOT_DISTANCE', 'LOC_X', 'LOC_Y', 'CELL', 'year_founded'],
+                    'int16'),
+    **dict.fromkeys(['PERIOD', 'MINUTES_REMAINING', 'SECONDS_REMAINING', 'SHOT_MADE_FLAG', 'HOME', 'WIN'], 'int8'),
+    **dict.fromkeys(['MIN', 'PLAYER_AGE', 'POSS', 'OPP_POSS'], 'float32'),
+    **dict.fromkeys(['IS_ACTIVE', 'is_active', 'SEASON_CURRENT'], 'bool'),
+    'GAME_DATE': 'date',
+}
+
+# Per-table exceptions to COLUMN_DTYPES
+TABLE_DTYPES = {
+    # Career totals run past the int16 range
+    'ALLTIMELEADERS': {'VALUE': 'int32'},
+    # Team histories summed over a season
+    'TEAM_SPLITS': {'PTS': 'int32', 'OPP_PTS': 'int32'},
+}
+
+FRACTION_SUFFIXES = ('_PCT', '_FREQUENCY')
+SIDE_SUFFIXES = ('_A', '_B')
+
+# dtype names applied when writing. Floats keep full precision and dates stay ISO text, since float32 values are not
+# the decimals nba_api sent and the tables compare GAME_DATE as text
+LOSSLESS = {'category', 'int8', 'int16', 'int32', 'bool'}
+
+
+def column_dtype(table, column):
+    """
+    :param table: Table name, or None for COLUMN_DTYPES alone
+    :param column: Column name
+    :return: Compact dtype name of the column, or None for columns without one
+    """
+    dtype = TABLE_DTYPES.get(table, {}).get(column, COLUMN_DTYPES.get(column))
+    if dtype is None and column.endswith(SIDE_SUFFIXES):
+        dtype = column_dtype(table, column[:-2])
+    if dtype is None and column.endswith(FRACTION_SUFFIXES):
+        dtype = 'float32'
+
+    return dtype
+
+
+def table_schema(table, columns):
+    """
+    :param table: Table name
+    :param columns: Column names
+    :return: Dict of the columns with a compact dtype to its name
+    """
+    schema = {}
+    for column in columns:
+        dtype = column_dtype(table, column)
+        if dtype is not None:
+            schema[column] = dtype
+
+    return schema
+
+
+def _integers(series, dtype):
+    """
+    :return: series as the integer dtype, nullable if it has missing values, widened to the smallest integer type the
+        values fit if they are out of range. series unchanged if it holds text or fractions
+    """
+    if series.dtype.kind not in 'iufb':
+        try:
+            series = pd.to_numeric(series)
+        except (ValueError, TypeError):
+            return series
+
+    values = series.dropna()
+    if series.dtype.kind == 'f' and not (values % 1 == 0).all():
+        return series
+    if len(values) and (values.min() < np.iinfo(dtype).min or values.max() > np.iinfo(dtype).max):
+        dtype = pd.to_numeric(values, downcast='integer').dtype.name
+
+    return series.astype(dtype.capitalize() if len(values) < len(series) else dtype)
+
+
+def cast_column(series, dtype, lossless=False):
+    """
+    :param series: Column of a DataFrame
+    :param dtype: Compact dtype name, see COLUMN_DTYPES
+    :param lossless: Whether to skip float32 and date conversions, for frames that are about to be written
+    :return: Column with the dtype
+    """
+    if lossless and dtype not in LOSSLESS:
+        return series
+
+    if dtype == 'category':
+        return series if isinstance(series.dtype, pd.CategoricalDtype) else series.astype('category')
+    if dtype == 'date':
+        return pd.to_datetime(series, format='ISO8601', errors='coerce')
+    if dtype == 'bool':
+        return series.astype('boolean' if series.isna().any() else bool)
+    if dtype == 'float32':
+        return series.astype('float32') if series.dtype.kind in 'iuf' else series
+
+    return _integers(series, dtype)
+
+
+def apply_schema(df, table=None, lossless=False):
+    """
+    Convert a DataFrame to the compact dtypes of its table, e.g. right after download or after reading it back.
+    Columns without a compact dtype are left alone
+
+    Usage:
+        games = apply_schema(pd.read_sql_query('SELECT * FROM ALL_GAMES_UNMERGED', conn), 'ALL_GAMES_UNMERGED')
+
+    :param df: DataFrame
+    :param table: Table the frame belongs to, for TABLE_DTYPES. Default COLUMN_DTYPES alone
+    :param lossless: Whether to keep floats and dates as they are, so values written to SQLite do not change
+    :return: DataFrame with compact dtypes
+    """
+    changed = {}
+    for column, dtype in table_schema(table, df.columns).items():
+        series = cast_column(df[column], dtype, lossless)
+        if series is not df[column]:
+            changed[column] = series
+
+    return df.assign(**changed) if changed else df
+
+
+def read_sql(query, CONNECTION, table, params=()):
+    """
+    pd.read_sql_query with the compact dtypes of a table
+
+    :param query: SQL query
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param table: Table the query reads, for TABLE_DTYPES
+    :param params: Query parameters
+    :return: DataFrame with compact dtypes
+    """
+    return apply_schema(pd.read_sql_query(query, CONNECTION, params=params), table)
+
+
+def table_bytes(CONNECTION, table):
+    """
+    :return: Bytes of the pages a table takes in the database file, its indexes excluded, or None if SQLite was built
+        without the dbstat virtual table
+    """
+    try:
+        return CONNECTION.execute('SELECT SUM(pgsize) FROM dbstat WHERE name = ?', (table,)).fetchone()[0] or 0
+    except sqlite3.OperationalError:
+        return None
+
+
+def _sqlite_bytes(df, table):
+    conn = sqlite3.connect(':memory:')
+    try:
+        df.to_sql(table, conn, index=False)
+        return table_bytes(conn, table)
+    finally:
+        conn.close()
+
+
+def _parquet_bytes(df):
+    if pa is None:
+        return None
+    buffer = io.BytesIO()
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), buffer, compression='zstd')
+    return buffer.tell()
+
+
+def size_report(CONNECTION, tables=None):
+    """
+    Measure what the compact dtypes save per table: pandas memory as read from SQLite and after apply_schema, the
+    table rewritten to a fresh SQLite database as stored and with the lossless schema, and a zstd Parquet file as
+    stored and with the full schema
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :param tables: List of table names. Default every table with columns in the registry
+    :return: DataFrame of bytes per table
+    """
+    if tables is None:
+        tables = [row[0] for row in CONNECTION.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+
+    rows = []
+    for table in tables:
+        if not table_exists(CONNECTION, table):
+            continue
+        df = pd.read_sql_query(f'SELECT * FROM "{table}"', CONNECTION)
+        if not table_schema(table, df.columns):
+            continue
+
+        compact = apply_schema(df, table)
+        rows.append((table, len(df), df.memory_usage(deep=True).sum(), compact.memory_usage(deep=True).sum(),
+                     table_bytes(CONNECTION, table), _sqlite_bytes(df, table),
+                     _sqlite_bytes(apply_schema(df, table, lossless=True), table), _parquet_bytes(df),
+                     _parquet_bytes(compact)))
+
+    columns = ['TABLE', 'ROWS', 'PANDAS', 'PANDAS_COMPACT', 'SQLITE_FILE', 'SQLITE', 'SQLITE_COMPACT', 'PARQUET',
+               'PARQUET_COMPACT']
+    return pd.DataFrame(rows, columns=columns)
+
+
+def format_report(report):
+    """
+    :param report: DataFrame returned by size_report
+    :return: Report in MB per table with the saving of each format, as printable text
+    """
+    def mb(value):
+        return f'{value / 2 ** 20:>8.2f}' if pd.notna(value) else f'{"-":>8}'
+
+    def saving(before, after):
+        return f'{1 - after / before:>6.0%}' if pd.notna(before) and pd.notna(after) and before else f'{"-":>6}'
+
+    lines = [f'{"table":<28} {"rows":>9} {"pandas":>8} {"compact":>8} {"saved":>6} {"sqlite":>8} {"compact":>8} '
+             f'{"saved":>6} {"parquet":>8} {"compact":>8} {"saved":>6}']
+    totals = report.drop(columns=['TABLE']).sum(min_count=1)
+    for row in list(report.itertuples(index=False)) + [('total', *totals)]:
+        table, rows, pandas, pandas_compact, _, sqlite, sqlite_compact, parquet, parquet_compact = row
+        lines.append(f'{table:<28} {int(rows):>9} {mb(pandas)} {mb(pandas_compact)} {saving(pandas, pandas_compact)} '
+                     f'{mb(sqlite)} {mb(sqlite_compact)} {saving(sqlite, sqlite_compact)} {mb(parquet)} '
+                     f'{mb(parquet_compact)} {saving(parquet, parquet_compact)}')
+
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    # python schema.py [table ...] reports the bytes the compact dtypes save per table, in MB
+    with connect() as conn:
+        print(format_report(size_report(conn, sys.argv[1:] or None)))
@@ -0,0 +1,300 @@
+import json
+import sqlite3
+import pandas as pd
+from connect_sqlite import ALL, PARTITION_VERSIONS_TABLE, PARTITIONS, VERSIONS_TABLE
+from metrics import timed_write
+
+
+def table_exists(conn, table):
+    """
+    :param conn: Connection object representing the connection to the SQLite database
+    :param table: Table name
+    :return: Whether the table exists
+    """
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    return row is not None
+
+
+def table_columns(conn, table):
+    """
+    :param conn: Connection object representing the connection to the SQLite database
+    :param table: Table name
+    :return: List of column names of the table
+    """
+    return [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+
+
+def partition_keys(table, rows=None):
+    """
+    :param table: Table name
+    :param rows: DataFrame of the rows a write touched, or None
+    :return: List of the JSON keys of the table's partitions the rows fall in, [ALL] when they are unknown, or an empty
+        list for tables without partitions
+    """
+    season_col = PARTITIONS.get(table)
+    if season_col is None:
+        return []
+    if rows is None or season_col not in rows or rows[season_col].isna().any():
+        return [ALL]
+    return [json.dumps(season) for season in rows[season_col].drop_duplicates().tolist()]
+
+
+def bump_version(conn, table, rows=None):
+    """
+    Count a write to a table in TABLE_VERSIONS, once per write call rather than per row, in the caller's transaction,
+    so the bump commits or rolls back with the rows it describes. Every function that writes rows calls this. The
+    seasons written are recorded in PARTITION_VERSIONS for tables partitioned in PARTITIONS
+
+    :param conn: Connection object representing the connection to the SQLite database
+    :param table: Table name
+    :param rows: DataFrame of the rows written or deleted, holding the table's season column. Default None records
+        the write against every season
+    """
+    sql = (f'INSERT INTO {VERSIONS_TABLE} (NAME, VERSION) VALUES (?, 1) '
+           'ON CONFLICT (NAME) DO UPDATE SET VERSION = VERSION + 1')
+    partitions_sql = (f'INSERT INTO {PARTITION_VERSIONS_TABLE} (NAME, SEASON, VERSION) '
+                      f'SELECT ?, ?, VERSION FROM {VERSIONS_TABLE} WHERE NAME = ? '
+                      'ON CONFLICT (NAME, SEASON) DO UPDATE SET VERSION = excluded.VERSION')
+    try:
+        conn.execute(sql, (table,))
+    except sqlite3.OperationalError:
+        # Connections not opened by connect_sqlite.connect, e.g. benchmarks, may not have been migrated
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {VERSIONS_TABLE} (NAME TEXT PRIMARY KEY, '
+                     'VERSION INTEGER NOT NULL DEFAULT 0)')
+        conn.execute(sql, (table,))
+
+    keys = [(table, key, table) for key in partition_keys(table, rows)]
+    try:
+        conn.executemany(partitions_sql, keys)
+    except sqlite3.OperationalError:
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {PARTITION_VERSIONS_TABLE} (NAME TEXT, SEASON TEXT, '
+                     'VERSION INTEGER NOT NULL, PRIMARY KEY (NAME, SEASON))')
+        conn.executemany(partitions_sql, keys)
+
+
+def sql_type(series):
+    """
+    :param series: Column of a DataFrame
+    :return: SQLite type name pandas would use for the column
+    """
+    if series.dtype.kind in 'iub':
+        return 'INTEGER'
+    if series.dtype.kind == 'f':
+        return 'REAL'
+    return 'TEXT'
+
+
+def frame_rows(df):
+    """
+    Convert a DataFrame into a list of tuples of plain Python values (NaN becomes None) that sqlite3 can bind
+
+    :param df: DataFrame
+    :return: List of row tuples
+    """
+    df = df.astype(object).where(df.notna(), None)
+    return list(df.itertuples(index=False, name=None))
+
+
+def ensure_table(df, table, conn):
+    """
+    Create the table from the DataFrame's schema if it does not exist yet, and add any columns of the DataFrame
+    the table is missing. Does not commit, so it can run inside a caller's transaction.
+
+    :param df: DataFrame whose columns and dtypes define the schema
+    :param table: Table name
+    :param conn: Connection object representing the connection to the SQLite database
+    """
+    if not table_exists(conn, table):
+        # IF NOT EXISTS, since parallel writers may race to create the same table
+        schema = pd.io.sql.get_schema(df, table, con=conn)
+        conn.execute(schema.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', 1))
+        return
+
+    existing = set(table_columns(conn, table))
+    for name in df.columns:
+        if name not in existing:
+            conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{name}" {sql_type(df[name])}')
+
+
+@timed_write
+def insert_frame(df, table, conn, index=False, batch_rows=10000):
+    """
+    Append a DataFrame to a table with batched executemany calls, without committing. Unlike DataFrame.to_sql,
+    several inserts (and other statements) can then be committed as one transaction by the caller.
+
+    :param df: DataFrame to insert
+    :param table: Table name. Created if it does not exist
+    :param conn: Connection object representing the connection to the SQLite database
+    :param index: Whether to write the DataFrame index as a column named 'index', like DataFrame.to_sql
+    :param batch_rows: Number of rows per executemany call
+    :return: Number of rows inserted
+    """
+    if index:
+        df = df.reset_index()
+    if len(df.columns) == 0:
+        return 0
+
+    ensure_table(df, table, conn)
+
+    columns = ', '.join(f'"{col}"' for col in df.columns)
+    placeholders = ', '.join('?' for _ in df.columns)
+    sql = f'INSERT INTO "{table}" ({columns}) VALUES ({placeholders})'
+
+    for start in range(0, len(df), batch_rows):
+        conn.executemany(sql, frame_rows(df.iloc[start:start + batch_rows]))
+    if len(df):
+        bump_version(conn, table, df)
+
+    return len(df)
+
+
+def ensure_unique_index(conn, table, key):
+    """
+    Create the unique index on the natural key that INSERT ... ON CONFLICT needs. Rows of tables written before the
+    index existed may repeat a key; only the most recently written row of each key is kept.
+
+    :param conn: Connection object representing the connection to the SQLite database
+    :param table: Table name
+    :param key: List of key column names
+    """
+    name = f'UX_{table}_{"_".join(key)}'
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,)).fetchone():
+        return
+
+    columns = ', '.join(f'"{col}"' for col in key)
+    deleted = conn.execute(f'DELETE FROM "{table}" WHERE rowid NOT IN (SELECT MAX(rowid) FROM "{table}" '
+                           f'GROUP BY {columns})').rowcount
+    if deleted > 0:
+        bump_version(conn, table)
+    conn.execute(f'CREATE UNIQUE INDEX "{name}" ON "{table}" ({columns})')
+
+
+def _join_keys(conn, table, select, key, keys):
+    """
+    Run SELECT {select} FROM table t for the rows matching a list of key tuples, joining against a temporary table
+    of the keys instead of building a huge IN clause
+
+    :return: sqlite3 cursor rows as a list of tuples, and the cursor description
+    """
+    names = ', '.join(f'"{col}"' for col in key)
+    conn.execute('DROP TABLE IF EXISTS temp._lookup_keys')
+    conn.execute(f'CREATE TEMP TABLE _lookup_keys ({names})')
+    conn.executemany(f'INSERT INTO temp._lookup_keys VALUES ({", ".join("?" for _ in key)})', keys)
+
+    join = ' AND '.join(f't."{col}" = k."{col}"' for col in key)
+    cursor = conn.execute(f'SELECT {select} FROM "{table}" t JOIN (SELECT DISTINCT * FROM temp._lookup_keys) k ON {join}')
+    rows = cursor.fetchall()
+    description = cursor.description
+    conn.execute('DROP TABLE temp._lookup_keys')
+
+    return rows, description
+
+
+def read_rows(conn, table, columns, key, keys):
+    """
+    Read the existing rows of a table for the given keys
+
+    :param conn: Connection object representing the connection to the SQLite database
+    :param table: Table name
+    :param columns: Columns to read. The key columns must come first
+    :param key: List of key column names
+    :param keys: List of key tuples to look up
+    :return: Dict of key tuple to row tuple
+    """
+    rows, _ = _join_keys(conn, table, ', '.join(f't."{col}"' for col in columns), key, keys)
+    return {row[:len(key)]: row for row in rows}
+
+
+def read_frame_by_keys(conn, table, key, keys):
+    """
+    Read every column of the rows of a table matching the given keys, e.g. all rows of a list of GAME_IDs
+
+    :param conn: Connection object representing the connection to the SQLite database
+    :param table: Table name
+    :param key: List of key column names
+    :param keys: List of key tuples to look up
+    :return: DataFrame of matching rows
+    """
+    rows, description = _join_keys(conn, table, 't.*', key, keys)
+    return pd.DataFrame.from_records(rows, columns=[col[0] for col in description])
+
+
+@timed_write
+def upsert(df, table, conn, key, delete_missing=False, batch_rows=10000, commit=True):
+    """
+    Write a DataFrame into a table keyed on its natural key, touching only rows that changed: new keys are inserted,
+    keys whose values differ are updated with INSERT ... ON CONFLICT DO UPDATE, identical rows are left alone. The
+    table, its schema and any indexes added to it are kept, unlike DataFrame.to_sql(if_exists='replace').
+
+    :param df: DataFrame to write. Rows repeating a key keep the last occurrence
+    :param table: Table name. Created if it does not exist
+    :param conn: Connection object representing the connection to the SQLite database
+    :param key: List of key column names, e.g. ['PLAYER_ID', 'SEASON_ID', 'TEAM_ID']. Must not contain NaN
+    :param delete_missing: Whether to delete rows whose key is not in df, for tables that hold a full snapshot
+    :param batch_rows: Number of rows per executemany call
+    :param commit: Whether to commit when done. Pass False to make the write part of a larger transaction
+    :return: Dict with the number of rows 'inserted', 'updated', 'unchanged' and 'deleted'
+    """
+    df = df.drop_duplicates(subset=key, keep='last')
+    columns = key + [col for col in df.columns if col not in key]
+    df = df[columns]
+
+    ensure_table(df, table, conn)
+    ensure_unique_index(conn, table, key)
+
+    rows = frame_rows(df)
+    existing = read_rows(conn, table, columns, key, [row[:len(key)] for row in rows])
+
+    changed = []
+    inserted = updated = 0
+    for row in rows:
+        old = existing.get(row[:len(key)])
+        if old is None:
+            inserted += 1
+            changed.append(row)
+        elif old != row:
+            updated += 1
+            changed.append(row)
+
+    names = ', '.join(f'"{col}"' for col in columns)
+    placeholders = ', '.join('?' for _ in columns)
+    conflict = ', '.join(f'"{col}"' for col in key)
+    updates = ', '.join(f'"{col}" = excluded."{col}"' for col in columns[len(key):])
+    action = f'DO UPDATE SET {updates}' if updates else 'DO NOTHING'
+    sql = f'INSERT INTO "{table}" ({names}) VALUES ({placeholders}) ON CONFLICT ({conflict}) {action}'
+    for start in range(0, len(changed), batch_rows):
+        conn.executemany(sql, changed[start:start + batch_rows])
+
+    deleted = 0
+    if delete_missing:
+        incoming = {row[:len(key)] for row in rows}
+        stale = [k for k in conn.execute(f'SELECT {conflict} FROM "{table}"') if k not in incoming]
+        where = ' AND '.join(f'"{col}" IS ?' for col in key)
+        conn.executemany(f'DELETE FROM "{table}" WHERE {where}', stale)
+        deleted = len(stale)
+
+    if changed or deleted:
+        # Deleted keys may fall in any season
+        bump_version(conn, table, None if deleted else df)
+    if commit:
+        conn.commit()
+
+    return {'inserted': inserted, 'updated': updated, 'unchanged': len(rows) - inserted - updated, 'deleted': deleted}
+
+
+def rows_written(counts):
+    """
+    :param counts: Dict returned by upsert
+    :return: Number of rows the upsert inserted, updated or deleted
+    """
+    return counts['inserted'] + counts['updated'] + counts['deleted']
+
+
+def format_counts(table, counts):
+    """
+    :param table: Table name
+    :param counts: Dict returned by upsert
+    :return: One-line report of an upsert for the run log
+    """
+    return (f'{table}: {counts["inserted"]} inserted, {counts["updated"]} updated, '
+            f'{counts["unchanged"]} unchanged, {counts["deleted"]} deleted')
@@ -0,0 +1,383 @@
+import sys
+import numpy as np
+import pandas as pd
+from connect_sqlite import connect, get_current_time
+from sql_writer import bump_version, ensure_table, ensure_unique_index, frame_rows, insert_frame, table_exists, upsert
+
+MERGED_TABLE = 'ALL_GAMES_MERGED'
+# One row per team per game with its Elo before and after, and its form over the last FORM_WINDOW games
+RATINGS_TABLE = 'TEAM_GAME_RATINGS'
+# Current Elo of every team, the state the next games are rated from
+STATE_TABLE = 'TEAM_RATINGS'
+# Season-to-date home and away totals per team
+SPLITS_TABLE = 'TEAM_SPLITS'
+
+RATINGS_KEY = ['GAME_ID', 'TEAM_ID']
+SPLITS_KEY = ['TEAM_ID', 'SEASON_ID', 'HOME']
+SPLIT_COLUMNS = ['GP', 'W', 'PTS', 'OPP_PTS', 'POSS', 'OPP_POSS']
+
+# Elo parameters: starting rating, K factor, home-court advantage in rating points, and the share of a team's
+# distance from the mean it keeps into a new season
+ELO_START = 1500.0
+ELO_K = 20.0
+ELO_HOME = 100.0
+ELO_CARRYOVER = 0.75
+
+FORM_WINDOW = 10
+
+
+def team_games(merged):
+    """
+    Split merged games into one row per team, each with its opponent's points and possessions
+
+    :param merged: DataFrame of ALL_GAMES_MERGED rows
+    :return: DataFrame of team games ordered by GAME_DATE and GAME_ID, the order they are rated in
+    """
+    sides = []
+    for side, opp in [('A', 'B'), ('B', 'A')]:
+        sides.append(pd.DataFrame({
+            'SEASON_ID': merged['SEASON_ID'],
+            'GAME_ID': merged['GAME_ID'],
+            'GAME_DATE': merged['GAME_DATE'],
+            'TEAM_ID': merged[f'TEAM_ID_{side}'],
+            'TEAM_ABBREVIATION': merged[f'TEAM_ABBREVIATION_{side}'],
+            'OPP_TEAM_ID': merged[f'TEAM_ID_{opp}'],
+            'HOME': merged[f'MATCHUP_{side}'].str.contains(' vs. ', regex=False).astype(int),
+            'WIN': (merged[f'PTS_{side}'] > merged[f'PTS_{opp}']).astype(int),
+            'PTS': merged[f'PTS_{side}'],
+            'OPP_PTS': merged[f'PTS_{opp}'],
+            'POSS': possessions(merged, side),
+            'OPP_POSS': possessions(merged, opp),
+        }))
+
+    games = pd.concat(sides, ignore_index=True)
+    games['MARGIN'] = games['PTS'] - games['OPP_PTS']
+    return games.sort_values(['GAME_DATE', 'GAME_ID', 'HOME'], ascending=[True, True, False], ignore_index=True)
+
+
+def ratable_games(merged):
+    """
+    Keep one row per GAME_ID and drop games without two distinct teams, which cannot be rated. Merges that keep
+    both orders of a game, e.g. neutral-site games where both teams are listed as home or combine_team_games with
+    keep_method=None, hold each game twice; team_games builds the same two rows from either order
+
+    :param merged: DataFrame of ALL_GAMES_MERGED rows
+    :return: DataFrame of the games that can be rated
+    """
+    merged = merged.drop_duplicates('GAME_ID')
+    valid = merged['TEAM_ID_A'].notna() & merged['TEAM_ID_B'].notna() & (merged['TEAM_ID_A'] != merged['TEAM_ID_B'])
+
+    return merged[valid.to_numpy()]
+
+
+def possessions(merged, side):
+    """
+    :return: Series of estimated possessions of one side: FGA + 0.44 FTA - OREB + TOV. NaN where a box score
+        column was not tracked yet, e.g. turnovers before 1977
+    """
+    return merged[f'FGA_{side}'] + 0.44 * merged[f'FTA_{side}'] - merged[f'OREB_{side}'] + merged[f'TOV_{side}']
+
+
+def pair_games(games):
+    """
+    Pivot team games on GAME_ID into one pair of rows per game with an explicit A and B side, like ALL_GAMES_MERGED.
+    Games that do not have exactly two rows of two distinct teams are left out
+
+    :param games: DataFrame of team_games
+    :return: Tuple of numpy arrays (row positions of the A side, row positions of the B side), in the order of games
+    """
+    rows = pd.DataFrame({'GAME_ID': games['GAME_ID'].to_numpy(), 'TEAM_ID': games['TEAM_ID'].to_numpy(),
+                         'POS': np.arange(len(games))})
+    grouped = rows.groupby('GAME_ID', sort=False)['TEAM_ID']
+    valid = (grouped.transform('size') == 2) & (grouped.transform('nunique') == 2)
+    side = grouped.cumcount()
+
+    pairs = rows.loc[valid & (side == 0), ['GAME_ID', 'POS']].merge(
+        rows.loc[valid & (side == 1), ['GAME_ID', 'POS']], on='GAME_ID', suffixes=['_A', '_B'])
+
+    return pairs['POS_A'].to_numpy(), pairs['POS_B'].to_numpy()
+
+
+def elo_ratings(games, state):
+    """
+    Rate games in order with margin-of-victory Elo. Each game's update depends on every earlier game of both teams,
+    so this is one sequential pass rather than a vectorized expression. A team's first game of a new season starts
+    from its rating pulled ELO_CARRYOVER of the way back to the mean
+
+    :param games: DataFrame of team_games. Games are paired by pair_games, and rows of games it leaves out are not rated
+    :param state: Dict of TEAM_ID to (Elo, SEASON_ID) before these games. Updated in place
+    :return: Tuple of numpy arrays aligned with games: Elo before, Elo after, opponent's Elo before and win
+        probability, home advantage included. NaN for rows that were not rated
+    """
+    # Plain lists: indexing them is several times faster than indexing numpy arrays element by element
+    n = len(games)
+    pre, post, opp_pre, prob = ([np.nan] * n for _ in range(4))
+    teams = games['TEAM_ID'].tolist()
+    seasons = games['SEASON_ID'].tolist()
+    home = games['HOME'].tolist()
+    margins = games['MARGIN'].tolist()
+
+    side_a, side_b = pair_games(games)
+    for a, b in zip(side_a.tolist(), side_b.tolist()):
+        elo_a, season = state.get(teams[a], (ELO_START, seasons[a]))
+        if season != seasons[a]:
+            elo_a = ELO_START + ELO_CARRYOVER * (elo_a - ELO_START)
+        elo_b, season = state.get(teams[b], (ELO_START, seasons[b]))
+        if season != seasons[b]:
+            elo_b = ELO_START + ELO_CARRYOVER * (elo_b - ELO_START)
+
+        diff = elo_a - elo_b + ELO_HOME * (home[a] - home[b])
+        expected = 1 / (1 + 10 ** (-diff / 400))
+        margin = margins[a]
+        # The multiplier damps blowouts by favourites, so ratings do not run away
+        multiplier = (abs(margin) + 3) ** 0.8 / (7.5 + 0.006 * (diff if margin > 0 else -diff))
+        change = ELO_K * multiplier * ((margin > 0) - expected)
+
+        pre[a], pre[b] = elo_a, elo_b
+        post[a], post[b] = elo_a + change, elo_b - change
+        opp_pre[a], opp_pre[b] = elo_b, elo_a
+        prob[a], prob[b] = expected, 1 - expected
+        state[teams[a]] = (post[a], seasons[a])
+        state[teams[b]] = (post[b], seasons[b])
+
+    return np.array(pre), np.array(post), np.array(opp_pre), np.array(prob)
+
+
+def rolling_form(games, window=FORM_WINDOW):
+    """
+    Add each team's form over its last window games of the season, current game included, for all teams and seasons
+    at once: rolling sums are group cumulative sums minus the same sums window games earlier
+
+    :param games: DataFrame of team_games, optionally preceded by up to window - 1 earlier games of each team
+    :param window: Number of games in the window
+    :return: games with FORM_GAMES, FORM_WINS, FORM_MARGIN (points per game) and FORM_NET_RTG (points per 100
+        possessions minus points allowed per 100 opponent possessions)
+    """
+    keys = ['TEAM_ID', 'SEASON_ID']
+    columns = ['WIN', 'MARGIN', 'PTS', 'OPP_PTS', 'POSS', 'OPP_POSS']
+    # Missing possessions are counted rather than summed, so a window with any of them has no net rating, whichever
+    # games the cumulative sums started from
+    values = games[columns].fillna(0).assign(MISSING=games[['POSS', 'OPP_POSS']].isna().any(axis=1).astype(int))
+    grouped = values.groupby([games[key] for key in keys], sort=False)
+
+    totals = grouped.cumsum()
+    totals['GAMES'] = grouped.cumcount() + 1
+    earlier = totals.groupby([games[key] for key in keys], sort=False).shift(window, fill_value=0)
+    form = totals - earlier
+    net_rtg = 100 * (form['PTS'] / form['POSS'] - form['OPP_PTS'] / form['OPP_POSS'])
+
+    return games.assign(
+        FORM_GAMES=form['GAMES'],
+        FORM_WINS=form['WIN'],
+        FORM_MARGIN=form['MARGIN'] / form['GAMES'],
+        FORM_NET_RTG=net_rtg.mask(form['MISSING'] > 0),
+    )
+
+
+def season_splits(games):
+    """
+    :param games: DataFrame of team_games
+    :return: DataFrame of SPLITS_KEY and SPLIT_COLUMNS totals. Possessions stay NaN if any game lacks them, as NULL
+        does in the increments of add_splits
+    """
+    games = games.assign(GP=1, W=games['WIN'])
+    keys = [games[key] for key in SPLITS_KEY]
+    totals = games[SPLIT_COLUMNS].groupby(keys).sum()
+    incomplete = games[SPLIT_COLUMNS].isna().groupby(keys).any()
+
+    return totals.mask(incomplete).reset_index()
+
+
+def add_splits(df, CONNECTION):
+    """
+    Add game totals to TEAM_SPLITS, inserting new keys and incrementing existing ones, and keep the per-game and
+    per-100-possession rates in step. Does not commit.
+
+    :param df: DataFrame returned by season_splits
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    """
+    df = df.assign(W_PCT=df['W'] / df['GP'], MARGIN=(df['PTS'] - df['OPP_PTS']) / df['GP'],
+                   NET_RTG=100 * (df['PTS'] / df['POSS'] - df['OPP_PTS'] / df['OPP_POSS']))
+    ensure_table(df, SPLITS_TABLE, CONNECTION)
+    ensure_unique_index(CONNECTION, SPLITS_TABLE, SPLITS_KEY)
+
+    names = ', '.join(f'"{col}"' for col in df.columns)
+    placeholders = ', '.join('?' for _ in df.columns)
+    increments = ', '.join(f'{col} = {col} + excluded.{col}' for col in SPLIT_COLUMNS)
+    total = {col: f'({col} + excluded.{col})' for col in SPLIT_COLUMNS}
+    CONNECTION.executemany(
+        f'INSERT INTO "{SPLITS_TABLE}" ({names}) VALUES ({placeholders}) ON CONFLICT ({", ".join(SPLITS_KEY)}) '
+        f'DO UPDATE SET {increments}, '
+        f'W_PCT = CAST({total["W"]} AS REAL) / {total["GP"]}, '
+        f'MARGIN = CAST({total["PTS"]} - {total["OPP_PTS"]} AS REAL) / {total["GP"]}, '
+        f'NET_RTG = 100 * ({total["PTS"]} / {total["POSS"]} - {total["OPP_PTS"]} / {total["OPP_POSS"]})',
+        frame_rows(df))
+    bump_version(CONNECTION, SPLITS_TABLE, df)
+
+
+def read_state(CONNECTION):
+    """
+    :return: Tuple of (dict of TEAM_ID to (Elo, SEASON_ID), dict of TEAM_ID to (GAME_DATE, GAME_ID) of its last
+        rated game)
+    """
+    if not table_exists(CONNECTION, STATE_TABLE):
+        return {}, {}
+
+    rows = CONNECTION.execute(f'SELECT TEAM_ID, ELO, SEASON_ID, LAST_GAME_DATE, LAST_GAME_ID FROM {STATE_TABLE}')
+    state, last = {}, {}
+    for team, elo, season, date, game_id in rows:
+        state[team] = (elo, season)
+        last[team] = (date, game_id)
+
+    return state, last
+
+
+def recent_games(CONNECTION, games, window=FORM_WINDOW):
+    """
+    :param games: DataFrame of new team_games
+    :return: DataFrame of the last window - 1 rated games of each team in games, in the same season, oldest first
+    """
+    recent = []
+    for team, season in games[['TEAM_ID', 'SEASON_ID']].drop_duplicates().itertuples(index=False):
+        recent.append(pd.read_sql_query(
+            f'SELECT * FROM {RATINGS_TABLE} WHERE TEAM_ID = ? AND SEASON_ID = ? '
+            'ORDER BY GAME_DATE DESC, GAME_ID DESC LIMIT ?', CONNECTION, params=(int(team), season, window - 1)))
+
+    recent = [df for df in recent if len(df)]
+    if not recent:
+        return games.iloc[:0]
+
+    return pd.concat(recent, ignore_index=True).sort_values(['GAME_DATE', 'GAME_ID'], ignore_index=True)
+
+
+def rate_games(CONNECTION, merged, state, window=FORM_WINDOW):
+    """
+    Rate new merged games and write them to the ratings, state and splits tables, without committing
+
+    :param merged: DataFrame of ALL_GAMES_MERGED rows not rated yet, all later than each team's last rated game.
+        Repeated GAME_IDs are rated once and games without two distinct teams are skipped, see ratable_games
+    :param state: Dict of TEAM_ID to (Elo, SEASON_ID) before these games
+    :return: Number of team games rated
+    """
+    ratable = ratable_games(merged)
+    skipped = sorted(set(merged['GAME_ID']) - set(ratable['GAME_ID']))
+    if skipped:
+        print(f'{get_current_time()}: Skipped {len(skipped)} games without two distinct teams: {", ".join(skipped[:5])}')
+
+    games = team_games(ratable)
+    games['ELO_PRE'], games['ELO_POST'], games['OPP_ELO_PRE'], games['ELO_WIN_PROB'] = elo_ratings(games, state)
+
+    # Form windows reach back into games rated by earlier runs
+    history = recent_games(CONNECTION, games, window) if table_exists(CONNECTION, RATINGS_TABLE) else games.iloc[:0]
+    games = rolling_form(pd.concat([history[games.columns], games], ignore_index=True), window).iloc[len(history):]
+
+    insert_frame(games, RATINGS_TABLE, CONNECTION)
+    ensure_unique_index(CONNECTION, RATINGS_TABLE, RATINGS_KEY)
+    add_splits(season_splits(games), CONNECTION)
+
+    last = games.drop_duplicates('TEAM_ID', keep='last')
+    ratings = pd.DataFrame({
+        'TEAM_ID': last['TEAM_ID'],
+        'TEAM_ABBREVIATION': last['TEAM_ABBREVIATION'],
+        'ELO': [state[team][0] for team in last['TEAM_ID']],
+        'SEASON_ID': last['SEASON_ID'],
+        'LAST_GAME_DATE': last['GAME_DATE'],
+        'LAST_GAME_ID': last['GAME_ID'],
+    })
+    upsert(ratings, STATE_TABLE, CONNECTION, ['TEAM_ID'], commit=False)
+
+    return len(games)
+
+
+def read_merged(CONNECTION, unrated=False):
+    """
+    :param unrated: Whether to read only the games without rows in TEAM_GAME_RATINGS
+    :return: DataFrame of the ALL_GAMES_MERGED columns the ratings need
+    """
+    columns = ['SEASON_ID', 'GAME_ID', 'GAME_DATE'] + [f'{col}_{side}' for side in 'AB' for col in
+                                                       ['TEAM_ID', 'TEAM_ABBREVIATION', 'MATCHUP', 'PTS', 'FGA', 'FTA',
+                                                        'OREB', 'TOV']]
+    where = f' WHERE GAME_ID NOT IN (SELECT GAME_ID FROM {RATINGS_TABLE})' if unrated else ''
+
+    return pd.read_sql_query(f'SELECT {", ".join(columns)} FROM {MERGED_TABLE}{where}', CONNECTION)
+
+
+def rebuild_ratings(CONNECTION):
+    """
+    Recompute every rating from the first game in ALL_GAMES_MERGED and replace the ratings, state and splits
+    tables in one transaction
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :return: Number of team games rated
+    """
+    if not table_exists(CONNECTION, MERGED_TABLE):
+        return 0
+
+    merged = read_merged(CONNECTION)
+    try:
+        for table in [RATINGS_TABLE, STATE_TABLE, SPLITS_TABLE]:
+            if table_exists(CONNECTION, table):
+                CONNECTION.execute(f'DELETE FROM {table}')
+                bump_version(CONNECTION, table)
+        rated = rate_games(CONNECTION, merged, {}) if len(merged) else 0
+        CONNECTION.commit()
+    except Exception:
+        CONNECTION.rollback()
+        raise
+
+    print(f'{get_current_time()}: Rebuilt team ratings from {len(merged)} games')
+    return rated
+
+
+def update_ratings(CONNECTION):
+    """
+    Rate the games in ALL_GAMES_MERGED that are not rated yet, carrying each team's Elo, form window and splits
+    forward from the stored tables. Games are found by GAME_ID rather than passed in, so games saved by a run whose
+    rating step failed are picked up by the next. Falls back to rebuild_ratings when nothing is rated yet, or when a
+    new game predates a team's last rated game, since Elo depends on the order of games
+
+    :param CONNECTION: Connection object representing the connection to the SQLite database
+    :return: Number of team games rated
+    """
+    if not table_exists(CONNECTION, MERGED_TABLE):
+        return 0
+    if not table_exists(CONNECTION, RATINGS_TABLE):
+        return rebuild_ratings(CONNECTION)
+
+    # Games that cannot be rated stay unrated forever, so they are left out here rather than forcing a rebuild
+    merged = ratable_games(read_merged(CONNECTION, unrated=True))
+    if merged.empty:
+        return 0
+
+    state, last = read_state(CONNECTION)
+    for side in 'AB':
+        previous = merged[f'TEAM_ID_{side}'].map(lambda team: last.get(team, ('', '')))
+        if any(game < previous for game, previous in zip(zip(merged['GAME_DATE'], merged['GAME_ID']), previous)):
+            print(f'{get_current_time()}: New games predate rated games, rebuilding team ratings')
+            return rebuild_ratings(CONNECTION)
+
+    try:
+        rated = rate_games(CONNECTION, merged, state)
+        CONNECTION.commit()
+    except Exception:
+        CONNECTION.rollback()
+        raise
+
+    print(f'{get_current_time()}: Rated {len(merged)} new games')
+    return rated
+
+
+def main(rebuild=False):
+    """
+    Bring the team ratings up to date with ALL_GAMES_MERGED
+
+    :param rebuild: Whether to recompute everything instead of rating only new games
+    :return: Number of team games rated
+    """
+    with connect() as conn:
+        return rebuild_ratings(conn) if rebuild else update_ratings(conn)
+
+
+if __name__ == '__main__':
+    # python team_ratings.py [--rebuild]
+    main(rebuild='--rebuild' in sys.argv[1:])
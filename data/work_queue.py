@@ -0,0 +1,168 @@
+import time
+from collections import Counter
+import pandas as pd
+
+
+TABLE = 'WORK_QUEUE'
+
+
+class WorkQueue:
+    """
+    Persistent work queue of IDs. Completed IDs are recorded in the WORK_QUEUE table, so a crashed or interrupted run
+    restarted with the same queue name skips everything that was already done. Membership checks are O(1) set lookups.
+    An ID is yielded until it is marked done or retry() gives up on it, so every failure must call retry().
+
+    Usage:
+        queue = WorkQueue(conn, 'players_active', player_ids)
+        for id in queue:
+            try:
+                ...
+                queue.done(id)
+            except Exception:
+                queue.retry(id)
+        queue.finish()
+    """
+
+    def __init__(self, conn, name, ids, table=TABLE, retries=3, backoff=2.0, max_backoff=60.0):
+        """
+        :param conn: Connection object representing the connection to the SQLite database
+        :param name: Name identifying this queue across runs
+        :param ids: Iterable of integer IDs to process
+        :param table: Table recording the completed IDs. Default 'WORK_QUEUE'
+        :param retries: Number of times a failed ID is retried in one run before it is left for the next run
+        :param backoff: Seconds before the first retry of an ID, doubled for every retry after it
+        :param max_backoff: Upper bound of the wait between retries, in seconds
+        """
+        self.conn = conn
+        self.name = name
+        self.table = table
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.attempts = Counter()
+        # Completion marks held back by done(defer=True) until write_marks()
+        self.deferred = []
+        # IDs given up on in this run. They stay pending in the table, so the next run tries them again
+        self.failed = []
+
+        create_queue_table(conn, table)
+        done = pd.read_sql_query(f'SELECT ITEM_ID FROM {table} WHERE QUEUE = ?', conn, params=(name,))
+        self.completed = set(done['ITEM_ID'])
+
+        # dict.fromkeys drops duplicate IDs but keeps the input order
+        self.pending = [id for id in dict.fromkeys(int(id) for id in ids) if id not in self.completed]
+
+    def __iter__(self):
+        while len(self.pending) > 0:
+            yield self.pending[-1]
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __contains__(self, id):
+        return id in self.completed
+
+    def done(self, id, commit=True, defer=False):
+        """
+        Mark an ID as completed and remove it from the pending list
+
+        :param id: Completed ID
+        :param commit: Whether to commit immediately. Pass False to have the mark committed together with the rows
+            written for this ID in the caller's transaction, so both land or neither does
+        :param defer: Whether to hold the mark in memory until write_marks(), e.g. passed as a FrameAccumulator's
+            on_flush so marks land in the flush that writes their rows without a write transaction staying open
+            between flushes
+        """
+        if defer:
+            self.deferred.append(int(id))
+        else:
+            self.conn.execute(f'INSERT OR IGNORE INTO {self.table} (QUEUE, ITEM_ID) VALUES (?, ?)', (self.name, int(id)))
+            if commit:
+                self.conn.commit()
+
+        self.completed.add(id)
+        self._remove(id)
+
+    def write_marks(self):
+        """
+        Write the marks deferred by done(defer=True), without committing
+        """
+        if self.deferred:
+            self.conn.executemany(f'INSERT OR IGNORE INTO {self.table} (QUEUE, ITEM_ID) VALUES (?, ?)',
+                                  [(self.name, id) for id in self.deferred])
+        self.deferred = []
+
+    def retry(self, id):
+        """
+        Record a failed attempt at an ID. While the ID has retries left, wait out an exponential backoff before it is
+        yielded again. After that, give up on it for this run: it leaves the pending list without being marked done
+
+        :param id: ID whose attempt failed
+        :return: Whether the ID will be yielded again
+        """
+        self.attempts[id] += 1
+        if self.attempts[id] > self.retries:
+            self.failed.append(id)
+            self._remove(id)
+            return False
+
+        time.sleep(min(self.backoff * 2 ** (self.attempts[id] - 1), self.max_backoff))
+        return True
+
+    def _remove(self, id):
+        if len(self.pending) > 0 and self.pending[-1] == id:
+            self.pending.pop()
+        elif id in self.pending:
+            self.pending.remove(id)
+
+    def finish(self, staging_table=None):
+        """
+        Clear the queue after its results have been saved, so the next run starts from scratch
+
+        :param staging_table: Optional staging table holding this queue's partial results, dropped as well
+        """
+        clear_queue(self.conn, self.name, staging_table, self.table)
+        self.pending = []
+        self.completed = set()
+
+
+def create_queue_table(conn, table):
+    """
+    Create a table recording completed IDs per queue if it does not exist yet
+
+    :param conn: Connection object representing the connection to the SQLite database
+    :param table: Table name
+    """
+    conn.execute(f'CREATE TABLE IF NOT EXISTS {table} (QUEUE TEXT, ITEM_ID INTEGER, PRIMARY KEY (QUEUE, ITEM_ID))')
+
+
+def clear_queue(conn, name, staging_table=None, table=TABLE):
+    """
+    Delete the completed IDs of a queue, and optionally its staging table
+
+    :param conn: Connection object representing the connection to the SQLite database
+    :param name: Name of the queue
+    :param staging_table: Optional staging table holding this queue's partial results
+    :param table: Table recording the completed IDs. Default 'WORK_QUEUE'
+    """
+    create_queue_table(conn, table)
+    conn.execute(f'DELETE FROM {table} WHERE QUEUE = ?', (name,))
+    if staging_table is not None:
+        conn.execute(f'DROP TABLE IF EXISTS {staging_table}')
+    conn.commit()
+
+
+def read_staging(conn, staging_table):
+    """
+    Read everything staged so far by a queue's downloader
+
+    :param conn: Connection object representing the connection to the SQLite database
+    :param staging_table: Name of the staging table
+    :return: DataFrame of staged rows. Empty DataFrame if nothing has been staged
+    """
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (staging_table,)).fetchone()
+    if exists is None:
+        return pd.DataFrame()
+
+    return pd.read_sql_query(f'SELECT * FROM {staging_table}', conn)